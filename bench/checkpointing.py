@@ -0,0 +1,160 @@
+"""
+Mask R-CNN
+Memory and time of a training step of the whole network with and
+without gradient checkpointing (GRADIENT_CHECKPOINTING in config.py).
+
+    python -m bench.checkpointing --size 1024 --rois 200
+
+"kept MB" is the memory held from the end of the forward pass for the
+backward pass, which is what checkpointing cuts. "peak MB" is the most
+memory used during the step. It only drops if the peak comes from
+activations rather than, say, the proposal layer. Both are on top of the
+memory in use before the step: what torch allocated on GPU, or the
+resident set size of the process on CPU (Linux only).
+
+Each setting runs in a fresh process so that the peak memory of one
+doesn't hide the next. Weights and inputs are random, but the same in
+every setting, so the gradient norms should match.
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+import resource
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+import utils
+import model as modellib
+from config import Config
+
+
+SETTINGS = [
+    ("none", []),
+    ("resnet", ["C1", "C2", "C3", "C4", "C5"]),
+    ("resnet+fpn", ["C1", "C2", "C3", "C4", "C5", "fpn"]),
+    ("mask", ["mask"]),
+    ("all", ["C1", "C2", "C3", "C4", "C5", "fpn", "mask"]),
+]
+
+
+def bench_config(args, parts):
+    class BenchConfig(Config):
+        NAME = "bench"
+        GPU_COUNT = int(args.gpu)
+        IMAGES_PER_GPU = args.batch
+        NUM_CLASSES = 81
+        IMAGE_MIN_DIM = args.size
+        IMAGE_MAX_DIM = args.size
+        TRAIN_ROIS_PER_IMAGE = args.rois
+        RPN_TARGETS_ON_DEVICE = True
+        GRADIENT_CHECKPOINTING = parts
+    return BenchConfig()
+
+
+def synthetic_batch(config, instances, rng):
+    """A training batch of random images with random boxes and full
+    mini-masks, as train_epoch() would pass it to predict().
+    """
+    batch, size = config.BATCH_SIZE, config.IMAGE_MAX_DIM
+    images = rng.randint(0, 256, [batch, size, size, 3]).astype(np.uint8)
+    image_metas = np.stack([
+        modellib.compose_image_meta(i, (size, size, 3), (0, 0, size, size),
+                                    np.ones([config.NUM_CLASSES], dtype=np.int32))
+        for i in range(batch)])
+    y1x1 = rng.randint(0, size // 2, [batch, instances, 2])
+    hw = rng.randint(16, size // 2, [batch, instances, 2])
+    gt_boxes = np.concatenate([y1x1, y1x1 + hw], axis=2).astype(np.float32)
+    gt_class_ids = rng.randint(1, config.NUM_CLASSES, [batch, instances]).astype(np.int32)
+    gt_masks = utils.pack_masks(np.ones([batch * instances] + list(config.MINI_MASK_SHAPE), dtype=bool))
+    gt_masks = gt_masks.reshape(batch, instances, -1)
+
+    inputs = [Variable(torch.from_numpy(a)) for a in (images, gt_class_ids, gt_boxes, gt_masks)]
+    if config.GPU_COUNT:
+        inputs = [v.cuda() for v in inputs]
+    images, gt_class_ids, gt_boxes, gt_masks = inputs
+    return [images, image_metas, gt_class_ids, gt_boxes, gt_masks, None, None, None]
+
+
+def memory(config):
+    """Memory in use in MB, on the GPU or by the process."""
+    if config.GPU_COUNT:
+        return torch.cuda.memory_allocated() / 2 ** 20
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def peak_memory(config):
+    """Peak memory in MB, of the GPU or of the process."""
+    if config.GPU_COUNT:
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def run(args, parts):
+    """Runs training steps with the given GRADIENT_CHECKPOINTING. Returns
+    the best step time in seconds, the memory kept for the backward pass
+    and the peak memory in MB, and the norm of the gradients.
+    """
+    torch.manual_seed(args.seed)
+    config = bench_config(args, parts)
+    model = modellib.MaskRCNN(config, model_dir=tempfile.gettempdir())
+    if config.GPU_COUNT:
+        model = model.cuda()
+    if args.heads:
+        for name, param in model.named_parameters():
+            if re.match(r"fpn\.C\d\.", name):
+                param.requires_grad = False
+    inputs = synthetic_batch(config, args.instances, np.random.RandomState(args.seed))
+
+    best = float("inf")
+    for _ in range(args.steps):
+        torch.manual_seed(args.seed)
+        model.zero_grad()
+        start_memory = memory(config)
+        start = time.perf_counter()
+        loss = sum(modellib.compute_losses(*model.predict(inputs, mode="training")))
+        kept_memory = memory(config) - start_memory
+        loss.backward()
+        if config.GPU_COUNT:
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    grad_norm = sum(float(p.grad.data.norm()) ** 2 for p in model.parameters()
+                    if p.grad is not None) ** 0.5
+    return best, kept_memory, peak_memory(config) - start_memory, grad_norm
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark memory and time of gradient checkpointing.")
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--rois', type=int, default=200)
+    parser.add_argument('--instances', type=int, default=10)
+    parser.add_argument('--steps', type=int, default=2)
+    parser.add_argument('--heads', action='store_true',
+                        help="Freeze the ResNet stages, as with layers='heads'")
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print("{}x{} images, batch of {}, {} ROIs per image, training {}".format(
+        args.size, args.size, args.batch, args.rois, "heads" if args.heads else "all layers"))
+    print("{:12} {:>10} {:>10} {:>10} {:>12}".format("", "step s", "kept MB", "peak MB", "grad norm"))
+    # Make glibc return freed tensors to the system right away, so that
+    # the peak resident set size follows the memory in use on CPU.
+    os.environ.setdefault("MALLOC_MMAP_THRESHOLD_", str(2 ** 16))
+    context = multiprocessing.get_context("spawn")
+    for name, parts in SETTINGS:
+        with context.Pool(1) as pool:
+            seconds, kept, peak, grad_norm = pool.apply(run, (args, parts))
+        print("{:12} {:10.2f} {:10.0f} {:10.0f} {:12.6g}".format(name, seconds, kept, peak, grad_norm))
+
+
+if __name__ == '__main__':
+    main()
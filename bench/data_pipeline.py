@@ -0,0 +1,249 @@
+"""
+Mask R-CNN
+Throughput of the training data pipeline, model.Dataset.__getitem__(),
+and the time of each of its steps.
+
+    python -m bench.data_pipeline --images images/ --workers 4 --step-time 0.5
+
+Samples are loaded in --workers processes, each on its own share of the
+dataset, as DataLoader workers would. Throughput is measured over the
+loading loops; spawning the workers and building their datasets is
+reported as startup. The steps are timed by wrapping
+the functions that do them:
+
+    load_image_resized   Decoding and resizing the image
+      load_image         Decoding, for datasets that override load_image()
+      resize_image       Resizing, for those datasets and non-JPEG files
+    load_mask_crops      Loading the masks as per-instance crops
+      load_mask          Loading the full resolution masks
+      resize_mask        Resizing and padding them like the image
+      extract_bboxes     Boxes of the resized masks
+    flip_mask_crops      Horizontal flips
+    minimize_mask_crops  Mini masks (expand_mask_crops without them)
+    build_rpn_targets    Anchor matching and sampling
+    sparse_rpn_match     Indices and labels of the sampled anchors
+    pack_masks           Bit-packing the masks
+    other                The rest: tensor conversion, image meta, ...
+
+Indented steps are part of the one above them. The table gives the mean
+and percentiles of each step per sample, --histograms prints their
+distribution.
+
+With --step-time, the time of a training step in seconds, it also
+prints the number of workers needed to load --batch samples within
+each step, to set DATA_LOADER_WORKERS.
+
+The images in --images get random elliptical instance masks at full
+resolution. With --coco, samples come from a COCO subset instead, which
+needs pycocotools.
+"""
+
+import argparse
+import functools
+import json
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+import utils
+import model as modellib
+from config import Config
+
+
+# (step, module or None for the dataset, nesting level)
+STEPS = [
+    ("load_image_resized", None, 0),
+    ("load_image", None, 1),
+    ("resize_image", utils, 1),
+    ("load_mask_crops", None, 0),
+    ("load_mask", None, 1),
+    ("resize_mask", utils, 1),
+    ("extract_bboxes", utils, 1),
+    ("flip_mask_crops", utils, 0),
+    ("minimize_mask_crops", utils, 0),
+    ("expand_mask_crops", utils, 0),
+    ("build_rpn_targets", modellib, 0),
+    ("sparse_rpn_match", modellib, 0),
+    ("pack_masks", utils, 0),
+]
+
+
+class ImageFolderDataset(utils.Dataset):
+    """The images of a directory, each with a few random elliptical
+    instance masks of a single class.
+    """
+
+    def load_images(self, directory, instances=8, seed=0):
+        self.add_class("folder", 1, "object")
+        self.instances = instances
+        self.seed = seed
+        for name in sorted(os.listdir(directory)):
+            if not name.lower().endswith((".jpg", ".jpeg", ".png")):
+                continue
+            path = os.path.join(directory, name)
+            with Image.open(path) as im:
+                width, height = im.size
+            self.add_image("folder", name, path, width=width, height=height)
+
+    def load_mask(self, image_id):
+        info = self.image_info[image_id]
+        height, width = info["height"], info["width"]
+        rng = np.random.RandomState(self.seed + image_id)
+        y, x = np.ogrid[:height, :width]
+        mask = np.zeros([height, width, self.instances], dtype=bool)
+        for i in range(self.instances):
+            cy, cx = rng.uniform(0, height), rng.uniform(0, width)
+            ry, rx = rng.uniform(8, height / 4), rng.uniform(8, width / 4)
+            mask[:, :, i] = ((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2 <= 1
+        return mask, np.ones([self.instances], dtype=np.int32)
+
+
+def make_dataset(args):
+    if args.coco:
+        import coco
+        dataset = coco.CocoDataset()
+        dataset.load_coco(args.coco, args.subset)
+    else:
+        dataset = ImageFolderDataset()
+        dataset.load_images(args.images, args.instances, args.seed)
+    dataset.prepare()
+    return dataset
+
+
+def make_config(args, num_classes):
+    class BenchConfig(Config):
+        NAME = "bench"
+        GPU_COUNT = 0
+        IMAGES_PER_GPU = args.batch
+        NUM_CLASSES = num_classes
+        IMAGE_MIN_DIM = min(800, args.size)
+        IMAGE_MAX_DIM = args.size
+        USE_MINI_MASK = not args.full_masks
+        DATA_LOADER_WORKERS = args.workers
+    return BenchConfig()
+
+
+def timed(times, name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            times[name] = times.get(name, 0) + time.perf_counter() - start
+    return wrapper
+
+
+def load_samples(args, worker):
+    """Loads the samples of a worker's share of the dataset. Returns the
+    time of each step for each sample, and the wall time of the worker.
+    """
+    dataset = make_dataset(args)
+    config = make_config(args, dataset.num_classes)
+    data = modellib.Dataset(dataset, config, augment=True)
+
+    times = {}
+    for name, module, _ in STEPS:
+        owner = dataset if module is None else module
+        setattr(owner, name, timed(times, name, getattr(owner, name)))
+
+    indices = [i % len(data.image_ids) for i in range(args.samples)][worker::args.workers]
+    samples = []
+    start = time.perf_counter()
+    for index in indices:
+        times.clear()
+        sample_start = time.perf_counter()
+        data[index]
+        total = time.perf_counter() - sample_start
+        sample = dict(times)
+        sample["other"] = total - sum(sample.get(name, 0) for name, _, level in STEPS if level == 0)
+        sample["total"] = total
+        samples.append(sample)
+    return samples, time.perf_counter() - start
+
+
+def histogram(values, bins=10, width=40):
+    """Text histogram of values in ms, one line per bin."""
+    counts, edges = np.histogram(values * 1000, bins=bins)
+    lines = []
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        bar = "#" * int(round(width * count / max(counts.max(), 1)))
+        lines.append("    {:9.2f} - {:9.2f} ms {:6} {}".format(low, high, count, bar))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the training data pipeline per step.")
+    parser.add_argument('--images', default="images",
+                        help="Directory of images to give random masks")
+    parser.add_argument('--instances', type=int, default=8,
+                        help="Random masks per image")
+    parser.add_argument('--coco', metavar="DIR",
+                        help="Load samples from the COCO dataset in DIR instead")
+    parser.add_argument('--subset', default="val")
+    parser.add_argument('--samples', type=int, default=64,
+                        help="Samples to load, cycling through the dataset")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--size', type=int, default=1024,
+                        help="IMAGE_MAX_DIM")
+    parser.add_argument('--full-masks', action='store_true',
+                        help="Full image size masks instead of mini masks")
+    parser.add_argument('--batch', type=int, default=2,
+                        help="Images per training step")
+    parser.add_argument('--step-time', type=float,
+                        help="Seconds per training step of the model")
+    parser.add_argument('--histograms', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar="PATH",
+                        help="Write the times of all samples to this file")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    start = time.perf_counter()
+    with context.Pool(args.workers) as pool:
+        results = pool.starmap(load_samples, [(args, w) for w in range(args.workers)])
+    wall = time.perf_counter() - start
+    samples = [s for worker_samples, _ in results for s in worker_samples]
+    worker_rate = np.mean([len(s) / elapsed for s, elapsed in results if s])
+    # The throughput only counts the loading loops. Spawning the workers,
+    # imports and building the dataset are startup.
+    loop_time = max(elapsed for _, elapsed in results)
+    rate = len(samples) / loop_time
+    startup = wall - loop_time
+
+    print("{} samples, {} workers: {:.1f} samples/s, {:.1f} samples/s per worker, "
+          "{:.2f}s startup".format(len(samples), args.workers, rate, worker_rate, startup))
+    print("\n{:24} {:>9} {:>9} {:>9} {:>9} {:>7}".format("", "mean ms", "p50 ms", "p90 ms", "max ms", "share"))
+    mean_total = np.mean([s["total"] for s in samples])
+    names = [(name, level) for name, _, level in STEPS] + [("other", 0), ("total", 0)]
+    for name, level in names:
+        values = np.array([s.get(name, 0) for s in samples])
+        if not values.any():
+            continue
+        print("{:24} {:9.2f} {:9.2f} {:9.2f} {:9.2f} {:6.1%}".format(
+            "  " * level + name, values.mean() * 1000, np.percentile(values, 50) * 1000,
+            np.percentile(values, 90) * 1000, values.max() * 1000, values.mean() / mean_total))
+        if args.histograms:
+            print(histogram(values))
+
+    if args.step_time:
+        needed = args.batch / args.step_time / worker_rate
+        print("\n{} samples per {:.3f}s step need {:.1f} workers at {:.1f} samples/s each: "
+              "use DATA_LOADER_WORKERS = {}".format(args.batch, args.step_time, needed,
+                                                     worker_rate, math.ceil(needed)))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"workers": args.workers, "wall_s": wall, "startup_s": startup,
+                       "samples_per_second": rate,
+                       "samples_per_second_per_worker": worker_rate,
+                       "samples": samples}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Mask R-CNN
+End-to-end throughput and latency of MaskRCNN.detect().
+
+    python -m bench.e2e --config tiny --images images/ --batch 1,2,4 --threads 1,4,16
+
+Every combination of batch size and thread count runs in a fresh
+process, which builds the model, loads the weights (random ones unless
+--weights is given) and detects on the images, passed as file paths so
+that decoding counts too, in batches. It reports:
+
+    images/s    Images detected per second after the first call
+    p50/p95/p99 Latency of a detect() call in ms, over all calls but the
+                first. Each image of a batch waits for the whole batch.
+    cold s      Time to the first result: building the model, loading the
+                weights and the first detect() call
+    peak MB     Peak resident set size of the process (Linux, macOS)
+
+Configurations:
+
+    tiny    256x256 inputs with fewer proposals and detections, for quick
+            runs on CPU, e.g. in CI
+    coco    CocoConfig from coco.py, for real measurements
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+import model as modellib
+from config import Config
+
+
+class TinyConfig(Config):
+    NAME = "tiny"
+    GPU_COUNT = 0
+    IMAGES_PER_GPU = 1
+    NUM_CLASSES = 1 + 80
+    IMAGE_MIN_DIM = 256
+    IMAGE_MAX_DIM = 256
+    RPN_ANCHOR_SCALES = (8, 16, 32, 64, 128)
+    POST_NMS_ROIS_INFERENCE = 100
+    DETECTION_MAX_INSTANCES = 20
+
+
+def make_config(name, batch, gpu):
+    if name == "tiny":
+        base = TinyConfig
+    else:
+        # coco.py needs pycocotools, only import it when asked for
+        import coco
+        base = coco.CocoConfig
+
+    class BenchConfig(base):
+        GPU_COUNT = int(gpu)
+        IMAGES_PER_GPU = batch
+    return BenchConfig()
+
+
+def image_inputs(args):
+    """Paths of the images in args.images, or random images if None."""
+    if args.images:
+        return sorted(os.path.join(args.images, f) for f in os.listdir(args.images)
+                      if f.lower().endswith((".jpg", ".jpeg", ".png")))
+    rng = np.random.RandomState(args.seed)
+    return [rng.randint(0, 256, [480, 640, 3]).astype(np.uint8) for _ in range(args.count)]
+
+
+def peak_rss():
+    """Peak resident set size of the process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def run(args, batch, threads):
+    """Runs the benchmark of one batch size and thread count. Returns a
+    dict of the measurements.
+    """
+    torch.set_num_threads(threads)
+    torch.manual_seed(args.seed)
+    images = image_inputs(args)
+    batches = [images[i:i + batch] for i in range(0, len(images) - batch + 1, batch)] * args.repeat
+    if not batches:
+        raise ValueError("Fewer images than the batch size {}.".format(batch))
+
+    start = time.perf_counter()
+    config = make_config(args.config, batch, args.gpu)
+    model = modellib.MaskRCNN(config, model_dir=tempfile.mkdtemp())
+    if args.gpu:
+        model = model.cuda()
+    if args.weights:
+        model.load_weights(args.weights)
+
+    latencies = []
+    with torch.no_grad():
+        for images in batches:
+            call_start = time.perf_counter()
+            model.detect(images)
+            latencies.append(time.perf_counter() - call_start)
+            if len(latencies) == 1:
+                cold_start = time.perf_counter() - start
+    latencies = np.array(latencies[1:]) if len(latencies) > 1 else np.array(latencies)
+    return {
+        "config": args.config, "batch": batch, "threads": threads,
+        "images_per_second": batch * len(latencies) / latencies.sum(),
+        "p50_ms": np.percentile(latencies, 50) * 1000,
+        "p95_ms": np.percentile(latencies, 95) * 1000,
+        "p99_ms": np.percentile(latencies, 99) * 1000,
+        "cold_start_s": cold_start,
+        "peak_rss_mb": peak_rss(),
+    }
+
+
+def int_list(text):
+    return [int(v) for v in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark throughput and latency of MaskRCNN.detect().")
+    parser.add_argument('--config', choices=["tiny", "coco"], default="tiny")
+    parser.add_argument('--images', metavar="DIR",
+                        help="Directory of images, random images if not given")
+    parser.add_argument('--count', type=int, default=16,
+                        help="Number of random images")
+    parser.add_argument('--weights', metavar="PATH",
+                        help="Weights file, random weights if not given")
+    parser.add_argument('--batch', type=int_list, default=[1],
+                        help="Comma separated batch sizes")
+    parser.add_argument('--threads', type=int_list, default=[torch.get_num_threads()],
+                        help="Comma separated torch thread counts")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Passes over the images")
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar="PATH",
+                        help="Write the results to this file")
+    args = parser.parse_args()
+
+    print("{:6} {:>5} {:>7} {:>9} {:>9} {:>9} {:>9} {:>8} {:>8}".format(
+        "config", "batch", "threads", "images/s", "p50 ms", "p95 ms", "p99 ms", "cold s", "peak MB"))
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for batch in args.batch:
+        for threads in args.threads:
+            with context.Pool(1) as pool:
+                result = pool.apply(run, (args, batch, threads))
+            results.append(result)
+            print("{config:6} {batch:5} {threads:7} {images_per_second:9.2f} {p50_ms:9.1f} "
+                  "{p95_ms:9.1f} {p99_ms:9.1f} {cold_start_s:8.2f} {peak_rss_mb:8.0f}".format(**result))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+"""
+Mask R-CNN
+Micro-benchmarks of the detection hot paths on synthetic inputs. Runs on
+CPU, or on GPU with --gpu.
+
+    python -m bench.kernels --json results.json
+    python -m bench.kernels --save-baseline baseline.json
+    python -m bench.kernels --baseline baseline.json --tolerance 0.1
+
+Each case reports the median and 90th percentile time of a call and the
+throughput in items (boxes, ROIs, anchors or images) per second. With
+--baseline, medians are compared to those of a file written with
+--save-baseline on the same machine, and the command exits with status 1
+if any case got slower by more than --tolerance. There is no baseline in
+the repository since timings only compare on the same hardware. A case
+that raises an exception is reported and left out of the results, the
+others still run, and the command exits with status 1.
+
+Inputs are random but follow the shapes of inference or training on
+1024x1024 images with 81 classes, the COCO setup.
+"""
+
+import argparse
+import json
+import platform
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+import utils
+import model as modellib
+from config import Config
+from nms.nms_wrapper import nms
+from roialign.roi_align.crop_and_resize import CropAndResizeFunction
+
+
+def bench_config(gpu):
+    class BenchConfig(Config):
+        NAME = "bench"
+        GPU_COUNT = int(gpu)
+        IMAGES_PER_GPU = 1
+        NUM_CLASSES = 81
+    return BenchConfig()
+
+
+############################################################
+#  Synthetic inputs
+############################################################
+
+def random_boxes(count, height, width, rng, min_size=8):
+    """Random [count, (y1, x1, y2, x2)] boxes in pixels inside an image."""
+    y1 = rng.uniform(0, height - min_size, count)
+    x1 = rng.uniform(0, width - min_size, count)
+    y2 = np.minimum(y1 + rng.uniform(min_size, height / 4, count), height)
+    x2 = np.minimum(x1 + rng.uniform(min_size, width / 4, count), width)
+    return np.stack([y1, x1, y2, x2], axis=1).astype(np.float32)
+
+
+def tensor(array, config):
+    t = torch.from_numpy(np.ascontiguousarray(array))
+    return t.cuda() if config.GPU_COUNT else t
+
+
+def feature_maps(config, rng, batch=1, depth=256):
+    """Random P2 to P5 feature maps of the padded input images."""
+    return [Variable(tensor(rng.standard_normal(
+        [batch, depth, int(shape[0]), int(shape[1])]).astype(np.float32), config))
+            for shape in config.BACKBONE_SHAPES[:4]]
+
+
+############################################################
+#  Cases
+############################################################
+# Each case function takes (config, rng) and returns (items, setup, run):
+# setup() builds the arguments of a call, untimed, and run(*args) is
+# the timed call.
+
+def nms_case(count):
+    def case(config, rng):
+        h, w = config.IMAGE_SHAPE[:2]
+        boxes = random_boxes(count, h, w, rng)
+        scores = np.sort(rng.uniform(size=count)).astype(np.float32)[::-1]
+        dets = tensor(np.concatenate([boxes, scores[:, None]], axis=1), config)
+        return count, lambda: (dets,), lambda d: nms(d, config.RPN_NMS_THRESHOLD)
+    return case
+
+
+def crop_and_resize_case(size, count, level, backward=False):
+    """ROIAlign of count boxes at size x size on pyramid level P2 to P5."""
+    def case(config, rng):
+        image = feature_maps(config, rng)[level - 2].data
+        h, w = config.IMAGE_SHAPE[:2]
+        boxes = tensor(random_boxes(count, h, w, rng) / np.array([h, w, h, w], dtype=np.float32), config)
+        box_ind = tensor(np.zeros(count, dtype=np.int32), config)
+
+        def forward():
+            return CropAndResizeFunction(size, size, 0)(
+                Variable(image, requires_grad=backward), Variable(boxes), Variable(box_ind))
+
+        if not backward:
+            return count, lambda: (), forward
+
+        def setup():
+            crops = forward()
+            return crops, torch.ones_like(crops.data)
+        return count, setup, lambda crops, grad: crops.backward(grad)
+    return case
+
+
+def proposal_layer_case(config, rng):
+    anchors = modellib.generate_anchors(config, tuple(config.IMAGE_SHAPE[:2]))
+    count = anchors.shape[0]
+    anchors = Variable(tensor(anchors.astype(np.float32), config))
+    fg = rng.uniform(size=[1, count]).astype(np.float32)
+    probs = Variable(tensor(np.stack([1 - fg, fg], axis=2), config))
+    deltas = Variable(tensor(rng.normal(0, 1, [1, count, 4]).astype(np.float32), config))
+
+    def run():
+        return modellib.proposal_layer([probs, deltas],
+                                       proposal_count=config.POST_NMS_ROIS_INFERENCE,
+                                       nms_threshold=config.RPN_NMS_THRESHOLD,
+                                       anchors=anchors, config=config)
+    return count, lambda: (), run
+
+
+def pyramid_roi_align_case(config, rng):
+    count = config.POST_NMS_ROIS_INFERENCE
+    maps = feature_maps(config, rng)
+    h, w = config.IMAGE_SHAPE[:2]
+    boxes = Variable(tensor(random_boxes(count, h, w, rng) / np.array([h, w, h, w], dtype=np.float32), config))
+
+    def run():
+        return modellib.pyramid_roi_align([boxes] + maps, config.POOL_SIZE, config.IMAGE_SHAPE)
+    return count, lambda: (), run
+
+
+def refine_detections_case(config, rng):
+    count = config.POST_NMS_ROIS_INFERENCE
+    h, w = config.IMAGE_SHAPE[:2]
+    rois = Variable(tensor(random_boxes(count, h, w, rng) / np.array([h, w, h, w], dtype=np.float32), config))
+    logits = rng.normal(0, 4, [count, config.NUM_CLASSES])
+    probs = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    probs = Variable(tensor(probs.astype(np.float32), config))
+    deltas = Variable(tensor(rng.normal(0, 1, [count, config.NUM_CLASSES, 4]).astype(np.float32), config))
+    window = np.array([0, 0, h, w])
+
+    def run():
+        return modellib.refine_detections(rois, probs, deltas, window, config)
+    return count, lambda: (), run
+
+
+def detection_target_layer_case(config, rng):
+    count, instances = config.POST_NMS_ROIS_TRAINING, 20
+    h, w = config.IMAGE_SHAPE[:2]
+    scale = np.array([h, w, h, w], dtype=np.float32)
+    gt_boxes = random_boxes(instances, h, w, rng, min_size=32)
+    # Proposals around the GT boxes, so that some of them are positive
+    jitter = rng.normal(0, 8, [count, 4]).astype(np.float32)
+    proposals = (np.clip(gt_boxes[rng.randint(0, instances, count)] + jitter, 0, h) / scale).astype(np.float32)
+    proposals = Variable(tensor(proposals[None], config))
+    gt_class_ids = Variable(tensor(rng.randint(1, config.NUM_CLASSES, [1, instances]).astype(np.int32), config))
+    gt_boxes = Variable(tensor((gt_boxes / scale)[None], config))
+    gt_masks = Variable(tensor(rng.randint(0, 2, [1, instances] + list(config.MINI_MASK_SHAPE))
+                               .astype(np.float32), config))
+
+    def run():
+        return modellib.detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, config)
+    return 1, lambda: (), run
+
+
+def build_rpn_targets_case(config, rng):
+    image_shape = tuple(config.IMAGE_SHAPE)
+    anchors = modellib.generate_anchors(config, image_shape[:2])
+    gt_boxes = random_boxes(20, image_shape[0], image_shape[1], rng, min_size=32).astype(np.int32)
+    gt_class_ids = rng.randint(1, config.NUM_CLASSES, 20).astype(np.int32)
+
+    def run():
+        return modellib.build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config)
+    return anchors.shape[0], lambda: (), run
+
+
+def compute_overlaps_case(config, rng):
+    anchors = modellib.generate_anchors(config, tuple(config.IMAGE_SHAPE[:2]))
+    gt_boxes = random_boxes(20, config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1], rng)
+    return anchors.shape[0], lambda: (), lambda: utils.compute_overlaps(anchors, gt_boxes)
+
+
+def unmold_detections_case(config, rng):
+    count = config.DETECTION_MAX_INSTANCES
+    image_shape = (480, 640, 3)
+    # Window of the image in the padded input, as resize_image() puts it
+    scale = utils.compute_resize_scale(image_shape[0], image_shape[1],
+                                       config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM)
+    h, w = round(image_shape[0] * scale), round(image_shape[1] * scale)
+    y1, x1 = (config.IMAGE_SHAPE[0] - h) // 2, (config.IMAGE_SHAPE[1] - w) // 2
+    y2, x2 = y1 + h, x1 + w
+    window = (y1, x1, y2, x2)
+    boxes = random_boxes(count, y2 - y1, x2 - x1, rng, min_size=16) + np.array([y1, x1, y1, x1])
+    detections = np.concatenate([
+        np.round(boxes), rng.randint(1, config.NUM_CLASSES, [count, 1]),
+        rng.uniform(0.7, 1, [count, 1])], axis=1).astype(np.float32)
+    masks = rng.uniform(size=[count] + config.MASK_SHAPE).astype(np.float32)
+    model = modellib.MaskRCNN(config, model_dir=tempfile.gettempdir())
+
+    def run():
+        return model.unmold_detections(detections, masks, image_shape, np.array(window))
+    return 1, lambda: (), run
+
+
+CASES = [
+    ("nms_1k", nms_case(1000)),
+    ("nms_6k", nms_case(6000)),
+    ("nms_12k", nms_case(12000)),
+    ("crop_and_resize_p2_7x7", crop_and_resize_case(7, 1000, 2)),
+    ("crop_and_resize_p2_7x7_backward", crop_and_resize_case(7, 1000, 2, backward=True)),
+    ("crop_and_resize_p4_14x14", crop_and_resize_case(14, 100, 4)),
+    ("crop_and_resize_p4_14x14_backward", crop_and_resize_case(14, 100, 4, backward=True)),
+    ("proposal_layer", proposal_layer_case),
+    ("pyramid_roi_align", pyramid_roi_align_case),
+    ("refine_detections", refine_detections_case),
+    ("detection_target_layer", detection_target_layer_case),
+    ("build_rpn_targets", build_rpn_targets_case),
+    ("compute_overlaps", compute_overlaps_case),
+    ("unmold_detections", unmold_detections_case),
+]
+
+
+############################################################
+#  Benchmark
+############################################################
+
+def measure(setup, run, config, repeat, warmup):
+    """Times run(*setup()) repeat times after warmup calls. Returns the
+    times in seconds.
+    """
+    times = []
+    for i in range(warmup + repeat):
+        args = setup()
+        if config.GPU_COUNT:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        run(*args)
+        if config.GPU_COUNT:
+            torch.cuda.synchronize()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change of each median from the baseline. Returns the
+    names of the cases that got slower by more than tolerance.
+    """
+    regressions = []
+    print("\n{:36} {:>12} {:>12} {:>8}".format("", "baseline ms", "median ms", "change"))
+    for name, result in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        before = baseline["cases"][name]["median_ms"]
+        change = result["median_ms"] / before - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:36} {:12.3f} {:12.3f} {:+7.1%}{}".format(name, before, result["median_ms"], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the detection hot paths on synthetic inputs.")
+    parser.add_argument('--cases', default=".*",
+                        help="Regular expression of the cases to run")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None,
+                        help="Number of torch threads")
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar="PATH",
+                        help="Write the results to this file")
+    parser.add_argument('--save-baseline', metavar="PATH",
+                        help="Write the results to this file as the baseline")
+    parser.add_argument('--baseline', metavar="PATH",
+                        help="Compare the results to this baseline file")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Slowdown from the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    config = bench_config(args.gpu)
+
+    results = {
+        "meta": {"machine": platform.machine(), "processor": platform.processor(),
+                 "python": platform.python_version(), "torch": torch.__version__,
+                 "threads": torch.get_num_threads(), "gpu": args.gpu,
+                 "repeat": args.repeat},
+        "cases": {},
+        "failures": {},
+    }
+    print("{:36} {:>10} {:>10} {:>14}".format("", "median ms", "p90 ms", "items/s"))
+    for name, case in CASES:
+        if not re.search(args.cases, name):
+            continue
+        rng = np.random.RandomState(args.seed)
+        try:
+            items, setup, run = case(config, rng)
+            times = measure(setup, run, config, args.repeat, args.warmup)
+        except Exception as e:
+            results["failures"][name] = "{}: {}".format(type(e).__name__, e)
+            print("{:36} FAILED {}".format(name, results["failures"][name]))
+            continue
+        median, p90 = np.median(times), np.percentile(times, 90)
+        results["cases"][name] = {"median_ms": median * 1000, "p90_ms": p90 * 1000,
+                                  "items": items, "throughput": items / median}
+        print("{:36} {:10.3f} {:10.3f} {:14.1f}".format(name, median * 1000, p90 * 1000, items / median))
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    failed = bool(results["failures"])
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nSlower than the baseline: {}".format(", ".join(regressions)))
+            failed = True
+    if results["failures"]:
+        print("\nFailed: {}".format(", ".join(results["failures"])))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Mask R-CNN
+Micro-benchmark of the batched mask utilities in utils.py against the
+per-instance loops they replaced.
+
+    python -m bench.mask_utils --instances 20 --repeat 10
+
+The loop versions are the previous implementations. scipy.misc.imresize
+is gone from recent SciPy releases, so _imresize() repeats what it did
+for float masks. Outputs of both versions are compared before timing.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import scipy.ndimage
+from PIL import Image
+
+import utils
+
+
+############################################################
+#  Per-instance reference implementations
+############################################################
+
+def _imresize(m, shape):
+    """scipy.misc.imresize(m, shape, interp='bilinear') of a float array:
+    rescale to 0..255 bytes, then resize with Pillow.
+    """
+    low, high = m.min(), m.max()
+    scale = 255. / ((high - low) or 1)
+    image = Image.fromarray(((m - low) * scale).clip(0, 255).__add__(0.5).astype(np.uint8))
+    return np.array(image.resize((shape[1], shape[0]), Image.BILINEAR))
+
+
+def extract_bboxes_loop(mask):
+    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
+    for i in range(mask.shape[-1]):
+        m = mask[:, :, i]
+        horizontal_indicies = np.where(np.any(m, axis=0))[0]
+        vertical_indicies = np.where(np.any(m, axis=1))[0]
+        if horizontal_indicies.shape[0]:
+            x1, x2 = horizontal_indicies[[0, -1]]
+            y1, y2 = vertical_indicies[[0, -1]]
+            boxes[i] = np.array([y1, x1, y2 + 1, x2 + 1])
+    return boxes
+
+
+def minimize_mask_loop(bbox, mask, mini_shape):
+    mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
+    for i in range(mask.shape[-1]):
+        y1, x1, y2, x2 = bbox[i][:4]
+        m = _imresize(mask[y1:y2, x1:x2, i].astype(float), mini_shape)
+        mini_mask[:, :, i] = np.where(m >= 128, 1, 0)
+    return mini_mask
+
+
+def expand_mask_loop(bbox, mini_mask, image_shape):
+    mask = np.zeros(image_shape[:2] + (mini_mask.shape[-1],), dtype=bool)
+    for i in range(mask.shape[-1]):
+        y1, x1, y2, x2 = bbox[i][:4]
+        m = _imresize(mini_mask[:, :, i].astype(float), (y2 - y1, x2 - x1))
+        mask[y1:y2, x1:x2, i] = np.where(m >= 128, 1, 0)
+    return mask
+
+
+def resize_mask_loop(mask, scale, padding):
+    mask = scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0)
+    return np.pad(mask, padding, mode='constant', constant_values=0)
+
+
+############################################################
+#  Benchmark
+############################################################
+
+def random_masks(height, width, count, rng):
+    """Random elliptical instance masks [height, width, count]. None of
+    them fills its bounding box, which imresize() would have turned into
+    an empty mask.
+    """
+    y, x = np.mgrid[:height, :width]
+    masks = np.zeros([height, width, count], dtype=bool)
+    for i in range(count):
+        cy, cx = rng.uniform(0, height), rng.uniform(0, width)
+        ry, rx = rng.uniform(4, height / 3), rng.uniform(4, width / 3)
+        masks[:, :, i] = ((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2 <= 1
+    return masks[:, :, masks.any(axis=(0, 1))]
+
+
+def timeit(fn, repeat):
+    """Best wall time of fn() over repeat runs, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark batched mask utilities against loops.")
+    parser.add_argument('--height', type=int, default=640)
+    parser.add_argument('--width', type=int, default=480)
+    parser.add_argument('--instances', type=int, default=20)
+    parser.add_argument('--scale', type=float, default=1.6)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    mask = random_masks(args.height, args.width, args.instances, rng)
+    bbox = utils.extract_bboxes(mask)
+    mini_shape = (56, 56)
+    mini_mask = utils.minimize_mask(bbox, mask, mini_shape)
+    image_shape = mask.shape[:2]
+    padding = [(8, 8), (0, 0), (0, 0)]
+
+    cases = [
+        ("extract_bboxes", lambda: extract_bboxes_loop(mask),
+         lambda: utils.extract_bboxes(mask)),
+        ("minimize_mask", lambda: minimize_mask_loop(bbox, mask, mini_shape),
+         lambda: utils.minimize_mask(bbox, mask, mini_shape)),
+        ("expand_mask", lambda: expand_mask_loop(bbox, mini_mask, image_shape),
+         lambda: utils.expand_mask(bbox, mini_mask, image_shape)),
+        ("resize_mask", lambda: resize_mask_loop(mask, args.scale, padding),
+         lambda: utils.resize_mask(mask, args.scale, padding)),
+    ]
+
+    print("{} instances, {}x{} image".format(mask.shape[-1], args.height, args.width))
+    print("{:16} {:>10} {:>10} {:>8}".format("", "loop ms", "batched ms", "speedup"))
+    for name, loop, batched in cases:
+        if not np.array_equal(loop(), batched()):
+            raise AssertionError("{} output differs from the loop version".format(name))
+        loop_ms = timeit(loop, args.repeat)
+        batched_ms = timeit(batched, args.repeat)
+        print("{:16} {:10.2f} {:10.2f} {:7.1f}x".format(
+            name, loop_ms, batched_ms, loop_ms / batched_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+"""
+Mask R-CNN
+Peak memory of each stage of loading a training sample and of
+MaskRCNN.detect().
+
+    python -m bench.memory --image images/1045023827_4ec3e8ba5c_z.jpg
+    python -m bench.memory --check
+
+Stages are the functions that do them, wrapped while the profiler runs:
+the steps of bench.data_pipeline and compute_overlaps() for a training
+sample, once with the random masks of bench.data_pipeline and once with
+the same masks as COCO polygons and a crowd RLE, which load through
+CocoDataset.load_mask_crops() and annToCrop() (needs pycocotools), and
+mold_inputs(), predict(), proposal_layer(),
+pyramid_roi_align(), refine_detections() and unmold_detections() of
+detect(). For each stage it reports the maximum over its calls of:
+
+    rss MB      High-water mark of the resident set size of the process
+                during the stage (Linux; elsewhere the peak so far)
+    +rss MB     Increase of that mark over the resident set size at the
+                start of the stage. Memory the allocator had freed before
+                is reused without growing it.
+    +traced MB  Peak of the memory allocated by numpy and python during
+                the stage (tracemalloc), over that at its start. Torch CPU
+                tensors aren't traced.
+    +cuda MB    With --gpu, the same for torch's GPU memory
+    largest     The largest ndarray or tensor among the arguments and the
+                return value of the stage
+
+Stages count in the stages they run in: compute_overlaps() in
+build_rpn_targets(), pyramid_roi_align() in predict(), ...
+
+Without --weights the model has random weights, tamed so that detect()
+returns DETECTION_MAX_INSTANCES detections, the most memory it can take.
+
+--check profiles the reference image with the reference configuration
+and exits with status 1 if a stage's largest array or +traced MB, or the
+peak resident set size of the process, exceeds its bound in BOUNDS.
+Bounds have room for noise and small changes, but not for a stage
+keeping full resolution or all-class masks it didn't before.
+tests/test_memory.py runs the same check.
+"""
+
+import argparse
+import functools
+import json
+import os
+import resource
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+import torch
+
+import utils
+import model as modellib
+from config import Config
+from bench.data_pipeline import STEPS, ImageFolderDataset
+
+
+REFERENCE_IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               "images", "1045023827_4ec3e8ba5c_z.jpg")
+
+# Upper bounds of --check in MB: stage: (largest array, +traced)
+BOUNDS = {
+    "sample": {
+        "__getitem__": (6, 64),
+        "load_mask": (4, 12),
+        "resize_mask": (8, 32),
+        "load_mask_crops": (1, 40),
+        "compute_overlaps": (16, 40),
+        "build_rpn_targets": (8, 48),
+        "pack_masks": (1, 1),
+    },
+    "coco_sample": {
+        "__getitem__": (6, 64),
+        "annToCrop": (1, 1),
+        "load_mask_crops": (1, 2),
+        "compute_overlaps": (16, 40),
+        "build_rpn_targets": (8, 48),
+        "pack_masks": (1, 1),
+    },
+    "detect": {
+        "mold_inputs": (4, 12),
+        "predict": (4, 8),
+        "unmold_detections": (40, 80),
+        "detect": (40, 96),
+    },
+}
+
+# Upper bound of --check on the peak resident set size of the process, MB
+PEAK_RSS_BOUND = 2560
+
+class ReferenceConfig(Config):
+    """COCO setup on CPU, keeping every detection so that detect() returns
+    as many masks as it can.
+    """
+    NAME = "reference"
+    GPU_COUNT = 0
+    IMAGES_PER_GPU = 1
+    NUM_CLASSES = 1 + 80
+    DETECTION_MIN_CONFIDENCE = 0
+    DATA_LOADER_WORKERS = 0
+
+
+############################################################
+#  Memory Measurements
+############################################################
+
+def rss():
+    """Returns the resident set size of the process and its high-water
+    mark in bytes.
+    """
+    if sys.platform.startswith("linux"):
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f)
+        return int(status["VmRSS"].split()[0]) * 1024, int(status["VmHWM"].split()[0]) * 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak if sys.platform == "darwin" else peak * 1024
+    return peak, peak
+
+
+def reset_rss_peak():
+    """Resets the high-water mark of rss() to the current size where the
+    kernel allows it (Linux 4.0+).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def arrays(x):
+    """Yields the ndarrays and tensors in x, which can be one of them or a
+    nested list, tuple or dict of them.
+    """
+    if isinstance(x, np.ndarray) or torch.is_tensor(x):
+        yield x
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            yield from arrays(v)
+    elif isinstance(x, dict):
+        for v in x.values():
+            yield from arrays(v)
+
+
+def array_bytes(a):
+    return a.nbytes if isinstance(a, np.ndarray) else a.numel() * a.element_size()
+
+
+def describe(a):
+    kind = "ndarray" if isinstance(a, np.ndarray) else "tensor"
+    dtype = str(a.dtype).replace("torch.", "")
+    return "{} {} {}".format(kind, dtype, list(a.shape))
+
+
+class MemoryProfiler(object):
+    """Records the peak memory of named stages, see the module docstring.
+
+        profiler = MemoryProfiler()
+        utils.resize_mask = profiler.wrap("resize_mask", utils.resize_mask)
+        with profiler:
+            ...
+        profiler.stages  # {"resize_mask": {"rss_mb": ..., ...}}
+        profiler.peak_rss  # Of the whole process over all stages, bytes
+
+    The high-water marks are reset at the start and end of each stage, and
+    the stages it runs in keep the peaks they had so far.
+    """
+
+    def __init__(self, cuda=False):
+        self.cuda = cuda
+        self.stages = {}
+        self.stack = []
+        self.peak_rss = 0
+
+    def __enter__(self):
+        tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        tracemalloc.stop()
+
+    def wrap(self, name, function):
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            self.begin()
+            output = function(*args, **kwargs)
+            self.end(name, (args, kwargs), output)
+            return output
+        return profiled
+
+    def peaks(self):
+        """Returns the peaks since the last reset and resets them."""
+        _, rss_peak = rss()
+        _, traced_peak = tracemalloc.get_traced_memory()
+        cuda_peak = torch.cuda.max_memory_allocated() if self.cuda else 0
+        reset_rss_peak()
+        tracemalloc.reset_peak()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        peaks = (rss_peak, traced_peak, cuda_peak)
+        self.peak_rss = max(self.peak_rss, rss_peak)
+        for frame in self.stack:
+            frame["peaks"] = [max(a, b) for a, b in zip(frame["peaks"], peaks)]
+        return peaks
+
+    def begin(self):
+        self.peaks()
+        rss_start, _ = rss()
+        traced_start, _ = tracemalloc.get_traced_memory()
+        cuda_start = torch.cuda.memory_allocated() if self.cuda else 0
+        self.stack.append({"start": (rss_start, traced_start, cuda_start),
+                           "peaks": [rss_start, traced_start, cuda_start]})
+
+    def end(self, name, inputs, outputs):
+        self.peaks()
+        frame = self.stack.pop()
+        (rss_peak, traced_peak, cuda_peak), start = frame["peaks"], frame["start"]
+        largest = max(arrays([inputs, outputs]), key=array_bytes, default=None)
+        record = {
+            "rss_mb": rss_peak / 2 ** 20,
+            "rss_increase_mb": (rss_peak - start[0]) / 2 ** 20,
+            "traced_mb": (traced_peak - start[1]) / 2 ** 20,
+            "cuda_mb": (cuda_peak - start[2]) / 2 ** 20,
+            "largest_mb": array_bytes(largest) / 2 ** 20 if largest is not None else 0,
+            "largest": describe(largest) if largest is not None else "",
+        }
+        stage = self.stages.setdefault(name, dict(record, calls=0))
+        stage["calls"] += 1
+        for key, value in record.items():
+            if key == "largest":
+                continue
+            if key == "largest_mb" and value > stage[key]:
+                stage["largest"] = record["largest"]
+            stage[key] = max(stage[key], value)
+
+
+############################################################
+#  Profiles
+############################################################
+
+def folder_dataset(path, instances):
+    """The images of the directory of path with random masks, as in
+    bench.data_pipeline. Returns the dataset and the index of path.
+    """
+    dataset = ImageFolderDataset()
+    dataset.load_images(os.path.dirname(path), instances)
+    dataset.prepare()
+    return dataset, [info["path"] for info in dataset.image_info].index(path)
+
+
+def coco_dataset(path, instances):
+    """The image at path alone in a coco.CocoDataset, with the random masks
+    of folder_dataset() as COCO annotations: polygons, and the last one a
+    crowd RLE. Its masks load with CocoDataset.load_mask_crops(). Needs
+    pycocotools. Returns the dataset and the index of path.
+    """
+    import skimage.measure
+    from pycocotools import mask as maskUtils
+    import coco
+
+    folder, index = folder_dataset(path, instances)
+    info = folder.image_info[index]
+    masks, _ = folder.load_mask(index)
+    annotations = []
+    for i in range(masks.shape[2]):
+        if i == masks.shape[2] - 1:
+            segmentation = maskUtils.encode(np.asfortranarray(masks[:, :, i].astype(np.uint8)))
+            segmentation["counts"] = segmentation["counts"].decode("ascii")
+        else:
+            # Padded so that masks on the image border get closed contours
+            contours = skimage.measure.find_contours(np.pad(masks[:, :, i], 1).astype(np.uint8), 0.5)
+            segmentation = [(np.fliplr(c) - 1).ravel().tolist() for c in contours]
+        annotations.append({"id": i + 1, "image_id": 1, "category_id": 1,
+                            "iscrowd": int(i == masks.shape[2] - 1),
+                            "segmentation": segmentation})
+
+    dataset = coco.CocoDataset()
+    dataset.add_class("coco", 1, "object")
+    dataset.add_image("coco", 1, path, width=info["width"], height=info["height"],
+                      annotations=annotations)
+    dataset.prepare()
+    return dataset, 0
+
+
+def profile_sample(dataset, index, config, cuda=False):
+    """Profiles loading the training sample of the image at index of
+    dataset.
+    """
+    data = modellib.Dataset(dataset, config, augment=False)
+
+    profiler = MemoryProfiler(cuda)
+    originals = []
+    steps = STEPS + [("compute_overlaps", utils, 1)]
+    if hasattr(dataset, "annToCrop"):
+        steps.append(("annToCrop", None, 2))
+    for name, module, _ in steps:
+        owner = dataset if module is None else module
+        originals.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, profiler.wrap(name, getattr(owner, name)))
+    try:
+        with profiler:
+            profiler.wrap("__getitem__", data.__getitem__)(index)
+    finally:
+        for owner, name, function in originals:
+            setattr(owner, name, function)
+    return profiler
+
+
+def profile_detect(path, config, weights=None, cuda=False):
+    """Profiles detect() on the image at path."""
+    torch.manual_seed(0)
+    model = modellib.MaskRCNN(config, model_dir=tempfile.mkdtemp())
+    if cuda:
+        model = model.cuda()
+    if weights:
+        model.load_weights(weights)
+    else:
+        # Keep the activations of random weights finite, and have the
+        # classifier pick a class other than background so that detect()
+        # returns masks
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.weight.data.fill_(0.3)
+        model.classifier.linear_class.bias.data[0] = -10
+
+    profiler = MemoryProfiler(cuda)
+    for name in ["detect", "mold_inputs", "predict", "unmold_detections"]:
+        setattr(model, name, profiler.wrap(name, getattr(model, name)))
+    functions = {name: getattr(modellib, name) for name in
+                 ["proposal_layer", "pyramid_roi_align", "refine_detections"]}
+    for name, function in functions.items():
+        setattr(modellib, name, profiler.wrap(name, function))
+    try:
+        with profiler, torch.no_grad():
+            model.detect([path])
+    finally:
+        for name, function in functions.items():
+            setattr(modellib, name, function)
+    return profiler
+
+
+def profile(path, config, instances, weights=None, cuda=False):
+    """Runs every profile on the image at path. Returns the stages of each
+    profile, as check() takes them, and the peak resident set size in MB.
+    """
+    profilers = {
+        "sample": profile_sample(*folder_dataset(path, instances), config, cuda),
+        "coco_sample": profile_sample(*coco_dataset(path, instances), config, cuda),
+        "detect": profile_detect(path, config, weights, cuda),
+    }
+    results = {name: profiler.stages for name, profiler in profilers.items()}
+    return results, max(p.peak_rss for p in profilers.values()) / 2 ** 20
+
+
+def print_stages(title, stages, cuda):
+    print("\n{:22} {:>6} {:>9} {:>9} {:>10}{} {:>9}  {}".format(
+        title, "calls", "rss MB", "+rss MB", "+traced MB", " {:>8}".format("+cuda MB") if cuda else "",
+        "largest", ""))
+    for name, stage in stages.items():
+        print("{:22} {:6} {:9.1f} {:9.1f} {:10.1f}{} {:6.1f} MB  {}".format(
+            name, stage["calls"], stage["rss_mb"], stage["rss_increase_mb"], stage["traced_mb"],
+            " {:8.1f}".format(stage["cuda_mb"]) if cuda else "", stage["largest_mb"], stage["largest"]))
+
+
+def check(results, peak_rss_mb):
+    """Returns the failures of the results against BOUNDS."""
+    failures = []
+    for profile, bounds in BOUNDS.items():
+        for name, (largest_bound, traced_bound) in bounds.items():
+            stage = results[profile].get(name)
+            if stage is None:
+                failures.append("{} {}: not called".format(profile, name))
+                continue
+            if stage["largest_mb"] > largest_bound:
+                failures.append("{} {}: largest array {:.1f} MB > {} MB ({})".format(
+                    profile, name, stage["largest_mb"], largest_bound, stage["largest"]))
+            if stage["traced_mb"] > traced_bound:
+                failures.append("{} {}: +traced {:.1f} MB > {} MB".format(
+                    profile, name, stage["traced_mb"], traced_bound))
+    if peak_rss_mb > PEAK_RSS_BOUND:
+        failures.append("peak rss {:.0f} MB > {} MB".format(peak_rss_mb, PEAK_RSS_BOUND))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Profile the peak memory of each stage of training samples and detect().")
+    parser.add_argument('--image', default=REFERENCE_IMAGE)
+    parser.add_argument('--instances', type=int, default=8,
+                        help="Random masks of the training sample")
+    parser.add_argument('--size', type=int, default=1024,
+                        help="IMAGE_MAX_DIM")
+    parser.add_argument('--weights', metavar="PATH",
+                        help="Weights file, random weights if not given")
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--check', action='store_true',
+                        help="Profile the reference image and check BOUNDS")
+    parser.add_argument('--json', metavar="PATH",
+                        help="Write the results to this file")
+    args = parser.parse_args()
+    if args.check:
+        args.image, args.instances, args.size, args.weights, args.gpu = REFERENCE_IMAGE, 8, 1024, None, False
+
+    class ProfileConfig(ReferenceConfig):
+        GPU_COUNT = int(args.gpu)
+        IMAGE_MIN_DIM = min(800, args.size)
+        IMAGE_MAX_DIM = args.size
+    config = ProfileConfig()
+    path = os.path.abspath(args.image)
+
+    results, peak_rss_mb = profile(path, config, args.instances, args.weights, args.gpu)
+    for name, stages in results.items():
+        print_stages(name, stages, args.gpu)
+    print("\npeak rss {:.0f} MB".format(peak_rss_mb))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(results, peak_rss_mb=peak_rss_mb), f, indent=2)
+
+    if args.check:
+        failures = check(results, peak_rss_mb)
+        for failure in failures:
+            print("FAIL", failure)
+        if failures:
+            sys.exit(1)
+        print("All stages within bounds.")
+
+
+if __name__ == '__main__':
+    main()
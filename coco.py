@@ -27,8 +27,11 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
     python3 coco.py evaluate --dataset=/path/to/coco/ --model=last
 """
 
+import copy
 import os
 import time
+import hashlib
+import json
 import numpy as np
 
 # Download and install the Python COCO tools from https://github.com/waleedka/coco
@@ -62,6 +65,13 @@ COCO_MODEL_PATH = os.path.join(ROOT_DIR, "mask_rcnn_coco.pth")
 DEFAULT_LOGS_DIR = os.path.join(ROOT_DIR, "logs")
 DEFAULT_DATASET_YEAR = "2014"
 
+# Directory to cache parsed COCO indexes in, if not provided
+# through the command line argument --cache
+DEFAULT_CACHE_DIR = os.path.join(ROOT_DIR, "cache")
+
+# Bump when the layout of cached indexes changes
+COCO_INDEX_CACHE_VERSION = 2
+
 ############################################################
 #  Configurations
 ############################################################
@@ -91,7 +101,8 @@ class CocoConfig(Config):
 
 class CocoDataset(utils.Dataset):
     def load_coco(self, dataset_dir, subset, year=DEFAULT_DATASET_YEAR, class_ids=None,
-                  class_map=None, return_coco=False, auto_download=False):
+                  class_map=None, return_coco=False, auto_download=False,
+                  cache_dir=None, precompute_rle=False):
         """Load a subset of the COCO dataset.
         dataset_dir: The root directory of the COCO dataset.
         subset: What to load (train, val, minival, valminusminival)
@@ -101,16 +112,37 @@ class CocoDataset(utils.Dataset):
             different datasets to the same class ID.
         return_coco: If True, returns the COCO object.
         auto_download: Automatically download and unzip MS-COCO images and annotations
+        cache_dir: If provided, the loaded index is saved in this directory
+            and later calls with the same annotation file (by path, size and
+            modification time), subset and class_ids load it from there,
+            memory-mapped, instead of parsing the JSON file. With
+            return_coco, the COCO object is then rebuilt from the cached
+            index too.
+        precompute_rle: If True, polygons are converted to compressed RLEs
+            when the cache is built. Masks then decode faster, but always at
+            full resolution. Only used with cache_dir.
         """
 
         if auto_download is True:
             self.auto_download(dataset_dir, subset, year)
 
-        coco = COCO("{}/annotations/instances_{}{}.json".format(dataset_dir, subset, year))
+        annotation_path = "{}/annotations/instances_{}{}.json".format(dataset_dir, subset, year)
         if subset == "minival" or subset == "valminusminival":
             subset = "val"
         image_dir = "{}/{}{}".format(dataset_dir, subset, year)
 
+        cache_path = None
+        if cache_dir:
+            cache_path = os.path.join(cache_dir, self.index_cache_key(
+                annotation_path, image_dir, class_ids, precompute_rle))
+            if os.path.exists(cache_path):
+                chunk, classes = self.load_index_cache(cache_path)
+                if return_coco:
+                    return self.coco_from_index(chunk, classes)
+                return
+
+        coco = COCO(annotation_path)
+
         # Load all classes or a subset?
         if not class_ids:
             # All classes
@@ -132,17 +164,96 @@ class CocoDataset(utils.Dataset):
             self.add_class("coco", i, coco.loadCats(i)[0]["name"])
 
         # Add images
+        image_infos = []
         for i in image_ids:
-            self.add_image(
-                "coco", image_id=i,
-                path=os.path.join(image_dir, coco.imgs[i]['file_name']),
-                width=coco.imgs[i]["width"],
-                height=coco.imgs[i]["height"],
-                annotations=coco.loadAnns(coco.getAnnIds(
-                    imgIds=[i], catIds=class_ids, iscrowd=None)))
+            annotations = coco.loadAnns(coco.getAnnIds(
+                imgIds=[i], catIds=class_ids, iscrowd=None))
+            if cache_path and precompute_rle:
+                annotations = [dict(a, segmentation=self.annToRLE(
+                    a, coco.imgs[i]["height"], coco.imgs[i]["width"]))
+                    for a in annotations]
+            image_infos.append({
+                "id": i,
+                "source": "coco",
+                "path": os.path.join(image_dir, coco.imgs[i]['file_name']),
+                "width": coco.imgs[i]["width"],
+                "height": coco.imgs[i]["height"],
+                "annotations": annotations,
+            })
+        # Pack into columnar form now so the per-image dicts can be freed
+        chunk = utils.ImageInfoChunk.from_dicts(image_infos)
+        del image_infos
+        self.image_info.add_chunk(chunk)
+
+        if cache_path:
+            self.save_index_cache(cache_path, chunk,
+                                  [(i, coco.loadCats(i)[0]["name"]) for i in class_ids])
         if return_coco:
             return coco
 
+    def index_cache_key(self, annotation_path, image_dir, class_ids, precompute_rle):
+        """Returns the cache directory name of a COCO index. Changes whenever
+        the annotation file is replaced or modified (its path, size or
+        modification time change) or any option that changes what
+        load_coco() adds to the dataset changes.
+        """
+        stat = os.stat(annotation_path)
+        options = json.dumps([COCO_INDEX_CACHE_VERSION, os.path.abspath(annotation_path),
+                              stat.st_size, stat.st_mtime_ns, os.path.abspath(image_dir),
+                              sorted(class_ids) if class_ids else None,
+                              bool(precompute_rle)])
+        sha1 = hashlib.sha1(options.encode("utf-8"))
+        return "{}_{}".format(os.path.splitext(os.path.basename(annotation_path))[0],
+                              sha1.hexdigest()[:16])
+
+    def save_index_cache(self, cache_path, chunk, classes):
+        """Writes the image index chunk and the (class id, name) pairs
+        that load_coco() added to the cache directory cache_path. The
+        directory is renamed into place once complete.
+        """
+        tmp_path = "{}.tmp{}".format(cache_path, os.getpid())
+        os.makedirs(tmp_path)
+        chunk.save(os.path.join(tmp_path, "images"))
+        with open(os.path.join(tmp_path, "classes.json"), "w") as f:
+            json.dump(classes, f)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            # Another process cached the same index first. Keep theirs.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def load_index_cache(self, cache_path):
+        """Adds the classes and images of a cached COCO index. Returns the
+        image chunk and the (class id, name) pairs.
+        """
+        with open(os.path.join(cache_path, "classes.json")) as f:
+            classes = json.load(f)
+        for class_id, name in classes:
+            self.add_class("coco", class_id, name)
+        chunk = utils.ImageInfoChunk.load(os.path.join(cache_path, "images"), mmap=True)
+        self.image_info.add_chunk(chunk)
+        return chunk, classes
+
+    @staticmethod
+    def coco_from_index(chunk, classes):
+        """Rebuilds the COCO object of a cached index, with its images,
+        their annotations and the classes, for loadRes() and COCOeval
+        without parsing the annotation file.
+        """
+        images = []
+        annotations = []
+        for i in range(len(chunk)):
+            images.append({"id": chunk.get(i, "id"),
+                           "width": chunk.get(i, "width"),
+                           "height": chunk.get(i, "height"),
+                           "file_name": os.path.basename(chunk.get(i, "path"))})
+            annotations.extend(chunk.annotations(i))
+        coco = COCO()
+        coco.dataset = {"images": images, "annotations": annotations,
+                        "categories": [{"id": i, "name": name} for i, name in classes]}
+        coco.createIndex()
+        return coco
+
     def auto_download(self, dataDir, dataType, dataYear):
         """Download the COCO dataset/annotations if requested.
         dataDir: The root directory of the COCO dataset.
@@ -234,7 +345,7 @@ class CocoDataset(utils.Dataset):
 
         instance_masks = []
         class_ids = []
-        annotations = self.image_info[image_id]["annotations"]
+        annotations = image_info["annotations"]
         # Build mask of shape [height, width, instance_count] and list
         # of class IDs that correspond to each channel of the mask.
         for annotation in annotations:
@@ -267,6 +378,51 @@ class CocoDataset(utils.Dataset):
             # Call super class to return an empty mask
             return super(CocoDataset, self).load_mask(image_id)
 
+    def load_mask_crops(self, image_id, scale, padding):
+        """Load instance masks rasterized directly at the resized and padded
+        image resolution, one tight crop per instance. Polygons are scaled
+        and rasterized into their bounding box only. RLEs are decoded one
+        at a time and resampled inside their bounding box. This avoids
+        building the full resolution [height, width, instances] stack.
+
+        See utils.Dataset.load_mask_crops() for the return values.
+        """
+        # If not a COCO image, delegate to parent class.
+        image_info = self.image_info[image_id]
+        if image_info["source"] != "coco":
+            return super(CocoDataset, self).load_mask_crops(image_id, scale, padding)
+
+        height, width = image_info["height"], image_info["width"]
+        # Same output size and offset that resize_image() gives the image
+        frame = (round(height * scale), round(width * scale))
+        offset = (padding[0][0], padding[1][0]) if padding else (0, 0)
+
+        boxes = []
+        crops = []
+        class_ids = []
+        annotations = image_info["annotations"]
+        for annotation in annotations:
+            class_id = self.map_source_class_id(
+                "coco.{}".format(annotation['category_id']))
+            if class_id:
+                box, crop = self.annToCrop(annotation, height, width, frame)
+                # Some objects are so small that they're less than 1 pixel area
+                # and end up rounded out. Skip those objects.
+                if box is None:
+                    continue
+                # Is it a crowd? If so, use a negative class ID.
+                if annotation['iscrowd']:
+                    class_id *= -1
+                boxes.append([box[0] + offset[0], box[1] + offset[1],
+                              box[2] + offset[0], box[3] + offset[1]])
+                crops.append(crop)
+                class_ids.append(class_id)
+
+        if class_ids:
+            return np.array(boxes, dtype=np.int32), crops, np.array(class_ids, dtype=np.int32)
+        else:
+            return np.zeros([0, 4], dtype=np.int32), [], np.empty([0], np.int32)
+
     def image_reference(self, image_id):
         """Return a link to the image in the COCO Website."""
         info = self.image_info[image_id]
@@ -305,6 +461,57 @@ class CocoDataset(utils.Dataset):
         m = maskUtils.decode(rle)
         return m
 
+    def annToCrop(self, ann, height, width, frame):
+        """
+        Rasterize an annotation at the resolution of frame, a (height, width)
+        resize of the original image, limited to the annotation's extent.
+        :return: tight (y1, x1, y2, x2) box in frame coordinates and the
+                 binary mask inside it, or (None, None) if the mask is empty.
+        """
+        scale_y = frame[0] / height
+        scale_x = frame[1] / width
+        segm = ann['segmentation']
+        if isinstance(segm, list):
+            # polygon -- scale the vertices and rasterize only the
+            # bounding box of all parts
+            polys = [np.array(p, dtype=np.float64).reshape([-1, 2]) * [scale_x, scale_y]
+                     for p in segm if len(p) >= 6]
+            if not polys:
+                return None, None
+            points = np.concatenate(polys, axis=0)
+            x1 = int(np.clip(np.floor(points[:, 0].min()), 0, frame[1]))
+            y1 = int(np.clip(np.floor(points[:, 1].min()), 0, frame[0]))
+            x2 = int(np.clip(np.ceil(points[:, 0].max()) + 1, 0, frame[1]))
+            y2 = int(np.clip(np.ceil(points[:, 1].max()) + 1, 0, frame[0]))
+            if x2 <= x1 or y2 <= y1:
+                return None, None
+            polys = [(p - [x1, y1]).ravel().tolist() for p in polys]
+            rle = maskUtils.merge(maskUtils.frPyObjects(polys, y2 - y1, x2 - x1))
+            crop = maskUtils.decode(rle)
+            return utils.tighten_mask_crop(y1, x1, crop)
+
+        # RLE -- decode one full resolution mask and resample its
+        # bounding box with nearest neighbor interpolation.
+        m = self.annToMask(ann, height, width)
+        # For crowd masks, annToMask() sometimes returns a mask
+        # smaller than the given dimensions. If so, use the whole image.
+        if m.shape[0] != height or m.shape[1] != width:
+            m = np.ones([height, width], dtype=np.uint8)
+        box, m = utils.tighten_mask_crop(0, 0, m)
+        if box is None:
+            return None, None
+        y1 = int(np.floor(box[0] * scale_y))
+        x1 = int(np.floor(box[1] * scale_x))
+        y2 = min(int(np.ceil(box[2] * scale_y)), frame[0])
+        x2 = min(int(np.ceil(box[3] * scale_x)), frame[1])
+        # Source pixel under the center of each target pixel
+        rows = np.floor((np.arange(y1, y2) + 0.5) / scale_y).astype(np.int64) - box[0]
+        cols = np.floor((np.arange(x1, x2) + 0.5) / scale_x).astype(np.int64) - box[1]
+        rows = np.clip(rows, 0, m.shape[0] - 1)
+        cols = np.clip(cols, 0, m.shape[1] - 1)
+        crop = m[rows[:, np.newaxis], cols[np.newaxis, :]]
+        return utils.tighten_mask_crop(y1, x1, crop)
+
 
 ############################################################
 #  COCO Evaluation
@@ -415,6 +622,25 @@ if __name__ == '__main__':
                         default=DEFAULT_LOGS_DIR,
                         metavar="/path/to/logs/",
                         help='Logs and checkpoints directory (default=logs/)')
+    parser.add_argument('--cache', required=False,
+                        default=DEFAULT_CACHE_DIR,
+                        metavar="/path/to/cache/",
+                        help='Directory to cache parsed COCO annotations in (default=cache/)')
+    parser.add_argument('--features', required=False,
+                        default=None,
+                        metavar="/path/to/features/",
+                        help='Directory to cache backbone features in for training '
+                             'the heads on a subset of the images, see --features-images '
+                             '(default=run the backbone every step on all images)')
+    parser.add_argument('--features-images', required=False,
+                        default=0, type=int,
+                        metavar="<image count>",
+                        help='Training images to cache features of, and to train the heads '
+                             'on, with --features. The cache takes about 125MB per image.')
+    parser.add_argument('--precision', required=False,
+                        default=None,
+                        choices=["fp32", "bf16"],
+                        help='Overrides the PRECISION of the config (default=fp32)')
     parser.add_argument('--limit', required=False,
                         default=500,
                         metavar="<image count>",
@@ -425,16 +651,24 @@ if __name__ == '__main__':
                         help='Automatically download and unzip MS-COCO files (default=False)',
                         type=bool)
     args = parser.parse_args()
+    if args.features and args.features_images <= 0:
+        parser.error("--features needs --features-images")
     print("Command: ", args.command)
     print("Model: ", args.model)
     print("Dataset: ", args.dataset)
     print("Year: ", args.year)
     print("Logs: ", args.logs)
+    print("Cache: ", args.cache)
+    print("Features: ", args.features, args.features_images)
+    print("Precision: ", args.precision)
     print("Auto Download: ", args.download)
 
     # Configurations
     if args.command == "train":
         config = CocoConfig()
+        # Processes launched together with torchrun train together
+        if int(os.environ.get("WORLD_SIZE", 1)) > 1 and not config.DISTRIBUTED_BACKEND:
+            config.DISTRIBUTED_BACKEND = "nccl" if config.GPU_COUNT else "gloo"
     else:
         class InferenceConfig(CocoConfig):
             # Set batch size to 1 since we'll be running inference on
@@ -443,6 +677,8 @@ if __name__ == '__main__':
             IMAGES_PER_GPU = 1
             DETECTION_MIN_CONFIDENCE = 0
         config = InferenceConfig()
+    if args.precision:
+        config.PRECISION = args.precision
     config.display()
 
     # Create model
@@ -479,23 +715,41 @@ if __name__ == '__main__':
         # Training dataset. Use the training set and 35K from the
         # validation set, as as in the Mask RCNN paper.
         dataset_train = CocoDataset()
-        dataset_train.load_coco(args.dataset, "train", year=args.year, auto_download=args.download)
-        dataset_train.load_coco(args.dataset, "valminusminival", year=args.year, auto_download=args.download)
+        dataset_train.load_coco(args.dataset, "train", year=args.year, auto_download=args.download,
+                                cache_dir=args.cache)
+        dataset_train.load_coco(args.dataset, "valminusminival", year=args.year, auto_download=args.download,
+                                cache_dir=args.cache)
         dataset_train.prepare()
 
         # Validation dataset
         dataset_val = CocoDataset()
-        dataset_val.load_coco(args.dataset, "minival", year=args.year, auto_download=args.download)
+        dataset_val.load_coco(args.dataset, "minival", year=args.year, auto_download=args.download,
+                              cache_dir=args.cache)
         dataset_val.prepare()
 
         # *** This training schedule is an example. Update to your needs ***
 
         # Training - Stage 1
+        # The backbone is frozen, so its outputs can be computed once. The
+        # cache is too big for all of COCO, so the heads are then trained
+        # on the first --features-images images only.
+        dataset_heads, dataset_heads_val = dataset_train, dataset_val
+        train_features = val_features = None
+        if args.features:
+            print("Caching backbone features")
+            dataset_heads = copy.copy(dataset_train)
+            dataset_heads.select_images(dataset_train.image_ids[:args.features_images])
+            dataset_heads_val = copy.copy(dataset_val)
+            dataset_heads_val.select_images(dataset_val.image_ids[:args.features_images])
+            train_features = model.build_feature_cache(dataset_heads, os.path.join(args.features, "train"))
+            val_features = model.build_feature_cache(dataset_heads_val, os.path.join(args.features, "minival"))
         print("Training network heads")
-        model.train_model(dataset_train, dataset_val,
+        model.train_model(dataset_heads, dataset_heads_val,
                     learning_rate=config.LEARNING_RATE,
                     epochs=40,
-                    layers='heads')
+                    layers='heads',
+                    train_features=train_features,
+                    val_features=val_features)
 
         # Training - Stage 2
         # Finetune layers from ResNet stage 4 and up
@@ -516,7 +770,8 @@ if __name__ == '__main__':
     elif args.command == "evaluate":
         # Validation dataset
         dataset_val = CocoDataset()
-        coco = dataset_val.load_coco(args.dataset, "minival", year=args.year, return_coco=True, auto_download=args.download)
+        coco = dataset_val.load_coco(args.dataset, "minival", year=args.year, return_coco=True, auto_download=args.download,
+                                     cache_dir=args.cache)
         dataset_val.prepare()
         print("Running COCO evaluation on {} images.".format(args.limit))
         evaluate_coco(model, dataset_val, coco, "bbox", limit=int(args.limit))
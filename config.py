@@ -38,7 +38,17 @@ class Config(object):
     # number that your GPU can handle for best performance.
     IMAGES_PER_GPU = 1
 
-    # Number of training steps per epoch
+    # Process group backend of multi-process training, "nccl" for GPUs or
+    # "gloo" for CPU. With a backend set, launching with torchrun
+    # (torchrun --nproc_per_node=N coco.py train ...) starts N processes
+    # that each train on BATCH_SIZE images of their own share of the
+    # dataset and average their gradients. Each process uses one GPU, so
+    # set GPU_COUNT to 1, or to 0 to train on CPU. None runs every process
+    # on its own, e.g. for inference. coco.py sets it for training.
+    DISTRIBUTED_BACKEND = None
+
+    # Number of training steps per epoch. Each step trains on one batch of
+    # BATCH_SIZE images.
     # This doesn't need to match the size of the training set. Tensorboard
     # updates are saved at the end of each epoch, so setting this to a
     # smaller number means getting more frequent TensorBoard updates.
@@ -52,6 +62,50 @@ class Config(object):
     # down the training.
     VALIDATION_STEPS = 50
 
+    # Number of training steps between copies of the losses to the host.
+    # Each prints their means over the interval and appends them, with the
+    # mean step and data loading times, to metrics.jsonl in the log
+    # directory.
+    LOG_INTERVAL = 20
+
+    # Also time each stage of the training steps for metrics.jsonl: data
+    # loading and copying, the fpn, rpn, proposal_layer, rpn_targets,
+    # detection_target_layer, classifier and mask stages of the forward
+    # pass, the losses, backward and the optimizer step. Waits for the GPU
+    # between stages, which slows training down a little.
+    STEP_PROFILING = False
+
+    # Every this many training steps, and at the end of every epoch, also
+    # save a checkpoint to resume training from. It holds the optimizer,
+    # random number generator and data loader state, so that an
+    # interrupted epoch continues where it stopped. 0 disables it.
+    CHECKPOINT_INTERVAL = 0
+
+    # Save checkpoints with only the trainable parameters and the buffers.
+    # The frozen parameters are saved once to a base file in the log
+    # directory, which the checkpoints refer to by digest. Makes checkpoints
+    # several times smaller when training the heads or 4+. load_weights()
+    # puts the full weights back together.
+    DELTA_CHECKPOINTS = False
+
+    # Number of worker processes that load and preprocess training samples.
+    # Use 0 to load them in the training process.
+    DATA_LOADER_WORKERS = 4
+
+    # Number of batches each worker loads in advance
+    DATA_LOADER_PREFETCH_FACTOR = 2
+
+    # Keep worker processes alive between epochs instead of restarting them
+    DATA_LOADER_PERSISTENT_WORKERS = False
+
+    # Copy batches to page-locked memory. Speeds up host to GPU copies.
+    DATA_LOADER_PIN_MEMORY = False
+
+    # Seed of the order in which training images are visited. None draws
+    # one from numpy's random state in every train_model() call, so that
+    # runs see different orders unless numpy is seeded.
+    SHUFFLE_SEED = None
+
     # The strides of each layer of the FPN Pyramid. These values
     # are based on a Resnet101 backbone.
     BACKBONE_STRIDES = [4, 8, 16, 32, 64]
@@ -78,6 +132,11 @@ class Config(object):
     # How many anchors per image to use for RPN training
     RPN_TRAIN_ANCHORS_PER_IMAGE = 256
 
+    # Match anchors to GT boxes and sample them in the model, on its device,
+    # instead of in the data loader workers with numpy. Workers then only
+    # load and resize images and masks.
+    RPN_TARGETS_ON_DEVICE = False
+
     # ROIs kept after non-maximum supression (training and inference)
     POST_NMS_ROIS_TRAINING = 2000
     POST_NMS_ROIS_INFERENCE = 1000
@@ -96,6 +155,16 @@ class Config(object):
     # If True, pad images with zeros such that they're (max_dim by max_dim)
     IMAGE_PADDING = True  # currently, the False option is not supported
 
+    # Group training images by aspect ratio (width / height) so that all
+    # images of a batch fall in the same bucket, and pad them to the
+    # smallest shape that fits every image of that bucket instead of
+    # max_dim by max_dim. Bucket boundaries are given in increasing order.
+    # Images whose size isn't recorded in image_info are padded to a square.
+    # Only applies to training. Inference still pads to a square, so
+    # training and test input shapes differ when it's enabled.
+    ASPECT_RATIO_GROUPING = False
+    ASPECT_RATIO_BUCKETS = [1 / 2, 3 / 4, 1, 4 / 3, 2]
+
     # Image mean (RGB)
     MEAN_PIXEL = np.array([123.7, 116.8, 103.9])
 
@@ -131,6 +200,22 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Parts of the network whose activations are recomputed in the
+    # backward pass instead of being kept from the forward pass. Saves
+    # memory at the cost of running their forward pass twice. Any of
+    # "C1" to "C5" (ResNet stages), "fpn" (top-down layers) and "mask"
+    # (mask head). The mask head is the first part the backward pass
+    # recomputes, while everything else is still kept, so "mask" cuts
+    # the memory held between the passes but not the peak.
+    # See bench/checkpointing.py for the trade-off.
+    GRADIENT_CHECKPOINTING = []
+
+    # Precision of the backbone, FPN, RPN and heads: "fp32", or "bf16" to
+    # run them under autocast with bfloat16. Fast on CPUs with native bf16
+    # (oneDNN) and on recent GPUs. Box decoding, NMS, detection refinement
+    # and the losses stay in float32, as do the weights.
+    PRECISION = "fp32"
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimzer
@@ -156,9 +241,6 @@ class Config(object):
         else:
             self.BATCH_SIZE = self.IMAGES_PER_GPU
 
-        # Adjust step size based on batch size
-        self.STEPS_PER_EPOCH = self.BATCH_SIZE * self.STEPS_PER_EPOCH
-
         # Input image size
         self.IMAGE_SHAPE = np.array(
             [self.IMAGE_MAX_DIM, self.IMAGE_MAX_DIM, 3])
@@ -7,17 +7,27 @@ Licensed under the MIT License (see LICENSE for details)
 Written by Waleed Abdulla
 """
 
+import contextlib
 import datetime
+import functools
+import hashlib
+import json
 import math
 import os
+import queue
 import random
 import re
+import shutil
+import threading
+import time
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.utils.checkpoint
 import torch.utils.data
 from torch.autograd import Variable
 
@@ -58,12 +68,159 @@ def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1,
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     filledLength = int(length * iteration // total)
     bar = fill * filledLength + '-' * (length - filledLength)
-    print('\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix), end = '\n')
+    print('\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix), end = '', flush = True)
     # Print New Line on Complete
     if iteration == total:
         print()
 
 
+class StageTimer(object):
+    """Adds up the wall time spent in named stages, in seconds.
+
+        timer = StageTimer()
+        with timer("rpn"):
+            ...
+        timer.times  # {"rpn": 0.01}
+
+    With cuda=True, it waits for the GPU at the start and the end of each
+    stage, so that GPU work counts toward the stage that queued it. A
+    disabled timer only returns an empty context.
+    """
+
+    def __init__(self, enabled=True, cuda=False):
+        self.enabled = enabled
+        self.cuda = cuda
+        self.times = {}
+
+    def __call__(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.stage(name)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.cuda:
+                torch.cuda.synchronize()
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.times[name] = self.times.get(name, 0) + seconds
+
+    def reset(self):
+        self.times = {}
+
+
+# Default of functions that take an optional StageTimer
+NO_TIMER = StageTimer(enabled=False)
+
+
+def tensor_shapes(x):
+    """Returns the shapes of the tensors in x, which can be a tensor or a
+    nested list, tuple or dict of them. Other values are None.
+    """
+    if torch.is_tensor(x):
+        return list(x.size())
+    if isinstance(x, (list, tuple)):
+        return [tensor_shapes(v) for v in x]
+    if isinstance(x, dict):
+        return {k: tensor_shapes(v) for k, v in x.items()}
+    return None
+
+
+def tensor_bytes(x):
+    """Returns the size in bytes of the tensors in x, as tensor_shapes()."""
+    if torch.is_tensor(x):
+        return x.numel() * x.element_size()
+    if isinstance(x, (list, tuple)):
+        return sum(tensor_bytes(v) for v in x)
+    if isinstance(x, dict):
+        return sum(tensor_bytes(v) for v in x.values())
+    return 0
+
+
+class ChromeTrace(object):
+    """Context manager that records every forward call of the submodules
+    of a model, and every call of the functions in FUNCTIONS, to a trace
+    file for chrome://tracing or https://ui.perfetto.dev.
+
+    Each call is an event with its wall time, the shapes of its inputs and
+    outputs, the size of its outputs in bytes and, with cuda=True, the
+    change in GPU memory allocated by torch. With cuda=True it also waits
+    for the GPU at the start and end of each call, so calls are slower but
+    their times include their GPU work.
+
+    The functions are replaced in this module while the context is open,
+    so calls from other threads are recorded too.
+    """
+
+    FUNCTIONS = ["proposal_layer", "pyramid_roi_align", "refine_detections",
+                 "detection_target_layer", "nms"]
+
+    def __init__(self, model, path, cuda=False):
+        self.model = model
+        self.path = path
+        self.cuda = cuda
+
+    def __enter__(self):
+        self.events = []
+        self.calls = []
+        self.start = time.perf_counter()
+        self.hooks = []
+        for name, module in self.model.named_modules():
+            label = "{} ({})".format(name, type(module).__name__) if name else type(module).__name__
+            self.hooks.append(module.register_forward_pre_hook(
+                lambda module, input: self.begin()))
+            self.hooks.append(module.register_forward_hook(
+                lambda module, input, output, label=label: self.end(label, "module", input, output)))
+        self.functions = {name: globals()[name] for name in self.FUNCTIONS}
+        for name, function in self.functions.items():
+            globals()[name] = self.wrap(name, function)
+        return self
+
+    def __exit__(self, *exc_info):
+        for hook in self.hooks:
+            hook.remove()
+        globals().update(self.functions)
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def wrap(self, name, function):
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            self.begin()
+            output = function(*args, **kwargs)
+            self.end(name, "function", args, output)
+            return output
+        return traced
+
+    def begin(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        memory = torch.cuda.memory_allocated() if self.cuda else 0
+        self.calls.append((time.perf_counter(), memory))
+
+    def end(self, name, category, inputs, outputs):
+        if self.cuda:
+            torch.cuda.synchronize()
+        end = time.perf_counter()
+        start, memory = self.calls.pop()
+        args = {"inputs": tensor_shapes(inputs), "outputs": tensor_shapes(outputs),
+                "output_bytes": tensor_bytes(outputs)}
+        if self.cuda:
+            args["allocated_bytes"] = torch.cuda.memory_allocated() - memory
+        self.events.append({
+            "name": name, "cat": category, "ph": "X",
+            "ts": (start - self.start) * 1e6, "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+
 ############################################################
 #  Pytorch Utility Functions
 ############################################################
@@ -91,6 +248,38 @@ def log2(x):
         ln2 = ln2.cuda()
     return torch.log(x) / ln2
 
+def gather_rows(tensor, indices):
+    """Picks rows of a batch of tensors.
+    tensor: [batch, N, ...]
+    indices: [batch, K] Integer indices into N.
+
+    Returns [batch, K, ...]
+    """
+    size = tuple(indices.size()) + tuple(tensor.size()[2:])
+    index = indices.view(*(tuple(indices.size()) + (1,) * (tensor.dim() - 2)))
+    return tensor.gather(1, index.expand(*size))
+
+def random_sample(candidate_bool, count):
+    """Randomly picks count candidates in each row, without replacement,
+    on the device of candidate_bool. Gives every element a random key,
+    pushes the ones that aren't candidates below the others and keeps
+    the top keys.
+    candidate_bool: [batch, N] with N >= count
+
+    Returns [batch, count] indices. The candidates of a row come first. If
+    a row has fewer than count candidates, the rest are other indices.
+    """
+    candidate = candidate_bool.float()
+    keys = Variable(candidate.data.new(*candidate.size()).uniform_(), requires_grad=False)
+    return torch.topk(keys * candidate - (1 - candidate), count, dim=1)[1]
+
+def checkpointed(function, *args):
+    """Runs function(*args) without keeping its intermediate activations
+    for the backward pass. They're recomputed from args when needed.
+    Gradients still reach weights that the inputs don't depend on.
+    """
+    return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False)
+
 class SamePad2d(nn.Module):
     """Mimics tensorflow's 'SAME' padding.
     """
@@ -136,9 +325,14 @@ class TopDownLayer(nn.Module):
         return self.conv2(self.padding2(x+y))
 
 class FPN(nn.Module):
-    def __init__(self, C1, C2, C3, C4, C5, out_channels):
+    def __init__(self, C1, C2, C3, C4, C5, out_channels, checkpoints=()):
+        """checkpoints: Names of the parts whose activations are recomputed
+            in the backward pass in training: "C1" to "C5" for ResNet
+            stages and "fpn" for the top-down layers.
+        """
         super(FPN, self).__init__()
         self.out_channels = out_channels
+        self.checkpoints = set(checkpoints)
         self.C1 = C1
         self.C2 = C2
         self.C3 = C3
@@ -167,15 +361,39 @@ class FPN(nn.Module):
         )
 
     def forward(self, x):
-        x = self.C1(x)
-        x = self.C2(x)
-        c2_out = x
-        x = self.C3(x)
-        c3_out = x
-        x = self.C4(x)
-        c4_out = x
-        x = self.C5(x)
-        p5_out = self.P5_conv1(x)
+        return self.top_down(*self.bottom_up(x))
+
+    def bottom_up(self, x):
+        """Runs the ResNet stages. Returns the outputs of C2 to C5."""
+        x = self.run_stage("C1", x)
+        c2_out = self.run_stage("C2", x)
+        c3_out = self.run_stage("C3", c2_out)
+        c4_out = self.run_stage("C4", c3_out)
+        c5_out = self.run_stage("C5", c4_out)
+        return [c2_out, c3_out, c4_out, c5_out]
+
+    def run_stage(self, name, x):
+        """Runs a ResNet stage. If it's checkpointed, only the input of each
+        Bottleneck block is kept for the backward pass. C1 is checkpointed
+        as a whole.
+        """
+        stage = getattr(self, name)
+        # Frozen stages keep nothing for the backward pass anyway
+        frozen = not x.requires_grad and not any(p.requires_grad for p in stage.parameters())
+        if frozen or not (self.training and name in self.checkpoints):
+            return stage(x)
+        for block in ([stage] if name == "C1" else stage):
+            x = checkpointed(block, x)
+        return x
+
+    def top_down(self, c2_out, c3_out, c4_out, c5_out):
+        """Builds the P2 to P6 feature maps from the outputs of C2 to C5."""
+        if self.training and "fpn" in self.checkpoints:
+            return checkpointed(self.pyramid, c2_out, c3_out, c4_out, c5_out)
+        return self.pyramid(c2_out, c3_out, c4_out, c5_out)
+
+    def pyramid(self, c2_out, c3_out, c4_out, c5_out):
+        p5_out = self.P5_conv1(c5_out)
         p4_out = self.P4_conv1(c4_out) + F.upsample(p5_out, scale_factor=2)
         p3_out = self.P3_conv1(c3_out) + F.upsample(p4_out, scale_factor=2)
         p2_out = self.P2_conv1(c2_out) + F.upsample(p3_out, scale_factor=2)
@@ -329,7 +547,8 @@ def clip_boxes(boxes, window):
          boxes[:, 3].clamp(float(window[1]), float(window[3]))], 1)
     return boxes
 
-def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None):
+def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None, image_shape=None,
+                   timer=None):
     """Receives anchor scores and selects a subset to pass as proposals
     to the second stage. Filtering is done based on anchor scores and
     non-max suppression to remove overlaps. It also applies bounding
@@ -339,9 +558,15 @@ def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None):
         rpn_probs: [batch, anchors, (bg prob, fg prob)]
         rpn_bbox: [batch, anchors, (dy, dx, log(dh), log(dw))]
 
+    image_shape: [height, width] of the padded input images. Defaults to
+        config.IMAGE_SHAPE.
+    timer: Optional StageTimer of the proposal_layer.sort and
+        proposal_layer.nms stages.
+
     Returns:
         Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
     """
+    timer = timer or NO_TIMER
 
     # Currently only supports batchsize 1
     inputs[0] = inputs[0].squeeze(0)
@@ -360,7 +585,8 @@ def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None):
     # Improve performance by trimming to top anchors by score
     # and doing the rest on the smaller subset.
     pre_nms_limit = min(6000, anchors.size()[0])
-    scores, order = scores.sort(descending=True)
+    with timer("proposal_layer.sort"):
+        scores, order = scores.sort(descending=True)
     order = order[:pre_nms_limit]
     scores = scores[:pre_nms_limit]
     deltas = deltas[order.data, :] # TODO: Support batch size > 1 ff.
@@ -371,7 +597,7 @@ def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None):
     boxes = apply_box_deltas(anchors, deltas)
 
     # Clip to image boundaries. [batch, N, (y1, x1, y2, x2)]
-    height, width = config.IMAGE_SHAPE[:2]
+    height, width = (image_shape if image_shape is not None else config.IMAGE_SHAPE)[:2]
     window = np.array([0, 0, height, width]).astype(np.float32)
     boxes = clip_boxes(boxes, window)
 
@@ -380,7 +606,8 @@ def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None):
     # for small objects, so we're skipping it.
 
     # Non-max suppression
-    keep = nms(torch.cat((boxes, scores.unsqueeze(1)), 1).data, nms_threshold)
+    with timer("proposal_layer.nms"):
+        keep = nms(torch.cat((boxes, scores.unsqueeze(1)), 1).data, nms_threshold)
     keep = keep[:proposal_count]
     boxes = boxes[keep, :]
 
@@ -400,16 +627,18 @@ def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None):
 #  ROIAlign Layer
 ############################################################
 
-def pyramid_roi_align(inputs, pool_size, image_shape):
+def pyramid_roi_align(inputs, pool_size, image_shape, image_ids=None):
     """Implements ROI Pooling on multiple levels of the feature pyramid.
 
     Params:
     - pool_size: [height, width] of the output pooled regions. Usually [7, 7]
     - image_shape: [height, width, channels]. Shape of input image in pixels
+    - image_ids: [num_boxes] Index of the image in the batch that each box
+                 belongs to. If None, all boxes belong to the first image.
 
     Inputs:
-    - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized
-             coordinates.
+    - boxes: [batch, num_boxes, (y1, x1, y2, x2)] or [num_boxes, (y1, x1, y2, x2)]
+             in normalized coordinates.
     - Feature maps: List of feature maps from different levels of the pyramid.
                     Each is [batch, channels, height, width]
 
@@ -419,17 +648,18 @@ def pyramid_roi_align(inputs, pool_size, image_shape):
     constructor.
     """
 
-    # Currently only supports batchsize 1
-    for i in range(len(inputs)):
-        inputs[i] = inputs[i].squeeze(0)
-
-    # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coords
-    boxes = inputs[0]
+    # Crop boxes [num_boxes, (y1, x1, y2, x2)] in normalized coords
+    boxes = inputs[0].contiguous().view(-1, 4)
 
     # Feature Maps. List of feature maps from different level of the
-    # feature pyramid. Each is [batch, height, width, channels]
+    # feature pyramid. Each is [batch, channels, height, width]
     feature_maps = inputs[1:]
 
+    if image_ids is None:
+        image_ids = Variable(torch.zeros(boxes.size()[0]), requires_grad=False).int()
+        if boxes.is_cuda:
+            image_ids = image_ids.cuda()
+
     # Assign each ROI to a level in the pyramid based on the ROI area.
     y1, x1, y2, x2 = boxes.chunk(4, dim=1)
     h = y2 - y1
@@ -471,10 +701,7 @@ def pyramid_roi_align(inputs, pool_size, image_shape):
         # Here we use the simplified approach of a single value per bin,
         # which is how it's done in tf.crop_and_resize()
         # Result: [batch * num_boxes, pool_height, pool_width, channels]
-        ind = Variable(torch.zeros(level_boxes.size()[0]),requires_grad=False).int()
-        if level_boxes.is_cuda:
-            ind = ind.cuda()
-        feature_maps[i] = feature_maps[i].unsqueeze(0)  #CropAndResizeFunction needs batch dimension
+        ind = image_ids[ix.data].int()
         pooled_features = CropAndResizeFunction(pool_size, pool_size, 0)(feature_maps[i], level_boxes, ind)
         pooled.append(pooled_features)
 
@@ -497,220 +724,268 @@ def pyramid_roi_align(inputs, pool_size, image_shape):
 ############################################################
 def bbox_overlaps(boxes1, boxes2):
     """Computes IoU overlaps between two sets of boxes.
-    boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    boxes1: [..., N, (y1, x1, y2, x2)]
+    boxes2: [..., M, (y1, x1, y2, x2)]
+
+    Returns [..., N, M] overlaps. Leading (batch) dimensions broadcast.
     """
-    # 1. Tile boxes2 and repeate boxes1. This allows us to compare
-    # every boxes1 against every boxes2 without loops.
-    # TF doesn't have an equivalent to np.repeate() so simulate it
-    # using tf.tile() and tf.reshape.
-    boxes1_repeat = boxes2.size()[0]
-    boxes2_repeat = boxes1.size()[0]
-    boxes1 = boxes1.repeat(1,boxes1_repeat).view(-1,4)
-    boxes2 = boxes2.repeat(boxes2_repeat,1)
+    # 1. Broadcast boxes1 [..., N, 1] against boxes2 [..., 1, M] to compare
+    # every boxes1 against every boxes2 without materializing copies.
+    b1_y1, b1_x1, b1_y2, b1_x2 = [boxes1[..., i].unsqueeze(-1) for i in range(4)]
+    b2_y1, b2_x1, b2_y2, b2_x2 = [boxes2[..., i].unsqueeze(-2) for i in range(4)]
 
     # 2. Compute intersections
-    b1_y1, b1_x1, b1_y2, b1_x2 = boxes1.chunk(4, dim=1)
-    b2_y1, b2_x1, b2_y2, b2_x2 = boxes2.chunk(4, dim=1)
-    y1 = torch.max(b1_y1, b2_y1)[:, 0]
-    x1 = torch.max(b1_x1, b2_x1)[:, 0]
-    y2 = torch.min(b1_y2, b2_y2)[:, 0]
-    x2 = torch.min(b1_x2, b2_x2)[:, 0]
-    zeros = Variable(torch.zeros(y1.size()[0]), requires_grad=False)
-    if y1.is_cuda:
-        zeros = zeros.cuda()
-    intersection = torch.max(x2 - x1, zeros) * torch.max(y2 - y1, zeros)
-
-    # 3. Compute unions
+    y1 = torch.max(b1_y1, b2_y1)
+    x1 = torch.max(b1_x1, b2_x1)
+    y2 = torch.min(b1_y2, b2_y2)
+    x2 = torch.min(b1_x2, b2_x2)
+    intersection = (x2 - x1).clamp(min=0) * (y2 - y1).clamp(min=0)
+
+    # 3. Compute unions. Zero padded boxes have no area, keep them from
+    # dividing by zero.
     b1_area = (b1_y2 - b1_y1) * (b1_x2 - b1_x1)
     b2_area = (b2_y2 - b2_y1) * (b2_x2 - b2_x1)
-    union = b1_area[:,0] + b2_area[:,0] - intersection
-
-    # 4. Compute IoU and reshape to [boxes1, boxes2]
-    iou = intersection / union
-    overlaps = iou.view(boxes2_repeat, boxes1_repeat)
+    union = (b1_area + b2_area - intersection).clamp(min=1e-10)
 
-    return overlaps
+    # 4. Compute IoU [..., N, M]
+    return intersection / union
 
 def detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, config):
     """Subsamples proposals and generates target box refinment, class_ids,
     and masks for each.
 
+    Every image gets TRAIN_ROIS_PER_IMAGE ROI slots whatever the number of
+    proposals and GT instances, so the outputs have the same shape from
+    one step to the next. The first TRAIN_ROIS_PER_IMAGE * ROI_POSITIVE_RATIO
+    slots hold positive ROIs, the rest negative ones. Slots that aren't
+    filled are zero and marked as not valid.
+
     Inputs:
     proposals: [batch, N, (y1, x1, y2, x2)] in normalized coordinates. Might
                be zero padded if there are not enough proposals.
-    gt_class_ids: [batch, MAX_GT_INSTANCES] Integer class IDs.
+    gt_class_ids: [batch, MAX_GT_INSTANCES] Integer class IDs. Zero padded,
+                  negative for crowds.
     gt_boxes: [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)] in normalized
               coordinates.
-    gt_masks: [batch, height, width, MAX_GT_INSTANCES] of boolean type
+    gt_masks: [batch, MAX_GT_INSTANCES, height, width] float masks of 0s
+              and 1s
 
     Returns: Target ROIs and corresponding class IDs, bounding box shifts,
-    and masks.
+    masks and validity.
     rois: [batch, TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)] in normalized
           coordinates
     target_class_ids: [batch, TRAIN_ROIS_PER_IMAGE]. Integer class IDs.
-    target_deltas: [batch, TRAIN_ROIS_PER_IMAGE, NUM_CLASSES,
-                    (dy, dx, log(dh), log(dw), class_id)]
-                   Class-specific bbox refinments.
+    target_deltas: [batch, TRAIN_ROIS_PER_IMAGE, (dy, dx, log(dh), log(dw))]
     target_mask: [batch, TRAIN_ROIS_PER_IMAGE, height, width)
                  Masks cropped to bbox boundaries and resized to neural
                  network output size.
+    target_valid: [batch, TRAIN_ROIS_PER_IMAGE] True for the slots in use.
     """
-
-    # Currently only supports batchsize 1
-    proposals = proposals.squeeze(0)
-    gt_class_ids = gt_class_ids.squeeze(0)
-    gt_boxes = gt_boxes.squeeze(0)
-    gt_masks = gt_masks.squeeze(0)
+    roi_count = config.TRAIN_ROIS_PER_IMAGE
+    positive_count = int(config.TRAIN_ROIS_PER_IMAGE * config.ROI_POSITIVE_RATIO)
+    negative_count = roi_count - positive_count
+
+    # Pad the proposals to at least one per slot, the padding is never used
+    batch_size = proposals.size()[0]
+    if proposals.size()[1] < roi_count:
+        padding = Variable(proposals.data.new(batch_size, roi_count - proposals.size()[1], 4).zero_())
+        proposals = torch.cat([proposals, padding], dim=1)
+    # Zero out proposals without area, or not finite, so that they can be
+    # masked by multiplication later
+    y1, x1, y2, x2 = [proposals[:, :, i] for i in range(4)]
+    proposal_bool = (y2 > y1) & (x2 > x1)
+    proposals = proposals.masked_fill((proposal_bool == 0).unsqueeze(2).expand_as(proposals), 0)
+
+    # Compute overlaps matrix [batch, proposals, gt_boxes]
+    overlaps = bbox_overlaps(proposals, gt_boxes)
 
     # Handle COCO crowds
     # A crowd box in COCO is a bounding box around several instances. Exclude
     # them from training. A crowd box is given a negative class ID.
-    if torch.nonzero(gt_class_ids < 0).size():
-        crowd_ix = torch.nonzero(gt_class_ids < 0)[:, 0]
-        non_crowd_ix = torch.nonzero(gt_class_ids > 0)[:, 0]
-        crowd_boxes = gt_boxes[crowd_ix.data, :]
-        crowd_masks = gt_masks[crowd_ix.data, :, :]
-        gt_class_ids = gt_class_ids[non_crowd_ix.data]
-        gt_boxes = gt_boxes[non_crowd_ix.data, :]
-        gt_masks = gt_masks[non_crowd_ix.data, :]
-
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = bbox_overlaps(proposals, crowd_boxes)
-        crowd_iou_max = torch.max(crowd_overlaps, dim=1)[0]
-        no_crowd_bool = crowd_iou_max < 0.001
-    else:
-        no_crowd_bool =  Variable(torch.ByteTensor(proposals.size()[0]*[True]), requires_grad=False)
-        if config.GPU_COUNT:
-            no_crowd_bool = no_crowd_bool.cuda()
-
-    # Compute overlaps matrix [proposals, gt_boxes]
-    overlaps = bbox_overlaps(proposals, gt_boxes)
+    crowd = (gt_class_ids < 0).float().unsqueeze(1)
+    crowd_iou_max = torch.max(overlaps * crowd, dim=2)[0]
+    no_crowd_bool = crowd_iou_max < 0.001
 
-    # Determine postive and negative ROIs
-    roi_iou_max = torch.max(overlaps, dim=1)[0]
+    # Determine postive and negative ROIs. Crowds and padding get an IoU
+    # of -1 so that no ROI is assigned to them.
+    instance = (gt_class_ids > 0).float().unsqueeze(1)
+    roi_iou_max, roi_gt_box_assignment = torch.max(overlaps * instance - (1 - instance), dim=2)
 
     # 1. Positive ROIs are those with >= 0.5 IoU with a GT box
-    positive_roi_bool = roi_iou_max >= 0.5
-
-    # Subsample ROIs. Aim for 33% positive
-    # Positive ROIs
-    if torch.nonzero(positive_roi_bool).size():
-        positive_indices = torch.nonzero(positive_roi_bool)[:, 0]
-
-        positive_count = int(config.TRAIN_ROIS_PER_IMAGE *
-                             config.ROI_POSITIVE_RATIO)
-        rand_idx = torch.randperm(positive_indices.size()[0])
-        rand_idx = rand_idx[:positive_count]
-        if config.GPU_COUNT:
-            rand_idx = rand_idx.cuda()
-        positive_indices = positive_indices[rand_idx]
-        positive_count = positive_indices.size()[0]
-        positive_rois = proposals[positive_indices.data,:]
-
-        # Assign positive ROIs to GT boxes.
-        positive_overlaps = overlaps[positive_indices.data,:]
-        roi_gt_box_assignment = torch.max(positive_overlaps, dim=1)[1]
-        roi_gt_boxes = gt_boxes[roi_gt_box_assignment.data,:]
-        roi_gt_class_ids = gt_class_ids[roi_gt_box_assignment.data]
-
-        # Compute bbox refinement for positive ROIs
-        deltas = Variable(utils.box_refinement(positive_rois.data, roi_gt_boxes.data), requires_grad=False)
-        std_dev = Variable(torch.from_numpy(config.BBOX_STD_DEV).float(), requires_grad=False)
-        if config.GPU_COUNT:
-            std_dev = std_dev.cuda()
-        deltas /= std_dev
-
-        # Assign positive ROIs to GT masks
-        roi_masks = gt_masks[roi_gt_box_assignment.data,:,:]
-
-        # Compute mask targets
-        boxes = positive_rois
-        if config.USE_MINI_MASK:
-            # Transform ROI corrdinates from normalized image space
-            # to normalized mini-mask space.
-            y1, x1, y2, x2 = positive_rois.chunk(4, dim=1)
-            gt_y1, gt_x1, gt_y2, gt_x2 = roi_gt_boxes.chunk(4, dim=1)
-            gt_h = gt_y2 - gt_y1
-            gt_w = gt_x2 - gt_x1
-            y1 = (y1 - gt_y1) / gt_h
-            x1 = (x1 - gt_x1) / gt_w
-            y2 = (y2 - gt_y1) / gt_h
-            x2 = (x2 - gt_x1) / gt_w
-            boxes = torch.cat([y1, x1, y2, x2], dim=1)
-        box_ids = Variable(torch.arange(roi_masks.size()[0]), requires_grad=False).int()
-        if config.GPU_COUNT:
-            box_ids = box_ids.cuda()
-        masks = Variable(CropAndResizeFunction(config.MASK_SHAPE[0], config.MASK_SHAPE[1], 0)(roi_masks.unsqueeze(1), boxes, box_ids).data, requires_grad=False)
-        masks = masks.squeeze(1)
-
-        # Threshold mask pixels at 0.5 to have GT masks be 0 or 1 to use with
-        # binary cross entropy loss.
-        masks = torch.round(masks)
-    else:
-        positive_count = 0
+    positive_roi_bool = (roi_iou_max >= 0.5) & proposal_bool
 
     # 2. Negative ROIs are those with < 0.5 with every GT box. Skip crowds.
-    negative_roi_bool = roi_iou_max < 0.5
-    negative_roi_bool = negative_roi_bool & no_crowd_bool
-    # Negative ROIs. Add enough to maintain positive:negative ratio.
-    if torch.nonzero(negative_roi_bool).size() and positive_count>0:
-        negative_indices = torch.nonzero(negative_roi_bool)[:, 0]
-        r = 1.0 / config.ROI_POSITIVE_RATIO
-        negative_count = int(r * positive_count - positive_count)
-        rand_idx = torch.randperm(negative_indices.size()[0])
-        rand_idx = rand_idx[:negative_count]
-        if config.GPU_COUNT:
-            rand_idx = rand_idx.cuda()
-        negative_indices = negative_indices[rand_idx]
-        negative_count = negative_indices.size()[0]
-        negative_rois = proposals[negative_indices.data, :]
-    else:
-        negative_count = 0
+    negative_roi_bool = (roi_iou_max < 0.5) & no_crowd_bool & proposal_bool
+
+    # Subsample ROIs on the device. Aim for 33% positive
+    positive_indices = random_sample(positive_roi_bool, positive_count)
+    negative_indices = random_sample(negative_roi_bool, negative_count)
+
+    # Number of slots used in each image. Add enough negative ROIs to
+    # maintain the positive:negative ratio.
+    positives = positive_roi_bool.float().sum(dim=1).clamp(max=positive_count)
+    r = 1.0 / config.ROI_POSITIVE_RATIO
+    negatives = (r * positives.double() - positives.double()).floor().float()
+    negatives = torch.min(negatives, negative_roi_bool.float().sum(dim=1))
+    slots = Variable(proposals.data.new(list(range(roi_count))), requires_grad=False)
+    positive_bool = slots[:positive_count].unsqueeze(0) < positives.unsqueeze(1)
+    negative_bool = slots[:negative_count].unsqueeze(0) < negatives.unsqueeze(1)
+    positive_valid = positive_bool.float()
+
+    # Assign positive ROIs to GT boxes. Unused slots get a unit box as both
+    # ROI and GT box to keep their targets finite.
+    positive_rois = gather_rows(proposals, positive_indices)
+    roi_gt_box_assignment = roi_gt_box_assignment.gather(1, positive_indices)
+    roi_gt_boxes = gather_rows(gt_boxes, roi_gt_box_assignment)
+    roi_gt_class_ids = gt_class_ids.gather(1, roi_gt_box_assignment) * positive_bool.type_as(gt_class_ids)
+    unit_box = Variable(proposals.data.new([0, 0, 1, 1]), requires_grad=False)
+    valid = positive_valid.unsqueeze(2)
+    positive_rois = positive_rois * valid + unit_box * (1 - valid)
+    roi_gt_boxes = roi_gt_boxes * valid + unit_box * (1 - valid)
+
+    # Compute bbox refinement for positive ROIs
+    deltas = Variable(utils.box_refinement(positive_rois.data.view(-1, 4),
+                                           roi_gt_boxes.data.view(-1, 4)), requires_grad=False)
+    std_dev = Variable(torch.from_numpy(config.BBOX_STD_DEV).float(), requires_grad=False)
+    if config.GPU_COUNT:
+        std_dev = std_dev.cuda()
+    deltas = (deltas / std_dev).view(batch_size, positive_count, 4)
+
+    # Compute mask targets
+    boxes = positive_rois
+    if config.USE_MINI_MASK:
+        # Transform ROI corrdinates from normalized image space
+        # to normalized mini-mask space.
+        y1, x1, y2, x2 = positive_rois.chunk(4, dim=2)
+        gt_y1, gt_x1, gt_y2, gt_x2 = roi_gt_boxes.chunk(4, dim=2)
+        gt_h = gt_y2 - gt_y1
+        gt_w = gt_x2 - gt_x1
+        y1 = (y1 - gt_y1) / gt_h
+        x1 = (x1 - gt_x1) / gt_w
+        y2 = (y2 - gt_y1) / gt_h
+        x2 = (x2 - gt_x1) / gt_w
+        boxes = torch.cat([y1, x1, y2, x2], dim=2)
+    # Index of the assigned GT mask among the masks of all images
+    instance_count = gt_masks.size()[1]
+    offsets = roi_gt_box_assignment.data.new(list(range(0, batch_size * instance_count, instance_count)))
+    box_ids = Variable(roi_gt_box_assignment.data + offsets.unsqueeze(1), requires_grad=False).view(-1).int()
+    masks = CropAndResizeFunction(config.MASK_SHAPE[0], config.MASK_SHAPE[1], 0)(
+        gt_masks.contiguous().view(-1, 1, gt_masks.size()[2], gt_masks.size()[3]),
+        boxes.contiguous().view(-1, 4), box_ids)
+    masks = Variable(masks.data, requires_grad=False).view(batch_size, positive_count, *config.MASK_SHAPE)
+
+    # Threshold mask pixels at 0.5 to have GT masks be 0 or 1 to use with
+    # binary cross entropy loss.
+    masks = torch.round(masks) * valid.unsqueeze(3)
 
     # Append negative ROIs and pad bbox deltas and masks that
     # are not used for negative ROIs with zeros.
-    if positive_count > 0 and negative_count > 0:
-        rois = torch.cat((positive_rois, negative_rois), dim=0)
-        zeros = Variable(torch.zeros(negative_count), requires_grad=False).int()
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
-        roi_gt_class_ids = torch.cat([roi_gt_class_ids, zeros], dim=0)
-        zeros = Variable(torch.zeros(negative_count,4), requires_grad=False)
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
-        deltas = torch.cat([deltas, zeros], dim=0)
-        zeros = Variable(torch.zeros(negative_count,config.MASK_SHAPE[0],config.MASK_SHAPE[1]), requires_grad=False)
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
-        masks = torch.cat([masks, zeros], dim=0)
-    elif positive_count > 0:
-        rois = positive_rois
-    elif negative_count > 0:
-        rois = negative_rois
-        zeros = Variable(torch.zeros(negative_count), requires_grad=False)
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
-        roi_gt_class_ids = zeros
-        zeros = Variable(torch.zeros(negative_count,4), requires_grad=False).int()
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
-        deltas = zeros
-        zeros = Variable(torch.zeros(negative_count,config.MASK_SHAPE[0],config.MASK_SHAPE[1]), requires_grad=False)
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
-        masks = zeros
-    else:
-        rois = Variable(torch.FloatTensor(), requires_grad=False)
-        roi_gt_class_ids = Variable(torch.IntTensor(), requires_grad=False)
-        deltas = Variable(torch.FloatTensor(), requires_grad=False)
-        masks = Variable(torch.FloatTensor(), requires_grad=False)
-        if config.GPU_COUNT:
-            rois = rois.cuda()
-            roi_gt_class_ids = roi_gt_class_ids.cuda()
-            deltas = deltas.cuda()
-            masks = masks.cuda()
+    negative_rois = gather_rows(proposals, negative_indices)
+    target_valid = torch.cat([positive_bool, negative_bool], dim=1)
+    rois = torch.cat([positive_rois, negative_rois], dim=1) * target_valid.float().unsqueeze(2)
+    roi_gt_class_ids = torch.cat([roi_gt_class_ids, Variable(
+        roi_gt_class_ids.data.new(batch_size, negative_count).zero_(), requires_grad=False)], dim=1)
+    deltas = torch.cat([deltas, Variable(
+        deltas.data.new(batch_size, negative_count, 4).zero_(), requires_grad=False)], dim=1)
+    masks = torch.cat([masks, Variable(
+        masks.data.new(batch_size, negative_count, *config.MASK_SHAPE).zero_(), requires_grad=False)], dim=1)
+
+    return rois, roi_gt_class_ids, deltas, masks, target_valid
+
+
+def rpn_target_layer(anchors, gt_class_ids, gt_boxes, config, chunk_size=16384):
+    """Batched, on-device version of build_rpn_targets() followed by
+    sparse_rpn_match(). Matches anchors to GT boxes and samples the anchors
+    used to train the RPN.
+
+    The IoUs are computed for chunk_size anchors at a time, keeping only
+    the best match of each anchor and the best anchor of each GT box, so
+    memory doesn't grow with num_anchors * MAX_GT_INSTANCES.
+
+    anchors: [num_anchors, (y1, x1, y2, x2)]
+    gt_class_ids: [batch, MAX_GT_INSTANCES] Integer class IDs. Zero padded,
+                  negative for crowds.
+    gt_boxes: [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)] in the same
+              (pixel) coordinates as the anchors.
+
+    Returns:
+    rpn_indices: [batch, RPN_TRAIN_ANCHORS_PER_IMAGE] (int64) anchor indices,
+                 positive anchors first.
+    rpn_labels: [batch, RPN_TRAIN_ANCHORS_PER_IMAGE] (int8) 1 = positive,
+                -1 = negative, 0 = padding.
+    rpn_bbox: [batch, RPN_TRAIN_ANCHORS_PER_IMAGE, (dy, dx, log(dh), log(dw))]
+              Anchor bbox deltas of the positive anchors, zero for the rest.
+    """
+    anchor_count = config.RPN_TRAIN_ANCHORS_PER_IMAGE
+    batch_size = gt_boxes.size()[0]
+    num_anchors = anchors.size()[0]
+    anchor_zeros = Variable(anchors.data.new(batch_size, num_anchors).zero_(), requires_grad=False)
+
+    # A crowd box in COCO is a bounding box around several instances. Exclude
+    # them from training. A crowd box is given a negative class ID.
+    crowd = (gt_class_ids < 0).float().unsqueeze(1)
+    instance = (gt_class_ids > 0).float()
+
+    # Best GT box of each anchor [batch, num_anchors], whether the anchor
+    # is clear of crowds, and best anchor of each GT box [batch, num_gt_boxes]
+    anchor_iou_max = anchor_zeros.clone()
+    anchor_iou_argmax = anchor_zeros.long()
+    no_crowd_bool = anchor_zeros.byte()
+    gt_iou_max = instance - 2
+    gt_iou_argmax = instance.long() * 0
+    for start in range(0, num_anchors, chunk_size):
+        end = min(start + chunk_size, num_anchors)
+        # Overlaps [batch, chunk anchors, num_gt_boxes]
+        overlaps = bbox_overlaps(anchors[start:end].unsqueeze(0), gt_boxes)
+        no_crowd_bool[:, start:end] = torch.max(overlaps * crowd, dim=2)[0] < 0.001
+
+        # Crowds and padding get an IoU of -1 so that no anchor is matched to them
+        overlaps = overlaps * instance.unsqueeze(1) - (1 - instance.unsqueeze(1))
+        anchor_iou_max[:, start:end], anchor_iou_argmax[:, start:end] = torch.max(overlaps, dim=2)
+
+        # Keep the first anchor with the highest IoU, as torch.max() does
+        chunk_max, chunk_argmax = torch.max(overlaps, dim=1)
+        better = chunk_max > gt_iou_max
+        gt_iou_max = torch.max(gt_iou_max, chunk_max)
+        gt_iou_argmax[better] = chunk_argmax[better] + start
+    no_crowd_bool = no_crowd_bool > 0
+
+    # Match anchors to GT Boxes
+    # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
+    # If an anchor overlaps a GT box with IoU < 0.3 then it's negative.
+    # However, don't keep any GT box unmatched. Instead, match it to the
+    # closest anchor (even if its max IoU is < 0.3).
+    matched = anchor_zeros.scatter_add(1, gt_iou_argmax, instance)
+    positive_bool = (matched > 0) | (anchor_iou_max >= 0.7)
+    negative_bool = (anchor_iou_max < 0.3) & no_crowd_bool & (positive_bool == 0)
+
+    # Subsample to balance positive and negative anchors
+    # Don't let positives be more than half the anchors. Keep a random
+    # subset of them, then sort the kept positives first, negatives next,
+    # both in random order, and the rest last.
+    positives = positive_bool.float().sum(dim=1).clamp(max=anchor_count // 2)
+    positive_ix = random_sample(positive_bool, anchor_count // 2)
+    slots = Variable(anchors.data.new(list(range(anchor_count // 2))), requires_grad=False)
+    kept = anchor_zeros.scatter_add(
+        1, positive_ix, (slots.unsqueeze(0) < positives.unsqueeze(1)).float()) > 0
+    keys = Variable(anchors.data.new(batch_size, anchors.size()[0]).uniform_(), requires_grad=False)
+    keys = keys + 2 * kept.float() - 2 * ((kept | negative_bool) == 0).float()
+    rpn_indices = torch.topk(keys, anchor_count, dim=1)[1]
+    kept = kept.gather(1, rpn_indices)
+    rpn_labels = kept.char() - negative_bool.gather(1, rpn_indices).char()
 
-    return rois, roi_gt_class_ids, deltas, masks
+    # For positive anchors, compute shift and scale needed to transform them
+    # to match the corresponding GT boxes.
+    sampled_anchors = anchors[rpn_indices.data.view(-1)]
+    gt = gather_rows(gt_boxes, anchor_iou_argmax.gather(1, rpn_indices)).view(-1, 4)
+    rpn_bbox = Variable(utils.box_refinement(sampled_anchors.data, gt.data), requires_grad=False)
+    std_dev = Variable(torch.from_numpy(config.RPN_BBOX_STD_DEV).float(), requires_grad=False)
+    if config.GPU_COUNT:
+        std_dev = std_dev.cuda()
+    rpn_bbox = (rpn_bbox / std_dev).view(batch_size, anchor_count, 4)
+    rpn_bbox = rpn_bbox.masked_fill((kept == 0).unsqueeze(2).expand_as(rpn_bbox), 0)
+
+    return rpn_indices, rpn_labels, rpn_bbox
 
 
 ############################################################
@@ -729,7 +1004,7 @@ def clip_to_window(window, boxes):
 
     return boxes
 
-def refine_detections(rois, probs, deltas, window, config):
+def refine_detections(rois, probs, deltas, window, config, image_shape=None, timer=None):
     """Refine classified proposals and filter overlaps and return final
     detections.
 
@@ -740,9 +1015,13 @@ def refine_detections(rois, probs, deltas, window, config):
                 bounding box deltas.
         window: (y1, x1, y2, x2) in image coordinates. The part of the image
             that contains the image excluding the padding.
+        image_shape: [height, width] of the padded input image. Defaults to
+            config.IMAGE_SHAPE.
+        timer: Optional StageTimer of the per-class NMS, detection_layer.nms.
 
     Returns detections shaped: [N, (y1, x1, y2, x2, class_id, score)]
     """
+    timer = timer or NO_TIMER
 
     # Class IDs per ROI
     _, class_ids = torch.max(probs, dim=1)
@@ -763,7 +1042,7 @@ def refine_detections(rois, probs, deltas, window, config):
     refined_rois = apply_box_deltas(rois, deltas_specific * std_dev)
 
     # Convert coordiates to image domain
-    height, width = config.IMAGE_SHAPE[:2]
+    height, width = (image_shape if image_shape is not None else config.IMAGE_SHAPE)[:2]
     scale = Variable(torch.from_numpy(np.array([height, width, height, width])).float(), requires_grad=False)
     if config.GPU_COUNT:
         scale = scale.cuda()
@@ -785,6 +1064,10 @@ def refine_detections(rois, probs, deltas, window, config):
         keep_bool = keep_bool & (class_scores >= config.DETECTION_MIN_CONFIDENCE)
     keep = torch.nonzero(keep_bool)[:,0]
 
+    # No detections, e.g. with untrained weights
+    if not keep_bool.any():
+        return Variable(refined_rois.data.new(0, 6))
+
     # Apply per-class NMS
     pre_nms_class_ids = class_ids[keep.data]
     pre_nms_scores = class_scores[keep.data]
@@ -800,7 +1083,8 @@ def refine_detections(rois, probs, deltas, window, config):
         ix_scores, order = ix_scores.sort(descending=True)
         ix_rois = ix_rois[order.data,:]
 
-        class_keep = nms(torch.cat((ix_rois, ix_scores.unsqueeze(1)), dim=1).data, config.DETECTION_NMS_THRESHOLD)
+        with timer("detection_layer.nms"):
+            class_keep = nms(torch.cat((ix_rois, ix_scores.unsqueeze(1)), dim=1).data, config.DETECTION_NMS_THRESHOLD)
 
         # Map indicies
         class_keep = keep[ixs[order[class_keep].data].data]
@@ -825,7 +1109,7 @@ def refine_detections(rois, probs, deltas, window, config):
     return result
 
 
-def detection_layer(config, rois, mrcnn_class, mrcnn_bbox, image_meta):
+def detection_layer(config, rois, mrcnn_class, mrcnn_bbox, image_meta, image_shape=None, timer=None):
     """Takes classified proposal boxes and their bounding box deltas and
     returns the final detection boxes.
 
@@ -838,7 +1122,7 @@ def detection_layer(config, rois, mrcnn_class, mrcnn_bbox, image_meta):
 
     _, _, window, _ = parse_image_meta(image_meta)
     window = window[0]
-    detections = refine_detections(rois, mrcnn_class, mrcnn_bbox, window, config)
+    detections = refine_detections(rois, mrcnn_class, mrcnn_bbox, window, config, image_shape, timer)
 
     return detections
 
@@ -923,8 +1207,11 @@ class Classifier(nn.Module):
 
         self.linear_bbox = nn.Linear(1024, num_classes * 4)
 
-    def forward(self, x, rois):
-        x = pyramid_roi_align([rois]+x, self.pool_size, self.image_shape)
+    def forward(self, x, rois, image_ids=None, image_shape=None, timer=None):
+        if image_shape is None:
+            image_shape = self.image_shape
+        with (timer or NO_TIMER)("classifier.roi_align"):
+            x = pyramid_roi_align([rois]+x, self.pool_size, image_shape, image_ids)
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -942,12 +1229,16 @@ class Classifier(nn.Module):
         return [mrcnn_class_logits, mrcnn_probs, mrcnn_bbox]
 
 class Mask(nn.Module):
-    def __init__(self, depth, pool_size, image_shape, num_classes):
+    def __init__(self, depth, pool_size, image_shape, num_classes, checkpoint=False):
+        """checkpoint: If True, the activations of the convolutions are
+            recomputed in the backward pass in training.
+        """
         super(Mask, self).__init__()
         self.depth = depth
         self.pool_size = pool_size
         self.image_shape = image_shape
         self.num_classes = num_classes
+        self.checkpoint = checkpoint
         self.padding = SamePad2d(kernel_size=3, stride=1)
         self.conv1 = nn.Conv2d(self.depth, 256, kernel_size=3, stride=1)
         self.bn1 = nn.BatchNorm2d(256, eps=0.001)
@@ -962,8 +1253,30 @@ class Mask(nn.Module):
         self.sigmoid = nn.Sigmoid()
         self.relu = nn.ReLU(inplace=True)
 
-    def forward(self, x, rois):
-        x = pyramid_roi_align([rois] + x, self.pool_size, self.image_shape)
+    def forward(self, x, rois, image_ids=None, image_shape=None, timer=None, class_ids=None):
+        """class_ids: Optional [N] class ID of each ROI. If given, returns
+            only the mask of that class for each ROI, [N, height, width],
+            and computes only that channel of conv5. Otherwise returns the
+            masks of all classes, [N, num_classes, height, width].
+        """
+        if image_shape is None:
+            image_shape = self.image_shape
+        with (timer or NO_TIMER)("mask.roi_align"):
+            x = pyramid_roi_align([rois] + x, self.pool_size, image_shape, image_ids)
+        if self.training and self.checkpoint:
+            x = checkpointed(self.convs, x)
+        else:
+            x = self.convs(x)
+        if class_ids is None:
+            x = self.conv5(x)
+        else:
+            x = self.class_conv5(x, class_ids)
+        x = self.sigmoid(x)
+
+        return x
+
+    def convs(self, x):
+        """The convolutions up to the upsampled [N, 256, 28, 28] features."""
         x = self.conv1(self.padding(x))
         x = self.bn1(x)
         x = self.relu(x)
@@ -978,65 +1291,77 @@ class Mask(nn.Module):
         x = self.relu(x)
         x = self.deconv(x)
         x = self.relu(x)
-        x = self.conv5(x)
-        x = self.sigmoid(x)
-
         return x
 
+    def class_conv5(self, x, class_ids):
+        """conv5 of only the channel class_ids[i] for ROI i. Gathers the
+        1x1 filter and bias of each ROI's class and applies them as one
+        batched matrix product.
+
+        x: [N, depth, height, width] features of the ROIs
+        class_ids: [N] int class IDs
+
+        Returns: [N, height, width]
+        """
+        n, depth, height, width = x.size()
+        class_ids = class_ids.long()
+        weight = self.conv5.weight[class_ids].view(n, 1, depth)
+        bias = self.conv5.bias[class_ids].view(n, 1, 1)
+        x = torch.bmm(weight, x.contiguous().view(n, depth, height * width))
+        return x.view(n, height, width) + bias
+
 
 ############################################################
 #  Loss Functions
 ############################################################
 
-def compute_rpn_class_loss(rpn_match, rpn_class_logits):
+def compute_rpn_class_loss(rpn_indices, rpn_labels, rpn_class_logits):
     """RPN anchor classifier loss.
 
-    rpn_match: [batch, anchors, 1]. Anchor match type. 1=positive,
-               -1=negative, 0=neutral anchor.
+    rpn_indices: [batch, RPN_TRAIN_ANCHORS_PER_IMAGE]. Indices of the
+                 sampled anchors. See sparse_rpn_match().
+    rpn_labels: [batch, RPN_TRAIN_ANCHORS_PER_IMAGE]. Anchor match type of
+                the sampled anchors. 1=positive, -1=negative, 0=padding.
     rpn_class_logits: [batch, anchors, 2]. RPN classifier logits for FG/BG.
     """
 
-    # Squeeze last dim to simplify
-    rpn_match = rpn_match.squeeze(2)
+    # Positive and Negative anchors contribute to the loss,
+    # but padding doesn't.
+    indices = torch.nonzero(rpn_labels != 0)
+    anchor_ix = rpn_indices[indices.data[:,0],indices.data[:,1]]
 
     # Get anchor classes. Convert the -1/+1 match to 0/1 values.
-    anchor_class = (rpn_match == 1).long()
-
-    # Positive and Negative anchors contribute to the loss,
-    # but neutral anchors (match value = 0) don't.
-    indices = torch.nonzero(rpn_match != 0)
+    anchor_class = (rpn_labels[indices.data[:,0],indices.data[:,1]] == 1).long()
 
     # Pick rows that contribute to the loss and filter out the rest.
-    rpn_class_logits = rpn_class_logits[indices.data[:,0],indices.data[:,1],:]
-    anchor_class = anchor_class[indices.data[:,0],indices.data[:,1]]
+    rpn_class_logits = rpn_class_logits[indices.data[:,0],anchor_ix.data,:]
 
     # Crossentropy loss
     loss = F.cross_entropy(rpn_class_logits, anchor_class)
 
     return loss
 
-def compute_rpn_bbox_loss(target_bbox, rpn_match, rpn_bbox):
+def compute_rpn_bbox_loss(target_bbox, rpn_indices, rpn_labels, rpn_bbox):
     """Return the RPN bounding box loss graph.
 
     target_bbox: [batch, max positive anchors, (dy, dx, log(dh), log(dw))].
         Uses 0 padding to fill in unsed bbox deltas.
-    rpn_match: [batch, anchors, 1]. Anchor match type. 1=positive,
-               -1=negative, 0=neutral anchor.
+    rpn_indices: [batch, RPN_TRAIN_ANCHORS_PER_IMAGE]. Indices of the
+                 sampled anchors, positive anchors first.
+    rpn_labels: [batch, RPN_TRAIN_ANCHORS_PER_IMAGE]. Anchor match type of
+                the sampled anchors. 1=positive, -1=negative, 0=padding.
     rpn_bbox: [batch, anchors, (dy, dx, log(dh), log(dw))]
     """
 
-    # Squeeze last dim to simplify
-    rpn_match = rpn_match.squeeze(2)
-
     # Positive anchors contribute to the loss, but negative and
-    # neutral anchors (match value of 0 or -1) don't.
-    indices = torch.nonzero(rpn_match==1)
+    # neutral anchors (match value of 0 or -1) don't. They come first, in
+    # the same order as their target bounding box deltas.
+    indices = torch.nonzero(rpn_labels == 1)
+    anchor_ix = rpn_indices[indices.data[:,0],indices.data[:,1]]
 
     # Pick bbox deltas that contribute to the loss
-    rpn_bbox = rpn_bbox[indices.data[:,0],indices.data[:,1]]
-
-    # Trim target bounding box deltas to the same length as rpn_bbox.
-    target_bbox = target_bbox[0,:rpn_bbox.size()[0],:]
+    rpn_bbox = rpn_bbox[indices.data[:,0],anchor_ix.data]
+    target_bbox = target_bbox[indices.data[:,0],indices.data[:,1]]
 
     # Smooth L1 loss
     loss = F.smooth_l1_loss(rpn_bbox, target_bbox)
@@ -1044,21 +1369,19 @@ def compute_rpn_bbox_loss(target_bbox, rpn_match, rpn_bbox):
     return loss
 
 
-def compute_mrcnn_class_loss(target_class_ids, pred_class_logits):
+def compute_mrcnn_class_loss(target_class_ids, target_valid, pred_class_logits):
     """Loss for the classifier head of Mask RCNN.
 
-    target_class_ids: [batch, num_rois]. Integer class IDs. Uses zero
-        padding to fill in the array.
-    pred_class_logits: [batch, num_rois, num_classes]
+    target_class_ids: [num_rois]. Integer class IDs.
+    target_valid: [num_rois]. True for the ROI slots in use, only those
+        contribute to the loss.
+    pred_class_logits: [num_rois, num_classes]
     """
-
-    # Loss
-    if target_class_ids.size():
-        loss = F.cross_entropy(pred_class_logits,target_class_ids.long())
-    else:
-        loss = Variable(torch.FloatTensor([0]), requires_grad=False)
-        if target_class_ids.is_cuda:
-            loss = loss.cuda()
+    # Cross entropy of each ROI, averaged over the valid ones
+    log_probs = F.log_softmax(pred_class_logits, dim=1)
+    loss = -log_probs.gather(1, target_class_ids.long().unsqueeze(1)).squeeze(1)
+    valid = target_valid.float()
+    loss = (loss * valid).sum() / valid.sum().clamp(min=1)
 
     return loss
 
@@ -1066,28 +1389,21 @@ def compute_mrcnn_class_loss(target_class_ids, pred_class_logits):
 def compute_mrcnn_bbox_loss(target_bbox, target_class_ids, pred_bbox):
     """Loss for Mask R-CNN bounding box refinement.
 
-    target_bbox: [batch, num_rois, (dy, dx, log(dh), log(dw))]
-    target_class_ids: [batch, num_rois]. Integer class IDs.
-    pred_bbox: [batch, num_rois, num_classes, (dy, dx, log(dh), log(dw))]
+    target_bbox: [num_rois, (dy, dx, log(dh), log(dw))]
+    target_class_ids: [num_rois]. Integer class IDs. Zero for negative ROIs
+        and unused slots.
+    pred_bbox: [num_rois, num_classes, (dy, dx, log(dh), log(dw))]
     """
+    # Only positive ROIs contribute to the loss. And only
+    # the right class_id of each ROI.
+    positive = (target_class_ids > 0).float().unsqueeze(1)
+    class_ids = target_class_ids.long().view(-1, 1, 1).expand(pred_bbox.size()[0], 1, 4)
+    pred_bbox = pred_bbox.gather(1, class_ids).squeeze(1)
 
-    if target_class_ids.size():
-        # Only positive ROIs contribute to the loss. And only
-        # the right class_id of each ROI. Get their indicies.
-        positive_roi_ix = torch.nonzero(target_class_ids > 0)[:, 0]
-        positive_roi_class_ids = target_class_ids[positive_roi_ix.data].long()
-        indices = torch.stack((positive_roi_ix,positive_roi_class_ids), dim=1)
-
-        # Gather the deltas (predicted and true) that contribute to loss
-        target_bbox = target_bbox[indices[:,0].data,:]
-        pred_bbox = pred_bbox[indices[:,0].data,indices[:,1].data,:]
-
-        # Smooth L1 loss
-        loss = F.smooth_l1_loss(pred_bbox, target_bbox)
-    else:
-        loss = Variable(torch.FloatTensor([0]), requires_grad=False)
-        if target_class_ids.is_cuda:
-            loss = loss.cuda()
+    # Smooth L1 loss averaged over the positive ROIs. Others are zeroed
+    # out on both sides and add nothing to the sum.
+    loss = F.smooth_l1_loss(pred_bbox * positive, target_bbox * positive, size_average=False)
+    loss = loss / (positive.sum() * 4).clamp(min=1)
 
     return loss
 
@@ -1095,37 +1411,36 @@ def compute_mrcnn_bbox_loss(target_bbox, target_class_ids, pred_bbox):
 def compute_mrcnn_mask_loss(target_masks, target_class_ids, pred_masks):
     """Mask binary cross-entropy loss for the masks head.
 
-    target_masks: [batch, num_rois, height, width].
-        A float32 tensor of values 0 or 1. Uses zero padding to fill array.
-    target_class_ids: [batch, num_rois]. Integer class IDs. Zero padded.
-    pred_masks: [batch, proposals, height, width, num_classes] float32 tensor
-                with values from 0 to 1.
+    target_masks: [num_rois, height, width].
+        A float32 tensor of values 0 or 1. Zero for negative ROIs.
+    target_class_ids: [num_rois]. Integer class IDs. Zero for negative ROIs
+        and unused slots.
+    pred_masks: [num_rois, height, width] float32 tensor with values from
+                0 to 1, the mask of the target class of each ROI, or
+                [num_rois, num_classes, height, width] with the masks of
+                all classes.
     """
-    if target_class_ids.size():
-        # Only positive ROIs contribute to the loss. And only
-        # the class specific mask of each ROI.
-        positive_ix = torch.nonzero(target_class_ids > 0)[:, 0]
-        positive_class_ids = target_class_ids[positive_ix.data].long()
-        indices = torch.stack((positive_ix, positive_class_ids), dim=1)
-
-        # Gather the masks (predicted and true) that contribute to loss
-        y_true = target_masks[indices[:,0].data,:,:]
-        y_pred = pred_masks[indices[:,0].data,indices[:,1].data,:,:]
-
-        # Binary cross entropy
-        loss = F.binary_cross_entropy(y_pred, y_true)
+    # Only positive ROIs contribute to the loss. And only
+    # the class specific mask of each ROI.
+    positive = (target_class_ids > 0).float().view(-1, 1, 1).expand_as(target_masks)
+    if pred_masks.dim() == 4:
+        class_ids = target_class_ids.long().view(-1, 1, 1, 1).expand(
+            pred_masks.size()[0], 1, pred_masks.size()[2], pred_masks.size()[3])
+        y_pred = pred_masks.gather(1, class_ids).squeeze(1)
     else:
-        loss = Variable(torch.FloatTensor([0]), requires_grad=False)
-        if target_class_ids.is_cuda:
-            loss = loss.cuda()
+        y_pred = pred_masks
+
+    # Binary cross entropy averaged over the pixels of positive ROIs
+    loss = F.binary_cross_entropy(y_pred, target_masks, weight=positive, size_average=False)
+    loss = loss / positive.sum().clamp(min=1)
 
     return loss
 
-def compute_losses(rpn_match, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask):
+def compute_losses(rpn_indices, rpn_labels, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_class_ids, target_valid, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask):
 
-    rpn_class_loss = compute_rpn_class_loss(rpn_match, rpn_class_logits)
-    rpn_bbox_loss = compute_rpn_bbox_loss(rpn_bbox, rpn_match, rpn_pred_bbox)
-    mrcnn_class_loss = compute_mrcnn_class_loss(target_class_ids, mrcnn_class_logits)
+    rpn_class_loss = compute_rpn_class_loss(rpn_indices, rpn_labels, rpn_class_logits)
+    rpn_bbox_loss = compute_rpn_bbox_loss(rpn_bbox, rpn_indices, rpn_labels, rpn_pred_bbox)
+    mrcnn_class_loss = compute_mrcnn_class_loss(target_class_ids, target_valid, mrcnn_class_logits)
     mrcnn_bbox_loss = compute_mrcnn_bbox_loss(target_deltas, target_class_ids, mrcnn_bbox)
     mrcnn_mask_loss = compute_mrcnn_mask_loss(target_mask, target_class_ids, mrcnn_mask)
 
@@ -1137,7 +1452,7 @@ def compute_losses(rpn_match, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_
 ############################################################
 
 def load_image_gt(dataset, config, image_id, augment=False,
-                  use_mini_mask=False):
+                  use_mini_mask=False, image_shape=None, flip=None):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
 
     augment: If true, apply random image augmentation. Currently, only
@@ -1147,6 +1462,10 @@ def load_image_gt(dataset, config, image_id, augment=False,
         1024x1024x100 (for 100 instances). Mini masks are smaller, typically,
         224x224 and are generated by extracting the bounding box of the
         object and resizing it to MINI_MASK_SHAPE.
+    image_shape: [height, width] to pad the image to. Defaults to
+        config.IMAGE_SHAPE.
+    flip: If True or False, flips the image horizontally or not instead
+        of leaving it to augment.
 
     Returns:
     image: [height, width, 3]
@@ -1157,27 +1476,25 @@ def load_image_gt(dataset, config, image_id, augment=False,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
-    # Load image and mask
-    image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
-    shape = image.shape
-    image, window, scale, padding = utils.resize_image(
-        image,
+    # Load image, decoded at its training size where possible
+    image, window, scale, padding, shape = dataset.load_image_resized(
+        image_id,
         min_dim=config.IMAGE_MIN_DIM,
         max_dim=config.IMAGE_MAX_DIM,
-        padding=config.IMAGE_PADDING)
-    mask = utils.resize_mask(mask, scale, padding)
-
-    # Random horizontal flips.
-    if augment:
-        if random.randint(0, 1):
-            image = np.fliplr(image)
-            mask = np.fliplr(mask)
+        padding=config.IMAGE_PADDING,
+        padded_shape=image_shape)
 
-    # Bounding boxes. Note that some boxes might be all zeros
-    # if the corresponding mask got cropped out.
+    # Load masks at the resized resolution as one crop per instance.
+    # Instances whose mask got scaled or cropped out are dropped.
     # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
+    bbox, mask_crops, class_ids = dataset.load_mask_crops(image_id, scale, padding)
+
+    # Random horizontal flips.
+    if flip is None:
+        flip = augment and random.randint(0, 1)
+    if flip:
+        image = np.fliplr(image)
+        bbox, mask_crops = utils.flip_mask_crops(bbox, mask_crops, image.shape[1])
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1188,7 +1505,9 @@ def load_image_gt(dataset, config, image_id, augment=False,
 
     # Resize masks to smaller size to reduce memory usage
     if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+        mask = utils.minimize_mask_crops(bbox, mask_crops, config.MINI_MASK_SHAPE)
+    else:
+        mask = utils.expand_mask_crops(bbox, mask_crops, image.shape)
 
     # Image meta data
     image_meta = compose_image_meta(image_id, shape, window, active_class_ids)
@@ -1305,8 +1624,46 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
 
     return rpn_match, rpn_bbox
 
+
+def sparse_rpn_match(rpn_match, config):
+    """Converts the dense anchor match vector of build_rpn_targets() to the
+    sampled anchors only. Positive anchors come first, in the same order
+    as the rows of rpn_bbox.
+
+    rpn_match: [N] (int32) matches between anchors and GT boxes.
+
+    Returns:
+    rpn_indices: [RPN_TRAIN_ANCHORS_PER_IMAGE] (int64) anchor indices.
+    rpn_labels: [RPN_TRAIN_ANCHORS_PER_IMAGE] (int8) 1 = positive,
+                -1 = negative, 0 = padding.
+    """
+    count = config.RPN_TRAIN_ANCHORS_PER_IMAGE
+    positive = np.where(rpn_match == 1)[0]
+    negative = np.where(rpn_match == -1)[0]
+    indices = np.concatenate([positive, negative])[:count]
+    rpn_indices = np.zeros([count], dtype=np.int64)
+    rpn_labels = np.zeros([count], dtype=np.int8)
+    rpn_indices[:len(indices)] = indices
+    rpn_labels[:len(indices)] = rpn_match[indices]
+    return rpn_indices, rpn_labels
+
+
+def unpack_masks(packed, shape):
+    """Unpacks masks packed by utils.pack_masks() on the device they're on.
+
+    packed: [..., bytes] uint8 packed masks.
+    shape: (height, width) of the masks.
+
+    Returns [..., height, width] float masks of 0s and 1s.
+    """
+    bits = Variable(packed.data.new([128, 64, 32, 16, 8, 4, 2, 1]), requires_grad=False)
+    masks = (packed.unsqueeze(-1) & bits) != 0
+    masks = masks.view(*(packed.size()[:-1] + (-1,)))[..., :shape[0] * shape[1]]
+    return masks.contiguous().view(*(packed.size()[:-1] + tuple(shape))).float()
+
+
 class Dataset(torch.utils.data.Dataset):
-    def __init__(self, dataset, config, augment=True):
+    def __init__(self, dataset, config, augment=True, features=None):
         """A generator that returns images and corresponding target class ids,
             bounding box deltas, and masks.
 
@@ -1315,20 +1672,28 @@ class Dataset(torch.utils.data.Dataset):
             shuffle: If True, shuffles the samples before every epoch
             augment: If True, applies image augmentation to images (currently only
                      horizontal flips are supported)
+            features: Optional FeatureCache of dataset. Samples then hold
+                      the cached backbone outputs instead of the image.
 
             Returns a Python generator. Upon calling next() on it, the
             generator returns two lists, inputs and outputs. The containtes
             of the lists differs depending on the received arguments:
             inputs list:
-            - images: [batch, H, W, C]
+            - images: [batch, H, W, C], or with features the list of the
+                      C2 to C5 outputs, each [batch, channels, height, width]
             - image_metas: [batch, size of image meta]
-            - rpn_match: [batch, N] Integer (1=positive anchor, -1=negative, 0=neutral)
+            - rpn_indices: [batch, RPN_TRAIN_ANCHORS_PER_IMAGE] Indices of the
+                           sampled anchors, positive anchors first.
+            - rpn_labels: [batch, RPN_TRAIN_ANCHORS_PER_IMAGE] Integer
+                          (1=positive anchor, -1=negative, 0=padding)
             - rpn_bbox: [batch, N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
+              The three RPN targets are None with RPN_TARGETS_ON_DEVICE.
             - gt_class_ids: [batch, MAX_GT_INSTANCES] Integer class IDs
             - gt_boxes: [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)]
-            - gt_masks: [batch, height, width, MAX_GT_INSTANCES]. The height and width
-                        are those of the image unless use_mini_mask is True, in which
-                        case they are defined in MINI_MASK_SHAPE.
+            - gt_masks: [batch, MAX_GT_INSTANCES, bytes] Bit-packed masks, see
+                        utils.pack_masks(). The height and width are those of
+                        the image unless use_mini_mask is True, in which case
+                        they are defined in MINI_MASK_SHAPE.
 
             outputs list: Usually empty in regular training. But if detection_targets
                 is True then the outputs list contains target class_ids, bbox deltas,
@@ -1342,21 +1707,34 @@ class Dataset(torch.utils.data.Dataset):
         self.dataset = dataset
         self.config = config
         self.augment = augment
+        self.features = features
+
+        # Aspect ratio bucket of each image. -1 pads to IMAGE_SHAPE.
+        if config.ASPECT_RATIO_GROUPING:
+            self.image_buckets = compute_aspect_ratio_buckets(dataset, config)
+        else:
+            self.image_buckets = np.full([len(self.image_ids)], -1, dtype=np.int32)
 
-        # Anchors
+        if features is not None:
+            image_shapes = [bucket_image_shape(config, b) for b in self.image_buckets]
+            features.check(self.image_ids, image_shapes, config, flip=augment)
+
+        # Anchors of each padded image shape
         # [anchor_count, (y1, x1, y2, x2)]
-        self.anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                                 config.RPN_ANCHOR_RATIOS,
-                                                 config.BACKBONE_SHAPES,
-                                                 config.BACKBONE_STRIDES,
-                                                 config.RPN_ANCHOR_STRIDE)
+        self.anchors = {}
 
     def __getitem__(self, image_index):
         # Get GT bounding boxes and masks for image.
         image_id = self.image_ids[image_index]
+        image_shape = bucket_image_shape(self.config, self.image_buckets[image_index])
+        # The flip is picked here to read the matching cached features
+        flip = None
+        if self.features is not None:
+            flip = bool(self.augment and random.randint(0, 1))
         image, image_metas, gt_class_ids, gt_boxes, gt_masks = \
             load_image_gt(self.dataset, self.config, image_id, augment=self.augment,
-                          use_mini_mask=self.config.USE_MINI_MASK)
+                          use_mini_mask=self.config.USE_MINI_MASK,
+                          image_shape=image_shape, flip=flip)
 
         # Skip images that have no instances. This can happen in cases
         # where we train on a subset of classes and the image doesn't
@@ -1364,9 +1742,13 @@ class Dataset(torch.utils.data.Dataset):
         if not np.any(gt_class_ids > 0):
             return None
 
-        # RPN Targets
-        rpn_match, rpn_bbox = build_rpn_targets(image.shape, self.anchors,
-                                                gt_class_ids, gt_boxes, self.config)
+        # RPN Targets. Left to the model with RPN_TARGETS_ON_DEVICE.
+        rpn_match = rpn_bbox = None
+        if not self.config.RPN_TARGETS_ON_DEVICE:
+            if image_shape not in self.anchors:
+                self.anchors[image_shape] = generate_anchors(self.config, image_shape)
+            rpn_match, rpn_bbox = build_rpn_targets(image.shape, self.anchors[image_shape],
+                                                    gt_class_ids, gt_boxes, self.config)
 
         # If more instances than fits in the array, sub-sample from them.
         if gt_boxes.shape[0] > self.config.MAX_GT_INSTANCES:
@@ -1376,25 +1758,471 @@ class Dataset(torch.utils.data.Dataset):
             gt_boxes = gt_boxes[ids]
             gt_masks = gt_masks[:, :, ids]
 
-        # Add to batch
-        rpn_match = rpn_match[:, np.newaxis]
-        images = mold_image(image.astype(np.float32), self.config)
+        # Compact targets: the sampled anchors only and bit-packed masks.
+        # The model unpacks the masks on its device.
+        gt_masks = utils.pack_masks(gt_masks.transpose(2, 0, 1))
 
         # Convert
-        images = torch.from_numpy(images.transpose(2, 0, 1)).float()
+        # Images stay uint8 [H, W, C]. The model normalizes them on its device.
+        # With a feature cache, the image is replaced by its float16
+        # backbone outputs.
+        if self.features is not None:
+            images = [torch.from_numpy(c) for c in self.features.load(image_index, flip)]
+        else:
+            images = torch.from_numpy(np.ascontiguousarray(image, dtype=np.uint8))
         image_metas = torch.from_numpy(image_metas)
-        rpn_match = torch.from_numpy(rpn_match)
-        rpn_bbox = torch.from_numpy(rpn_bbox).float()
+        rpn_indices = rpn_labels = None
+        if rpn_match is not None:
+            rpn_indices, rpn_labels = sparse_rpn_match(rpn_match, self.config)
+            rpn_indices = torch.from_numpy(rpn_indices)
+            rpn_labels = torch.from_numpy(rpn_labels)
+            rpn_bbox = torch.from_numpy(rpn_bbox).float()
         gt_class_ids = torch.from_numpy(gt_class_ids)
         gt_boxes = torch.from_numpy(gt_boxes).float()
-        gt_masks = torch.from_numpy(gt_masks.astype(int).transpose(2, 0, 1)).float()
+        gt_masks = torch.from_numpy(gt_masks)
 
-        return images, image_metas, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks
+        return images, image_metas, rpn_indices, rpn_labels, rpn_bbox, gt_class_ids, gt_boxes, gt_masks
 
     def __len__(self):
         return self.image_ids.shape[0]
 
 
+def pad_instances(tensors, count):
+    """Zero pads a list of tensors along the first (instance) dimension to
+    count rows and stacks them into one [batch, count, ...] tensor.
+    """
+    batch = tensors[0].new(len(tensors), count, *tensors[0].size()[1:]).zero_()
+    for i, t in enumerate(tensors):
+        if t.size()[0]:
+            batch[i, :t.size()[0]] = t
+    return batch
+
+
+def collate_samples(samples):
+    """Collates samples returned by Dataset.__getitem__() into a batch.
+
+    Samples of images without instances (None) are dropped. The variable
+    length GT tensors (gt_class_ids, gt_boxes, gt_masks) are zero padded to
+    the largest instance count in the batch. A class ID of 0 marks padding.
+
+    Returns the same list of tensors as a sample, each with a batch
+    dimension, or None if no sample is left. RPN targets stay None if
+    the samples have none. Cached backbone features are stacked per level.
+    """
+    samples = [s for s in samples if s is not None]
+    if not samples:
+        return None
+    images, image_metas, rpn_indices, rpn_labels, rpn_bbox, gt_class_ids, gt_boxes, gt_masks = zip(*samples)
+    count = max(ids.size()[0] for ids in gt_class_ids)
+    if rpn_indices[0] is None:
+        rpn_targets = [None, None, None]
+    else:
+        rpn_targets = [torch.stack(rpn_indices), torch.stack(rpn_labels), torch.stack(rpn_bbox)]
+    if isinstance(images[0], list):
+        images = [torch.stack(level) for level in zip(*images)]
+    else:
+        images = torch.stack(images)
+    return ([images, torch.stack(image_metas)] + rpn_targets +
+            [pad_instances(gt_class_ids, count),
+             pad_instances(gt_boxes, count),
+             pad_instances(gt_masks, count)])
+
+
+def data_generator(dataset, config, shuffle=True, augment=True, rank=0, world_size=1,
+                   features=None, seed=0):
+    """Returns a DataLoader that yields batches of BATCH_SIZE training
+    samples from dataset, collated by collate_samples(). Batches can be
+    None if every image in them had no instances. With
+    ASPECT_RATIO_GROUPING, the images of a batch share an aspect ratio
+    bucket and batches at the end of an epoch can be smaller.
+
+    dataset: A utils.Dataset object to pick data from
+    config: The model config object. Worker settings come from its
+        DATA_LOADER_* values.
+    shuffle: If True, shuffles the samples before every epoch
+    augment: If True, applies image augmentation to images (currently only
+             horizontal flips are supported)
+    rank, world_size: In distributed training, the process and number of
+        processes. Each process loads its own share of the batches of an
+        epoch, and all get the same number of them. Set the epoch of the
+        sampler with set_sampler_epoch() so they shuffle alike.
+    features: Optional FeatureCache of dataset. Batches then hold its
+        backbone outputs in place of the images.
+    seed: Seed of the shuffling, the same in all processes.
+    """
+    data = Dataset(dataset, config, augment=augment, features=features)
+    kwargs = {}
+    if config.DATA_LOADER_WORKERS > 0:
+        kwargs["prefetch_factor"] = config.DATA_LOADER_PREFETCH_FACTOR
+        kwargs["persistent_workers"] = config.DATA_LOADER_PERSISTENT_WORKERS
+    # Without ASPECT_RATIO_GROUPING, all images are in bucket -1. The
+    # sampler then batches them like a shuffled DataLoader would, with an
+    # order that only depends on the seed and the epoch, so that epochs
+    # can be resumed.
+    batch_sampler = AspectRatioBatchSampler(
+        data.image_buckets, config.BATCH_SIZE, shuffle=shuffle, seed=seed,
+        rank=rank, world_size=world_size)
+    return torch.utils.data.DataLoader(
+        data,
+        batch_sampler=batch_sampler,
+        num_workers=config.DATA_LOADER_WORKERS,
+        pin_memory=config.DATA_LOADER_PIN_MEMORY,
+        collate_fn=collate_samples, **kwargs)
+
+
+def set_sampler_epoch(generator, epoch, start=0):
+    """Sets the epoch that the sampler of a data_generator() shuffles
+    for. Processes of distributed training must agree on it. The first
+    start batches of the epoch are skipped, to resume it.
+    """
+    generator.batch_sampler.set_epoch(epoch, start)
+
+
+############################################################
+#  Aspect Ratio Grouping
+############################################################
+
+def aspect_ratio_bucket(config, height, width):
+    """Returns the index of the ASPECT_RATIO_BUCKETS bucket that images of
+    the given height and width fall in. Works on scalars and arrays.
+    """
+    aspect_ratio = np.asarray(width, dtype=np.float64) / np.asarray(height, dtype=np.float64)
+    boundaries = np.asarray(config.ASPECT_RATIO_BUCKETS, dtype=np.float64)
+    # Aspect ratios on a boundary go to the bucket with the smaller shape:
+    # the one above for landscape images, the one below for portrait ones.
+    return np.where(aspect_ratio >= 1,
+                    np.searchsorted(boundaries, aspect_ratio, side="right"),
+                    np.searchsorted(boundaries, aspect_ratio, side="left"))
+
+
+def bucket_image_shape(config, bucket):
+    """Returns the padded (height, width) of the images of an aspect ratio
+    bucket, or of IMAGE_SHAPE if bucket is -1.
+
+    resize_image() keeps the longest side within IMAGE_MAX_DIM, so an
+    image with aspect ratio a (width / height) is at most
+    IMAGE_MAX_DIM / max(a, 1) high and IMAGE_MAX_DIM * min(a, 1) wide. The lowest and highest aspect ratio
+    of the bucket bound its height and width. Both are rounded up to a
+    multiple of 64 so the FPN levels line up.
+    """
+    max_dim = config.IMAGE_MAX_DIM
+    if bucket < 0:
+        return (int(config.IMAGE_SHAPE[0]), int(config.IMAGE_SHAPE[1]))
+    boundaries = [0] + list(config.ASPECT_RATIO_BUCKETS) + [np.inf]
+    low, high = boundaries[bucket], boundaries[bucket + 1]
+    height = int(math.ceil(max_dim / max(low, 1) / 64)) * 64
+    width = int(math.ceil(max_dim * min(high, 1) / 64)) * 64
+    return (height, width)
+
+
+def compute_aspect_ratio_buckets(dataset, config):
+    """Returns the aspect ratio bucket of each image of a utils.Dataset,
+    in the order of its image_ids, from the width and height in its
+    image_info. Images without them get -1.
+    """
+    buckets = np.full([dataset.num_images], -1, dtype=np.int32)
+    try:
+        heights = np.array(dataset.image_info.column("height"), dtype=np.float64)[dataset.image_ids]
+        widths = np.array(dataset.image_info.column("width"), dtype=np.float64)[dataset.image_ids]
+    except KeyError:
+        return buckets
+    known = (heights > 0) & (widths > 0)
+    buckets[known] = aspect_ratio_bucket(config, heights[known], widths[known])
+    return buckets
+
+
+class AspectRatioBatchSampler(torch.utils.data.Sampler):
+    """Yields batches of dataset indices whose images all fall in the same
+    aspect ratio bucket, so they can be padded to one shape.
+
+    Indices are visited in random order and added to the batch of their
+    bucket. A batch is yielded once it's full, so batches come in the same
+    random order as single images would. What's left in partial batches
+    is yielded at the end of the epoch.
+
+    buckets: [num_images] Aspect ratio bucket of each image.
+    batch_size: Number of images per batch.
+    shuffle: If True, visits the images in a different random order every
+        epoch.
+    seed: Seed of the shuffling. The order of an epoch only depends on
+        seed and the epoch number set with set_epoch().
+    rank, world_size: In distributed training, each process takes every
+        world_size-th batch, starting at its rank. Batches from the start
+        of the epoch are repeated so that all processes get as many.
+    """
+
+    def __init__(self, buckets, batch_size, shuffle=True, seed=0, rank=0, world_size=1):
+        self.buckets = np.asarray(buckets)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """Sets the epoch of the next iteration, which skips its first
+        start batches.
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.buckets))
+        else:
+            order = np.arange(len(self.buckets))
+        # Epochs advance on their own unless set_epoch() is called
+        self.epoch += 1
+
+        batches = []
+        partial = {}
+        for index in order:
+            batch = partial.setdefault(self.buckets[index], [])
+            batch.append(int(index))
+            if len(batch) == self.batch_size:
+                batches.append(batch)
+                partial[self.buckets[index]] = []
+        batches.extend(batch for batch in partial.values() if batch)
+
+        if self.world_size > 1:
+            padding = -len(batches) % self.world_size
+            batches.extend(batches[i % len(batches)] for i in range(padding))
+            batches = batches[self.rank::self.world_size]
+        start, self.start = self.start, 0
+        return iter(batches[start:])
+
+    def __len__(self):
+        _, counts = np.unique(self.buckets, return_counts=True)
+        num_batches = int(np.sum((counts + self.batch_size - 1) // self.batch_size))
+        return -(-num_batches // self.world_size)
+
+
+def compute_backbone_shapes(config, image_shape):
+    """Returns the [height, width] of each stage of the backbone for
+    input images of the given shape.
+    """
+    return np.array(
+        [[int(math.ceil(image_shape[0] / stride)),
+          int(math.ceil(image_shape[1] / stride))]
+         for stride in config.BACKBONE_STRIDES])
+
+
+def generate_anchors(config, image_shape):
+    """Returns the anchors of input images of the given shape.
+    [anchor_count, (y1, x1, y2, x2)] in pixels.
+    """
+    return utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                          config.RPN_ANCHOR_RATIOS,
+                                          compute_backbone_shapes(config, image_shape),
+                                          config.BACKBONE_STRIDES,
+                                          config.RPN_ANCHOR_STRIDE)
+
+
+############################################################
+#  Feature Cache
+############################################################
+
+class FeatureCache(object):
+    """Outputs of the ResNet stages C2 to C5 for every image of a dataset,
+    and optionally of its horizontal flip, as written by
+    MaskRCNN.build_feature_cache().
+
+    When the backbone is frozen (layers='heads'), training from the cache
+    only runs the FPN top-down layers and the heads. The features are
+    float16 and stored back to back in one memory-mapped file, so data
+    loader workers only read the entries of their batches.
+
+    A cache holds the features of one set of backbone weights, with the
+    image sizes and aspect ratio buckets of one config.
+
+    path: Directory of the cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index = np.load(os.path.join(path, "index.npz"))
+        self.image_ids = index["image_ids"]
+        # [image, flip, level] start and shape of each feature map
+        self.offsets = index["offsets"]
+        self.shapes = index["shapes"]
+        self.weights_digest = str(index["weights_digest"])
+        self.data = None
+
+    def __getstate__(self):
+        # Data loader workers map the file themselves
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def load(self, image_index, flip=False):
+        """Returns the [channels, height, width] float16 outputs of C2 to
+        C5 of an image of the dataset.
+        """
+        if self.data is None:
+            self.data = np.memmap(os.path.join(self.path, "features.bin"),
+                                  dtype=np.float16, mode="r")
+        return [np.array(self.data[start:start + np.prod(shape)]).reshape(shape)
+                for start, shape in zip(self.offsets[image_index, int(flip)],
+                                        self.shapes[image_index, int(flip)])]
+
+    def check(self, image_ids, image_shapes, config, flip=False):
+        """Raises an exception unless the cache has the features of the
+        given images, padded to image_shapes [(height, width)], and of their
+        flips if flip is True.
+        """
+        if not np.array_equal(self.image_ids, image_ids):
+            raise Exception("Feature cache {} was built for other images.".format(self.path))
+        if flip and self.offsets.shape[1] < 2:
+            raise Exception("Feature cache {} has no flipped images. Build it with "
+                            "flip=True to train with augmentation.".format(self.path))
+        cached_shapes = self.shapes[:, 0, 0, 1:] * config.BACKBONE_STRIDES[0]
+        if not np.array_equal(cached_shapes, np.array(image_shapes).reshape(-1, 2)):
+            raise Exception("Feature cache {} was built for other image sizes.".format(self.path))
+
+
+############################################################
+#  Checkpoints
+############################################################
+
+def snapshot(state):
+    """Returns a copy of a state dict, or of nested dicts and lists of
+    them, with every tensor copied to host memory. Training can go on
+    changing the original while the copy is saved.
+    """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def state_digest(state):
+    """Returns a hex digest of the names and values of the tensors of a
+    state dict.
+    """
+    digest = hashlib.sha1()
+    for name, tensor in sorted(state.items()):
+        digest.update(name.encode())
+        digest.update(tensor.cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def full_state(state, directory):
+    """Returns the state dict of a checkpoint. A delta checkpoint of
+    MaskRCNN.delta_state() is completed with the weights of its base file,
+    which must be in directory.
+    """
+    if "base_digest" not in state:
+        return state
+    base_path = os.path.join(directory, state["base"])
+    base = torch.load(base_path, map_location="cpu")
+    if state_digest(base) != state["base_digest"]:
+        raise Exception("Base weights {} don't match the checkpoint.".format(base_path))
+    base.update(state["delta"])
+    return base
+
+
+def get_rng_state():
+    """Returns the state of the random number generators of Python, numpy
+    and torch (CPU and GPUs).
+    """
+    state = {"python": random.getstate(), "numpy": np.random.get_state(),
+             "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restores random number generator states from get_rng_state()."""
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointWriter(object):
+    """Saves checkpoints in a background thread so that training doesn't
+    wait for the disk.
+
+    save() takes a snapshot() of the state in host memory and returns. At
+    most one more save waits behind the one being written. Files are
+    written under a temporary name and renamed once complete, so a
+    checkpoint file is never partially written. Write errors are raised
+    by the next save(), wait() or close().
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            state, path = item
+            try:
+                temp_path = path + ".tmp"
+                torch.save(state, temp_path)
+                os.replace(temp_path, path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def save(self, state, path):
+        self.check()
+        self.queue.put((snapshot(state), path))
+
+    def wait(self):
+        """Blocks until all checkpoints are written."""
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """Writes the pending checkpoints and stops the thread."""
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+############################################################
+#  Distributed Training
+############################################################
+
+def init_distributed(config):
+    """Joins the process group of a multi-process launch if the config has
+    a DISTRIBUTED_BACKEND, and returns the (rank, world_size) of this
+    process, or (0, 1) if it runs alone.
+
+    The launch is described by the RANK, WORLD_SIZE, LOCAL_RANK,
+    MASTER_ADDR and MASTER_PORT environment variables that torchrun sets.
+    With GPUs, each process uses the GPU of its LOCAL_RANK. A process
+    group that was initialized already is used as it is.
+    """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    if not config.DISTRIBUTED_BACKEND or int(os.environ.get("WORLD_SIZE", 1)) == 1:
+        return 0, 1
+    if config.GPU_COUNT:
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+    dist.init_process_group(backend=config.DISTRIBUTED_BACKEND, init_method="env://")
+    return dist.get_rank(), dist.get_world_size()
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1411,6 +2239,7 @@ class MaskRCNN(nn.Module):
         super(MaskRCNN, self).__init__()
         self.config = config
         self.model_dir = model_dir
+        self.rank, self.world_size = init_distributed(config)
         self.set_log_dir()
         self.build(config=config)
         self.initialize_weights()
@@ -1428,6 +2257,13 @@ class MaskRCNN(nn.Module):
                             "to avoid fractions when downscaling and upscaling."
                             "For example, use 256, 320, 384, 448, 512, ... etc. ")
 
+        if config.PRECISION not in ("fp32", "bf16"):
+            raise Exception("PRECISION must be 'fp32' or 'bf16', not {!r}".format(config.PRECISION))
+
+        unknown = set(config.GRADIENT_CHECKPOINTING) - {"C1", "C2", "C3", "C4", "C5", "fpn", "mask"}
+        if unknown:
+            raise Exception("Unknown GRADIENT_CHECKPOINTING parts: {}".format(sorted(unknown)))
+
         # Build the shared convolutional layers.
         # Bottom-up Layers
         # Returns a list of the last layers of each stage, 5 in total.
@@ -1437,9 +2273,12 @@ class MaskRCNN(nn.Module):
 
         # Top-down Layers
         # TODO: add assert to varify feature map sizes match what's in config
-        self.fpn = FPN(C1, C2, C3, C4, C5, out_channels=256)
+        self.fpn = FPN(C1, C2, C3, C4, C5, out_channels=256,
+                       checkpoints=config.GRADIENT_CHECKPOINTING)
 
         # Generate Anchors
+        # Anchors of other input shapes (aspect ratio buckets) are
+        # generated on first use by get_anchors().
         self.anchors = Variable(torch.from_numpy(utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
                                                                                 config.RPN_ANCHOR_RATIOS,
                                                                                 config.BACKBONE_SHAPES,
@@ -1447,6 +2286,13 @@ class MaskRCNN(nn.Module):
                                                                                 config.RPN_ANCHOR_STRIDE)).float(), requires_grad=False)
         if self.config.GPU_COUNT:
             self.anchors = self.anchors.cuda()
+        self.anchor_cache = {tuple(int(d) for d in config.IMAGE_SHAPE[:2]): self.anchors}
+
+        # Mean pixel, subtracted from the input images in predict()
+        self.mean_pixel = Variable(torch.from_numpy(config.MEAN_PIXEL).float().view(1, 3, 1, 1),
+                                   requires_grad=False)
+        if self.config.GPU_COUNT:
+            self.mean_pixel = self.mean_pixel.cuda()
 
         # RPN
         self.rpn = RPN(len(config.RPN_ANCHOR_RATIOS), config.RPN_ANCHOR_STRIDE, 256)
@@ -1455,7 +2301,8 @@ class MaskRCNN(nn.Module):
         self.classifier = Classifier(256, config.POOL_SIZE, config.IMAGE_SHAPE, config.NUM_CLASSES)
 
         # FPN Mask
-        self.mask = Mask(256, config.MASK_POOL_SIZE, config.IMAGE_SHAPE, config.NUM_CLASSES)
+        self.mask = Mask(256, config.MASK_POOL_SIZE, config.IMAGE_SHAPE, config.NUM_CLASSES,
+                         checkpoint="mask" in config.GRADIENT_CHECKPOINTING)
 
         # Fix batch norm layers
         def set_bn_fix(m):
@@ -1528,6 +2375,11 @@ class MaskRCNN(nn.Module):
         self.checkpoint_path = self.checkpoint_path.replace(
             "*epoch*", "{:04d}")
 
+        # Checkpoint to resume training from, with the optimizer, RNG and
+        # data loader state. find_last() doesn't pick it.
+        self.resume_path = os.path.join(self.log_dir, "resume_{}.pth".format(
+            self.config.NAME.lower()))
+
     def find_last(self):
         """Finds the last checkpoint file of the last trained model in the
         model directory.
@@ -1560,64 +2412,99 @@ class MaskRCNN(nn.Module):
         exlude: list of layer names to excluce
         """
         if os.path.exists(filepath):
-            self.load_state_dict(torch.load(filepath))
+            self.load_state_dict(full_state(torch.load(filepath), os.path.dirname(filepath)))
         else:
             print("Weight file not found ...")
 
         # Update the log directory
         self.set_log_dir(filepath)
-        if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir)
+        os.makedirs(self.log_dir, exist_ok=True)
 
-    def detect(self, images):
+    def detect(self, images, profile=False):
         """Runs the detection pipeline.
 
-        images: List of images, potentially of different sizes.
+        images: List of images, potentially of different sizes, or paths of
+            image files.
+        profile: If True, add the time spent in each stage to the results.
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
         masks: [H, W, N] instance binary masks
+        timing: With profile=True, a dict of seconds spent in mold_inputs,
+            copy (to and from the GPU), the predict() stages fpn, rpn,
+            proposal_layer, classifier, detection_layer and mask, and
+            unmold_detections. Stages named "<stage>.<part>" are part of
+            the time of <stage>: the sort and NMS of proposal_layer, the
+            ROIAlign of the classifier and mask heads and the per-class NMS
+            of detection_layer. unmold_detections is the time of the image
+            itself, the other stages run once for all images and give the
+            time of the whole batch. total is the time from the call until
+            the results of the image were ready.
         """
+        timer = StageTimer(enabled=profile, cuda=bool(self.config.GPU_COUNT))
+        start = time.perf_counter()
 
         # Mold inputs to format expected by the neural network
-        molded_images, image_metas, windows = self.mold_inputs(images)
+        with timer("mold_inputs"):
+            molded_images, image_metas, windows = self.mold_inputs(images)
 
-        # Convert images to torch tensor
-        molded_images = torch.from_numpy(molded_images.transpose(0, 3, 1, 2)).float()
+        with timer("copy"):
+            # Convert images to torch tensor
+            molded_images = torch.from_numpy(molded_images)
 
-        # To GPU
-        if self.config.GPU_COUNT:
-            molded_images = molded_images.cuda()
+            # To GPU
+            if self.config.GPU_COUNT:
+                molded_images = molded_images.cuda()
 
         # Wrap in variable
         molded_images = Variable(molded_images, volatile=True)
 
         # Run object detection
-        detections, mrcnn_mask = self.predict([molded_images, image_metas], mode='inference')
+        detections, mrcnn_mask = self.predict([molded_images, image_metas], mode='inference', timer=timer)
 
         # Convert to numpy
-        detections = detections.data.cpu().numpy()
-        mrcnn_mask = mrcnn_mask.permute(0, 1, 3, 4, 2).data.cpu().numpy()
+        with timer("copy"):
+            detections = detections.data.cpu().numpy()
+            mrcnn_mask = mrcnn_mask.data.cpu().numpy()
 
         # Process detections
         results = []
+        _, image_shapes, _, _ = parse_image_meta(image_metas)
         for i, image in enumerate(images):
-            final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, windows[i])
+            image_timer = StageTimer(enabled=profile)
+            with image_timer("unmold_detections"):
+                final_rois, final_class_ids, final_scores, final_masks =\
+                    self.unmold_detections(detections[i], mrcnn_mask[i],
+                                           image_shapes[i], windows[i])
             results.append({
                 "rois": final_rois,
                 "class_ids": final_class_ids,
                 "scores": final_scores,
                 "masks": final_masks,
             })
+            if profile:
+                timing = dict(timer.times, **image_timer.times)
+                timing["total"] = time.perf_counter() - start
+                results[-1]["timing"] = timing
         return results
 
-    def predict(self, input, mode):
+    def forward(self, input, mode, timer=None):
+        """Same as predict(). Wrappers such as DistributedDataParallel run
+        the model through it.
+        """
+        return self.predict(input, mode, timer=timer)
+
+    def predict(self, input, mode, timer=None):
+        """timer: Optional StageTimer that times the stages of the forward
+        pass: fpn, rpn, proposal_layer, rpn_targets, detection_target_layer,
+        classifier, detection_layer and mask. Stages named
+        "<stage>.<part>" time a part of a stage.
+        """
         molded_images = input[0]
         image_metas = input[1]
+        timer = timer or NO_TIMER
 
         if mode == 'inference':
             self.eval()
@@ -1632,64 +2519,113 @@ class MaskRCNN(nn.Module):
 
             self.apply(set_bn_eval)
 
-        # Feature extraction
-        [p2_out, p3_out, p4_out, p5_out, p6_out] = self.fpn(molded_images)
-
-        # Note that P6 is used in RPN, but not in the classifier heads.
-        rpn_feature_maps = [p2_out, p3_out, p4_out, p5_out, p6_out]
-        mrcnn_feature_maps = [p2_out, p3_out, p4_out, p5_out]
-
-        # Loop through pyramid layers
-        layer_outputs = []  # list of lists
-        for p in rpn_feature_maps:
-            layer_outputs.append(self.rpn(p))
+        with self.autocast():
+            # Feature extraction
+            # Images come in as uint8 [batch, height, width, 3]. Convert them to
+            # float [batch, 3, height, width] and subtract the mean pixel.
+            # Batches from a FeatureCache hold the outputs of C2 to C5 instead.
+            with timer("fpn"):
+                if isinstance(molded_images, (list, tuple)):
+                    backbone_maps = [c.float() for c in molded_images]
+                else:
+                    molded_images = molded_images.permute(0, 3, 1, 2).float() - self.mean_pixel
+                    backbone_maps = self.fpn.bottom_up(molded_images)
+                [p2_out, p3_out, p4_out, p5_out, p6_out] = self.fpn.top_down(*backbone_maps)
+
+            # Note that P6 is used in RPN, but not in the classifier heads.
+            rpn_feature_maps = [p2_out, p3_out, p4_out, p5_out, p6_out]
+
+            # Loop through pyramid layers
+            layer_outputs = []  # list of lists
+            with timer("rpn"):
+                for p in rpn_feature_maps:
+                    layer_outputs.append(self.rpn(p))
+
+        # The heads crop ROIs from float32 feature maps. Box decoding, NMS
+        # and the losses get float32 RPN outputs.
+        mrcnn_feature_maps = [p.float() for p in [p2_out, p3_out, p4_out, p5_out]]
 
         # Concatenate layer outputs
         # Convert from list of lists of level outputs to list of lists
         # of outputs across levels.
         # e.g. [[a1, b1, c1], [a2, b2, c2]] => [[a1, a2], [b1, b2], [c1, c2]]
-        outputs = list(zip(*layer_outputs))
-        outputs = [torch.cat(list(o), dim=1) for o in outputs]
+        with timer("rpn"):
+            outputs = list(zip(*layer_outputs))
+            outputs = [torch.cat(list(o), dim=1).float() for o in outputs]
         rpn_class_logits, rpn_class, rpn_bbox = outputs
 
         # Generate proposals
-        # Proposals are [batch, N, (y1, x1, y2, x2)] in normalized coordinates
-        # and zero padded.
+        # Proposals are [N, (y1, x1, y2, x2)] in normalized coordinates,
+        # one tensor per image in the batch.
         proposal_count = self.config.POST_NMS_ROIS_TRAINING if mode == "training" \
             else self.config.POST_NMS_ROIS_INFERENCE
-        rpn_rois = proposal_layer([rpn_class, rpn_bbox],
-                                 proposal_count=proposal_count,
-                                 nms_threshold=self.config.RPN_NMS_THRESHOLD,
-                                 anchors=self.anchors,
-                                 config=self.config)
+        batch_size = backbone_maps[0].size()[0]
+        image_shape = tuple(d * self.config.BACKBONE_STRIDES[0] for d in backbone_maps[0].size()[2:])
+        anchors = self.get_anchors(image_shape)
+        with timer("proposal_layer"):
+            rpn_rois = [proposal_layer([rpn_class[b:b+1], rpn_bbox[b:b+1]],
+                                       proposal_count=proposal_count,
+                                       nms_threshold=self.config.RPN_NMS_THRESHOLD,
+                                       anchors=anchors,
+                                       config=self.config,
+                                       image_shape=image_shape,
+                                       timer=timer).squeeze(0)
+                        for b in range(batch_size)]
+
+        h, w = image_shape
+        scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False)
+        if self.config.GPU_COUNT:
+            scale = scale.cuda()
 
         if mode == 'inference':
             # Network Heads
-            # Proposal classifier and BBox regressor heads
-            mrcnn_class_logits, mrcnn_class, mrcnn_bbox = self.classifier(mrcnn_feature_maps, rpn_rois)
+            # Proposal classifier and BBox regressor heads. The ROIs of all
+            # images go through the heads together.
+            rois, roi_image_ids = self.concat_rois(rpn_rois)
+            with timer("classifier"), self.autocast():
+                mrcnn_class_logits, mrcnn_class, mrcnn_bbox = self.classifier(mrcnn_feature_maps, rois, roi_image_ids, image_shape, timer)
+            mrcnn_class, mrcnn_bbox = mrcnn_class.float(), mrcnn_bbox.float()
 
             # Detections
-            # output is [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in image coordinates
-            detections = detection_layer(self.config, rpn_rois, mrcnn_class, mrcnn_bbox, image_metas)
+            # output is [num_detections, (y1, x1, y2, x2, class_id, score)] in image coordinates,
+            # one tensor per image.
+            detections = []
+            start = 0
+            with timer("detection_layer"):
+                for b in range(batch_size):
+                    end = start + rpn_rois[b].size()[0]
+                    detections.append(detection_layer(self.config, rpn_rois[b].unsqueeze(0),
+                                                      mrcnn_class[start:end], mrcnn_bbox[start:end],
+                                                      image_metas[b:b+1], image_shape, timer))
+                    start = end
 
             # Convert boxes to normalized coordinates
             # TODO: let DetectionLayer return normalized coordinates to avoid
             #       unnecessary conversions
-            h, w = self.config.IMAGE_SHAPE[:2]
-            scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False)
-            if self.config.GPU_COUNT:
-                scale = scale.cuda()
-            detection_boxes = detections[:, :4] / scale
-
-            # Add back batch dimension
-            detection_boxes = detection_boxes.unsqueeze(0)
-
-            # Create masks for detections
-            mrcnn_mask = self.mask(mrcnn_feature_maps, detection_boxes)
-
-            # Add back batch dimension
-            detections = detections.unsqueeze(0)
-            mrcnn_mask = mrcnn_mask.unsqueeze(0)
+            detection_boxes, detection_image_ids = self.concat_rois(
+                [d[:, :4] / scale for d in detections])
+
+            # Create masks for detections, only that of the detected class
+            if detection_boxes.size()[0]:
+                detection_class_ids = torch.cat([d[:, 4] for d in detections]).long()
+                with timer("mask"), self.autocast():
+                    mrcnn_mask = self.mask(mrcnn_feature_maps, detection_boxes, detection_image_ids,
+                                           image_shape, timer, detection_class_ids)
+                mrcnn_mask = mrcnn_mask.float()
+            else:
+                mrcnn_mask = Variable(detection_boxes.data.new(
+                    0, self.config.MASK_SHAPE[0], self.config.MASK_SHAPE[1]))
+
+            # Split masks by image and zero pad both outputs to
+            # [batch, max detections, ...]
+            count = max(d.size()[0] for d in detections)
+            masks = []
+            start = 0
+            for d in detections:
+                masks.append(mrcnn_mask[start:start + d.size()[0]])
+                start += d.size()[0]
+            detections = Variable(pad_instances([d.data for d in detections], count), volatile=True)
+            mrcnn_mask = Variable(pad_instances([m.data for m in masks], count), volatile=True)
 
             return [detections, mrcnn_mask]
 
@@ -1698,42 +2634,201 @@ class MaskRCNN(nn.Module):
             gt_class_ids = input[2]
             gt_boxes = input[3]
             gt_masks = input[4]
+            rpn_indices, rpn_labels, rpn_target_bbox = input[5:8]
+
+            # RPN Targets, unless the data loader built them
+            # (RPN_TARGETS_ON_DEVICE is False).
+            if rpn_indices is None:
+                with timer("rpn_targets"):
+                    rpn_indices, rpn_labels, rpn_target_bbox = \
+                        rpn_target_layer(anchors, gt_class_ids, gt_boxes, self.config)
+
+            with timer("detection_target_layer"):
+                # Unpack the bit-packed GT masks
+                mask_shape = self.config.MINI_MASK_SHAPE if self.config.USE_MINI_MASK else image_shape
+                gt_masks = unpack_masks(gt_masks, mask_shape)
+
+                # Normalize coordinates
+                gt_boxes = gt_boxes / scale
+
+                # Generate detection targets
+                # Subsamples proposals and generates target outputs for training.
+                # Proposals and GT instances are zero padded to the same count in
+                # each image of the batch. Every image gets TRAIN_ROIS_PER_IMAGE
+                # ROI slots, target_valid marks the ones in use.
+                proposal_count = max(r.size()[0] for r in rpn_rois)
+                proposals = Variable(pad_instances([r.data for r in rpn_rois], proposal_count),
+                                     requires_grad=False)
+                rois, target_class_ids, target_deltas, target_mask, target_valid = \
+                    detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, self.config)
+
+            # The ROI slots of all images go through the heads together
+            roi_count = rois.size()[1]
+            roi_image_ids = Variable(torch.arange(0, batch_size).int().view(-1, 1)
+                                     .expand(batch_size, roi_count).contiguous().view(-1),
+                                     requires_grad=False)
+            if self.config.GPU_COUNT:
+                roi_image_ids = roi_image_ids.cuda()
+            rois = rois.view(-1, 4)
+            target_class_ids = target_class_ids.view(-1)
+            target_valid = target_valid.view(-1)
+            target_deltas = target_deltas.view(-1, 4)
+            target_mask = target_mask.view(-1, *self.config.MASK_SHAPE)
+
+            # Network Heads
+            # Proposal classifier and BBox regressor heads
+            with self.autocast():
+                with timer("classifier"):
+                    mrcnn_class_logits, mrcnn_class, mrcnn_bbox = self.classifier(mrcnn_feature_maps, rois, roi_image_ids, image_shape, timer)
+
+                # Create masks for detections, only that of the target class
+                # of each ROI, the one the loss uses
+                with timer("mask"):
+                    mrcnn_mask = self.mask(mrcnn_feature_maps, rois, roi_image_ids, image_shape, timer,
+                                           target_class_ids)
+            mrcnn_class_logits, mrcnn_bbox, mrcnn_mask = \
+                mrcnn_class_logits.float(), mrcnn_bbox.float(), mrcnn_mask.float()
+
+            return [rpn_indices, rpn_labels, rpn_target_bbox, rpn_class_logits, rpn_bbox, target_class_ids, target_valid, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask]
+
+    def trace(self, path):
+        """Returns a context manager that writes a ChromeTrace of the calls
+        of every submodule and of the proposal, ROIAlign, detection,
+        target and NMS functions made in it to the file path.
+
+            with model.trace("trace.json"):
+                model.detect([image])
+        """
+        return ChromeTrace(self, path, cuda=bool(self.config.GPU_COUNT))
 
-            # Normalize coordinates
-            h, w = self.config.IMAGE_SHAPE[:2]
-            scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False)
+    def autocast(self):
+        """Returns a context manager that runs the layers in it with the
+        reduced precision of config.PRECISION, if any.
+        """
+        return torch.autocast(device_type="cuda" if self.config.GPU_COUNT else "cpu",
+                              dtype=torch.bfloat16,
+                              enabled=self.config.PRECISION == "bf16")
+
+    def get_anchors(self, image_shape):
+        """Returns the anchors of input images of the given (height, width)
+        as a [anchor_count, (y1, x1, y2, x2)] Variable.
+        """
+        image_shape = tuple(int(d) for d in image_shape[:2])
+        if image_shape not in self.anchor_cache:
+            anchors = Variable(torch.from_numpy(generate_anchors(self.config, image_shape)).float(),
+                               requires_grad=False)
             if self.config.GPU_COUNT:
-                scale = scale.cuda()
-            gt_boxes = gt_boxes / scale
-
-            # Generate detection targets
-            # Subsamples proposals and generates target outputs for training
-            # Note that proposal class IDs, gt_boxes, and gt_masks are zero
-            # padded. Equally, returned rois and targets are zero padded.
-            rois, target_class_ids, target_deltas, target_mask = \
-                detection_target_layer(rpn_rois, gt_class_ids, gt_boxes, gt_masks, self.config)
-
-            if not rois.size():
-                mrcnn_class_logits = Variable(torch.FloatTensor())
-                mrcnn_class = Variable(torch.IntTensor())
-                mrcnn_bbox = Variable(torch.FloatTensor())
-                mrcnn_mask = Variable(torch.FloatTensor())
-                if self.config.GPU_COUNT:
-                    mrcnn_class_logits = mrcnn_class_logits.cuda()
-                    mrcnn_class = mrcnn_class.cuda()
-                    mrcnn_bbox = mrcnn_bbox.cuda()
-                    mrcnn_mask = mrcnn_mask.cuda()
-            else:
-                # Network Heads
-                # Proposal classifier and BBox regressor heads
-                mrcnn_class_logits, mrcnn_class, mrcnn_bbox = self.classifier(mrcnn_feature_maps, rois)
+                anchors = anchors.cuda()
+            self.anchor_cache[image_shape] = anchors
+        return self.anchor_cache[image_shape]
 
-                # Create masks for detections
-                mrcnn_mask = self.mask(mrcnn_feature_maps, rois)
+    def concat_rois(self, rois):
+        """Concatenates per-image lists of boxes.
 
-            return [rpn_class_logits, rpn_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask]
+        rois: list of [N, (y1, x1, y2, x2)], one per image in the batch.
+              Empty images can be given as empty tensors of any shape.
 
-    def train_model(self, train_dataset, val_dataset, learning_rate, epochs, layers):
+        Returns:
+        boxes: [total N, (y1, x1, y2, x2)]
+        image_ids: [total N] Index of the image each box came from.
+        """
+        boxes = [r for r in rois if r.dim() and r.size()[0]]
+        image_ids = [torch.IntTensor(r.size()[0]).fill_(b)
+                     for b, r in enumerate(rois) if r.dim() and r.size()[0]]
+        if boxes:
+            boxes = torch.cat(boxes, dim=0)
+            image_ids = torch.cat(image_ids, dim=0)
+        else:
+            boxes = Variable(torch.zeros(0, 4))
+            image_ids = torch.IntTensor(0)
+        image_ids = Variable(image_ids, requires_grad=False)
+        if self.config.GPU_COUNT:
+            boxes = boxes.cuda()
+            image_ids = image_ids.cuda()
+        return boxes, image_ids
+
+    def backbone_digest(self):
+        """Returns a hex digest of the weights of the ResNet stages."""
+        return state_digest({name: tensor for name, tensor in self.fpn.state_dict().items()
+                             if re.match(r"C\d\.", name)})
+
+    def build_feature_cache(self, dataset, path, flip=True):
+        """Runs the ResNet stages on every image of a dataset, and on its
+        horizontal flip if flip is True, and stores their outputs in a
+        FeatureCache in the directory path. A cache that's in path already
+        is reused if it was built with the current backbone weights.
+
+        Images are resized and padded as in training, so build the cache
+        with the config of the training. The cache takes 2 bytes per value
+        of C2 to C5, about 62MB per 1024x1024 image and flip, so it's meant
+        for a subset of a large dataset, see utils.Dataset.select_images().
+        Raises an exception before writing anything if the disk of path
+        doesn't have room for it.
+
+        Returns the FeatureCache.
+        """
+        index_path = os.path.join(path, "index.npz")
+        weights_digest = self.backbone_digest()
+        if self.rank == 0 and not os.path.exists(index_path):
+            os.makedirs(path, exist_ok=True)
+            if self.config.ASPECT_RATIO_GROUPING:
+                buckets = compute_aspect_ratio_buckets(dataset, self.config)
+            else:
+                buckets = np.full([dataset.num_images], -1, dtype=np.int32)
+            flips = [False, True] if flip else [False]
+            # C2 to C5 have 256 to 2048 channels at strides 4 to 32
+            values_per_pixel = sum(256 * 2 ** k / stride ** 2
+                                   for k, stride in enumerate(self.config.BACKBONE_STRIDES[:4]))
+            pixels = sum(np.prod(bucket_image_shape(self.config, b)) for b in buckets)
+            size = int(2 * values_per_pixel * pixels * len(flips))
+            free = shutil.disk_usage(path).free
+            if size > free:
+                raise Exception("Feature cache of {} images needs {:.1f}GB, but {} has {:.1f}GB free. "
+                                "Cache a subset of the images.".format(
+                                    dataset.num_images, size / 1e9, path, free / 1e9))
+            offsets = np.zeros([dataset.num_images, len(flips), 4], dtype=np.int64)
+            shapes = np.zeros([dataset.num_images, len(flips), 4, 3], dtype=np.int64)
+            self.eval()
+            start = 0
+            # No autograd graph: the outputs are only copied to the file
+            with open(os.path.join(path, "features.bin"), "wb") as f, torch.no_grad():
+                for i, image_id in enumerate(dataset.image_ids):
+                    image = dataset.load_image_resized(
+                        image_id,
+                        min_dim=self.config.IMAGE_MIN_DIM,
+                        max_dim=self.config.IMAGE_MAX_DIM,
+                        padding=self.config.IMAGE_PADDING,
+                        padded_shape=bucket_image_shape(self.config, buckets[i]))[0]
+                    for j, flipped in enumerate(flips):
+                        images = np.fliplr(image) if flipped else image
+                        images = torch.from_numpy(np.ascontiguousarray(images)).unsqueeze(0)
+                        if self.config.GPU_COUNT:
+                            images = images.cuda()
+                        images = images.permute(0, 3, 1, 2).float() - self.mean_pixel
+                        for k, c in enumerate(self.fpn.bottom_up(images)):
+                            c = c.data.cpu().numpy()[0].astype(np.float16)
+                            if not np.isfinite(c).all():
+                                raise Exception("Backbone outputs of image {} exceed the float16 "
+                                                "range and can't be cached.".format(image_id))
+                            offsets[i, j, k] = start
+                            shapes[i, j, k] = c.shape
+                            f.write(c.tobytes())
+                            start += c.size
+                    printProgressBar(i + 1, dataset.num_images, prefix="Caching features", length=10)
+            # The index is written last. It marks a complete cache.
+            np.savez(index_path, image_ids=dataset.image_ids, offsets=offsets,
+                     shapes=shapes, weights_digest=weights_digest)
+
+        # The other processes wait for the first one to write the cache
+        if self.world_size > 1:
+            dist.barrier()
+        features = FeatureCache(path)
+        if features.weights_digest != weights_digest:
+            raise Exception("Feature cache {} was built with other backbone weights.".format(path))
+        return features
+
+    def train_model(self, train_dataset, val_dataset, learning_rate, epochs, layers,
+                    train_features=None, val_features=None):
         """Train the model.
         train_dataset, val_dataset: Training and validation Dataset objects.
         learning_rate: The learning rate to train with
@@ -1749,6 +2844,9 @@ class MaskRCNN(nn.Module):
               3+: Train Resnet stage 3 and up
               4+: Train Resnet stage 4 and up
               5+: Train Resnet stage 5 and up
+        train_features, val_features: Optional FeatureCache objects of the
+            datasets, from build_feature_cache(). The ResNet stages don't
+            run on their images then, so layers must leave them frozen.
         """
 
         # Pre-defined layer regular expressions
@@ -1765,17 +2863,58 @@ class MaskRCNN(nn.Module):
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
-        # Data generators
-        train_set = Dataset(train_dataset, self.config, augment=True)
-        train_generator = torch.utils.data.DataLoader(train_set, batch_size=1, shuffle=True, num_workers=4)
-        val_set = Dataset(val_dataset, self.config, augment=True)
-        val_generator = torch.utils.data.DataLoader(val_set, batch_size=1, shuffle=True, num_workers=4)
+        # Continue an interrupted call with the same arguments where its
+        # resume checkpoint left off, with the same order of images
+        resume = self.load_resume(learning_rate, epochs, layers)
+
+        # Data generators. Resume checkpoints that don't have the seed are
+        # from before it was drawn per run, when it was 0.
+        seed = self.shuffle_seed() if resume is None else resume.get("sampler_seed", 0)
+        train_generator = data_generator(train_dataset, self.config, shuffle=True, augment=True,
+                                         rank=self.rank, world_size=self.world_size,
+                                         features=train_features, seed=seed)
+        val_generator = data_generator(val_dataset, self.config, shuffle=True, augment=True,
+                                       rank=self.rank, world_size=self.world_size,
+                                       features=val_features, seed=seed)
 
         # Train
-        log("\nStarting at epoch {}. LR={}\n".format(self.epoch+1, learning_rate))
-        log("Checkpoint Path: {}".format(self.checkpoint_path))
+        if self.rank == 0:
+            log("\nStarting at epoch {}. LR={}\n".format(self.epoch+1, learning_rate))
+            log("Checkpoint Path: {}".format(self.checkpoint_path))
+            os.makedirs(self.log_dir, exist_ok=True)
         self.set_trainable(layers)
 
+        # Cached features are only valid for the weights they were built with
+        caches = [f for f in (train_features, val_features) if f is not None]
+        if caches:
+            trainable = [name for name, param in self.named_parameters()
+                         if param.requires_grad and re.match(r"fpn\.C\d\.", name)]
+            if trainable:
+                raise Exception("Training from a feature cache needs a frozen backbone, "
+                                "but {} is trainable.".format(trainable[0]))
+            weights_digest = self.backbone_digest()
+            for features in caches:
+                if features.weights_digest != weights_digest:
+                    raise Exception("Feature cache {} was built with other backbone "
+                                    "weights.".format(features.path))
+
+        start = (0, 0, 0)
+        if resume is not None:
+            if self.rank == 0:
+                log("Resuming epoch {} at step {}".format(resume["epoch"], resume["step"]))
+            self.load_state_dict(full_state(resume["model"], self.log_dir))
+            self.loss_history = resume["loss_history"]
+            self.val_loss_history = resume["val_loss_history"]
+            start = (resume["step"], resume["batch"], resume["loss_sum"])
+
+        # In distributed training, the wrapper copies the weights of process 0
+        # to the others and averages gradients over all of them in backward().
+        # It's built after set_trainable() as it only syncs trainable weights.
+        model = self
+        if self.world_size > 1:
+            device_ids = [torch.cuda.current_device()] if self.config.GPU_COUNT else None
+            model = nn.parallel.DistributedDataParallel(self, device_ids=device_ids)
+
         # Optimizer object
         # Add L2 Regularization
         # Skip gamma and beta weights of batch normalization layers.
@@ -1785,152 +2924,385 @@ class MaskRCNN(nn.Module):
             {'params': trainables_wo_bn, 'weight_decay': self.config.WEIGHT_DECAY},
             {'params': trainables_only_bn}
         ], lr=learning_rate, momentum=self.config.LEARNING_MOMENTUM)
-
-        for epoch in range(self.epoch+1, epochs+1):
-            log("Epoch {}/{}.".format(epoch,epochs))
-
-            # Training
-            loss = self.train_epoch(train_generator, optimizer, self.config.STEPS_PER_EPOCH)
-
-            # Validation
-            val_loss = self.valid_epoch(val_generator, self.config.VALIDATION_STEPS)
-
-            # Statistics
-            self.loss_history.append(loss)
-            self.val_loss_history.append(val_loss)
-            visualize.plot_loss(self.loss_history, self.val_loss_history, save=True, log_dir=self.log_dir)
-
-            # Save model
-            torch.save(self.state_dict(), self.checkpoint_path.format(epoch))
+        if resume is not None:
+            optimizer.load_state_dict(resume["optimizer"])
+
+        # Only the first process writes checkpoints. Losses are averaged over
+        # all processes already, and the weights are the same in all of them.
+        writer = CheckpointWriter() if self.rank == 0 else None
+        base = None
+
+        def model_state():
+            return self.state_dict() if base is None else self.delta_state(base)
+
+        def save_resume(epoch, step, batch, loss_sum):
+            writer.save({
+                "model": model_state(),
+                "optimizer": optimizer.state_dict(),
+                "rng": get_rng_state(),
+                "epoch": epoch,
+                "sampler_seed": seed,
+                "sampler_epoch": epoch,
+                "step": step,
+                "batch": batch,
+                "loss_sum": loss_sum,
+                "loss_history": self.loss_history,
+                "val_loss_history": self.val_loss_history,
+                "train": [learning_rate, epochs, layers],
+            }, self.resume_path)
+
+        try:
+            # Delta checkpoints leave out the frozen weights, which are
+            # saved once to a base file instead
+            if writer is not None and self.config.DELTA_CHECKPOINTS:
+                base = self.save_base(writer)
+
+            for epoch in range(self.epoch+1, epochs+1):
+                if self.rank == 0:
+                    log("Epoch {}/{}.".format(epoch,epochs))
+                set_sampler_epoch(train_generator, resume.get("sampler_epoch", epoch) if resume else epoch,
+                                  start=start[1])
+                set_sampler_epoch(val_generator, epoch)
+
+                # Training
+                checkpoint = None
+                if writer is not None and self.config.CHECKPOINT_INTERVAL:
+                    checkpoint = functools.partial(save_resume, epoch)
+                loss = self.train_epoch(train_generator, optimizer, self.config.STEPS_PER_EPOCH, model=model,
+                                        start=start, rng=resume and resume["rng"], checkpoint=checkpoint,
+                                        epoch=epoch)
+                start, resume = (0, 0, 0), None
+
+                # Validation
+                val_loss = self.valid_epoch(val_generator, self.config.VALIDATION_STEPS)
+
+                # Statistics
+                self.loss_history.append(loss)
+                self.val_loss_history.append(val_loss)
+
+                if self.rank == 0:
+                    self.log_metrics({"epoch": epoch, "loss": loss, "val_loss": val_loss})
+                    visualize.plot_loss(self.loss_history, self.val_loss_history, save=True, log_dir=self.log_dir)
+
+                    # Save model
+                    writer.save(model_state(), self.checkpoint_path.format(epoch))
+                    if self.config.CHECKPOINT_INTERVAL:
+                        save_resume(epoch + 1, 0, 0, 0)
+        finally:
+            if writer is not None:
+                writer.close()
 
         self.epoch = epochs
 
+    def save_base(self, writer):
+        """Saves the parameters that don't require gradients to a base file
+        in log_dir with the given CheckpointWriter, unless the file is there
+        already. Returns the reference to it that delta_state() takes, or
+        None if every parameter is trainable.
+        """
+        frozen = {name for name, param in self.named_parameters() if not param.requires_grad}
+        if not frozen:
+            return None
+        state = {name: tensor for name, tensor in self.state_dict().items() if name in frozen}
+        digest = state_digest(state)
+        base = {"base": "base_{}_{}.pth".format(self.config.NAME.lower(), digest[:12]),
+                "base_digest": digest}
+        path = os.path.join(self.log_dir, base["base"])
+        if not os.path.exists(path):
+            writer.save(state, path)
+        return base
+
+    def delta_state(self, base):
+        """Returns a delta checkpoint: the reference to a base file from
+        save_base() and the entries of the state dict that aren't in it,
+        i.e. the trainable parameters and all buffers. full_state() turns
+        it back into a state dict.
+        """
+        frozen = {name for name, param in self.named_parameters() if not param.requires_grad}
+        delta = {name: tensor for name, tensor in self.state_dict().items() if name not in frozen}
+        return dict(base, delta=delta)
+
+    def load_resume(self, learning_rate, epochs, layers):
+        """Returns the resume checkpoint in log_dir if a train_model() call
+        with the same arguments wrote it, in the epoch after self.epoch.
+        Returns None otherwise.
+        """
+        if not os.path.exists(self.resume_path):
+            return None
+        resume = torch.load(self.resume_path, map_location="cpu", weights_only=False)
+        if resume["train"] != [learning_rate, epochs, layers] or resume["epoch"] != self.epoch + 1:
+            return None
+        return resume
+
 
 
-    def train_epoch(self, datagenerator, optimizer, steps):
-        batch_count = 0
-        loss_sum = 0
-        step = 0
+    def train_epoch(self, datagenerator, optimizer, steps, model=None, start=(0, 0, 0),
+                    rng=None, checkpoint=None, epoch=None):
+        """model: The module that runs the forward pass, self by default.
+            train_model() passes its DistributedDataParallel wrapper.
+        start: (step, batch, loss_sum) to continue an epoch from. The sampler
+            of datagenerator must skip the first batch batches already.
+        rng: get_rng_state() of the checkpoint the epoch continues from.
+        checkpoint: Function called with (step, batch, loss_sum) every
+            CHECKPOINT_INTERVAL steps.
+        epoch: Epoch number for the metrics log.
 
+        Losses are summed on the device and only copied to the host every
+        LOG_INTERVAL steps, when their means are printed and logged to
+        metrics.jsonl with the mean step time.
+        """
+        if model is None:
+            model = self
+        step, batch, loss_sum = start
+        timer = StageTimer(enabled=self.config.STEP_PROFILING, cuda=bool(self.config.GPU_COUNT))
+        interval = {"losses": 0, "steps": 0, "step_time": 0., "data_time": 0.}
+
+        def flush(done):
+            """Prints and logs the steps since the last call, done being
+            the number of steps of the epoch done.
+            """
+            nonlocal loss_sum
+            count = interval["steps"]
+            if not count:
+                return
+            losses = [value / count for value in self.reduce_losses([interval["losses"]])]
+            loss_sum += losses[0] * count / steps
+            if self.rank == 0:
+                printProgressBar(done, steps, prefix="\t{}/{}".format(done, steps),
+                                 suffix="Complete - loss: {:.5f} - rpn_class_loss: {:.5f} - rpn_bbox_loss: {:.5f} - mrcnn_class_loss: {:.5f} - mrcnn_bbox_loss: {:.5f} - mrcnn_mask_loss: {:.5f}".format(
+                                     *losses) + " - {:.3f}s/step".format(interval["step_time"] / count), length=10)
+                record = {"epoch": epoch, "step": done}
+                record.update(zip(["loss", "rpn_class_loss", "rpn_bbox_loss", "mrcnn_class_loss",
+                                   "mrcnn_bbox_loss", "mrcnn_mask_loss"], losses))
+                record["step_time"] = interval["step_time"] / count
+                record["data_time"] = interval["data_time"] / count
+                if timer.enabled:
+                    record["stages"] = {name: t / count for name, t in timer.times.items()}
+                self.log_metrics(record)
+            interval.update(losses=0, steps=0, step_time=0., data_time=0.)
+            timer.reset()
+
+        # Restore the random state once the data loader has drawn the seed
+        # of its workers, as it had at the start of the interrupted epoch.
+        # Loader workers have new seeds all the same, so random flips
+        # differ after resuming unless DATA_LOADER_WORKERS is 0.
+        datagenerator = iter(datagenerator)
+        if rng is not None:
+            set_rng_state(rng)
+
+        step_start = time.perf_counter()
         for inputs in datagenerator:
-            batch_count += 1
+            batch += 1
+            data_time = time.perf_counter() - step_start
+            timer.add("data", data_time)
+
+            # Batch with no usable images, in any of the processes
+            if not self.all_processes(inputs is not None):
+                step_start = time.perf_counter()
+                continue
 
             images = inputs[0]
             image_metas = inputs[1]
-            rpn_match = inputs[2]
-            rpn_bbox = inputs[3]
-            gt_class_ids = inputs[4]
-            gt_boxes = inputs[5]
-            gt_masks = inputs[6]
+            rpn_indices = inputs[2]
+            rpn_labels = inputs[3]
+            rpn_bbox = inputs[4]
+            gt_class_ids = inputs[5]
+            gt_boxes = inputs[6]
+            gt_masks = inputs[7]
 
             # image_metas as numpy array
             image_metas = image_metas.numpy()
 
-            # Wrap in variables
-            images = Variable(images)
-            rpn_match = Variable(rpn_match)
-            rpn_bbox = Variable(rpn_bbox)
-            gt_class_ids = Variable(gt_class_ids)
-            gt_boxes = Variable(gt_boxes)
-            gt_masks = Variable(gt_masks)
-
-            # To GPU
-            if self.config.GPU_COUNT:
-                images = images.cuda()
-                rpn_match = rpn_match.cuda()
-                rpn_bbox = rpn_bbox.cuda()
-                gt_class_ids = gt_class_ids.cuda()
-                gt_boxes = gt_boxes.cuda()
-                gt_masks = gt_masks.cuda()
+            with timer("copy"):
+                # Wrap in variables
+                # Images are a list of backbone outputs with a feature cache.
+                if isinstance(images, list):
+                    images = [Variable(c) for c in images]
+                else:
+                    images = Variable(images)
+                gt_class_ids = Variable(gt_class_ids)
+                gt_boxes = Variable(gt_boxes)
+                gt_masks = Variable(gt_masks)
+
+                # To GPU
+                if self.config.GPU_COUNT:
+                    images = [c.cuda() for c in images] if isinstance(images, list) else images.cuda()
+                    gt_class_ids = gt_class_ids.cuda()
+                    gt_boxes = gt_boxes.cuda()
+                    gt_masks = gt_masks.cuda()
+
+                # RPN targets are None with RPN_TARGETS_ON_DEVICE. The model
+                # builds them.
+                if rpn_indices is not None:
+                    rpn_indices = Variable(rpn_indices)
+                    rpn_labels = Variable(rpn_labels)
+                    rpn_bbox = Variable(rpn_bbox)
+                    if self.config.GPU_COUNT:
+                        rpn_indices = rpn_indices.cuda()
+                        rpn_labels = rpn_labels.cuda()
+                        rpn_bbox = rpn_bbox.cuda()
 
             # Run object detection
-            rpn_class_logits, rpn_pred_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask = \
-                self.predict([images, image_metas, gt_class_ids, gt_boxes, gt_masks], mode='training')
+            rpn_indices, rpn_labels, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_class_ids, target_valid, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask = \
+                model([images, image_metas, gt_class_ids, gt_boxes, gt_masks, rpn_indices, rpn_labels, rpn_bbox], mode='training', timer=timer)
 
             # Compute losses
-            rpn_class_loss, rpn_bbox_loss, mrcnn_class_loss, mrcnn_bbox_loss, mrcnn_mask_loss = compute_losses(rpn_match, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask)
-            loss = rpn_class_loss + rpn_bbox_loss + mrcnn_class_loss + mrcnn_bbox_loss + mrcnn_mask_loss
+            with timer("loss"):
+                rpn_class_loss, rpn_bbox_loss, mrcnn_class_loss, mrcnn_bbox_loss, mrcnn_mask_loss = compute_losses(rpn_indices, rpn_labels, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_class_ids, target_valid, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask)
+                loss = rpn_class_loss + rpn_bbox_loss + mrcnn_class_loss + mrcnn_bbox_loss + mrcnn_mask_loss
 
             # Backpropagation
-            if (batch_count % self.config.BATCH_SIZE) == 0:
+            with timer("backward"):
                 optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm(self.parameters(), 5.0)
-            if (batch_count % self.config.BATCH_SIZE) == 0:
+                loss.backward()
+            with timer("optimizer"):
+                torch.nn.utils.clip_grad_norm(self.parameters(), 5.0)
                 optimizer.step()
-                batch_count = 0
 
-            # Progress
-            printProgressBar(step + 1, steps, prefix="\t{}/{}".format(step + 1, steps),
-                             suffix="Complete - loss: {:.5f} - rpn_class_loss: {:.5f} - rpn_bbox_loss: {:.5f} - mrcnn_class_loss: {:.5f} - mrcnn_bbox_loss: {:.5f} - mrcnn_mask_loss: {:.5f}".format(
-                                 loss.data.cpu()[0], rpn_class_loss.data.cpu()[0], rpn_bbox_loss.data.cpu()[0],
-                                 mrcnn_class_loss.data.cpu()[0], mrcnn_bbox_loss.data.cpu()[0],
-                                 mrcnn_mask_loss.data.cpu()[0]), length=10)
-
-            # Statistics
-            loss_sum += loss.data.cpu()[0]/steps
+            # Statistics, kept on the device until the next flush()
+            interval["losses"] = interval["losses"] + torch.cat([
+                l.data.view(-1) for l in [loss, rpn_class_loss, rpn_bbox_loss,
+                                          mrcnn_class_loss, mrcnn_bbox_loss, mrcnn_mask_loss]])
+            interval["steps"] += 1
+            interval["data_time"] += data_time
+            interval["step_time"] += time.perf_counter() - step_start
 
             # Break after 'steps' steps
             if step==steps-1:
+                flush(steps)
                 break
             step += 1
 
+            # Resume checkpoints need the losses up to them. All processes
+            # flush at the same steps, as they average the losses together.
+            checkpoint_due = self.config.CHECKPOINT_INTERVAL and step % self.config.CHECKPOINT_INTERVAL == 0
+            if step % self.config.LOG_INTERVAL == 0 or checkpoint_due:
+                flush(step)
+            if checkpoint is not None and checkpoint_due:
+                checkpoint(step, batch, loss_sum)
+            step_start = time.perf_counter()
+
+        flush(step)
         return loss_sum
 
+    def all_processes(self, flag):
+        """Returns True if flag is True in every process of distributed
+        training. Processes use it to agree on skipping a batch, since they
+        must all run the same steps.
+        """
+        if self.world_size == 1:
+            return flag
+        flags = torch.IntTensor([int(flag)])
+        if self.config.GPU_COUNT:
+            flags = flags.cuda()
+        dist.all_reduce(flags, op=dist.ReduceOp.MIN)
+        return bool(flags[0])
+
+    def shuffle_seed(self):
+        """Returns the SHUFFLE_SEED of the config, or if it's None a seed
+        drawn from numpy's random state. In distributed training, all
+        processes get the one of process 0.
+        """
+        seed = self.config.SHUFFLE_SEED
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        if self.world_size == 1:
+            return int(seed)
+        seeds = torch.LongTensor([int(seed)])
+        if self.config.GPU_COUNT:
+            seeds = seeds.cuda()
+        dist.broadcast(seeds, 0)
+        return int(seeds[0])
+
+    def log_metrics(self, record):
+        """Appends a dict of metrics to metrics.jsonl in the log directory."""
+        with open(os.path.join(self.log_dir, "metrics.jsonl"), "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def reduce_losses(self, losses):
+        """Returns the values of scalar loss Variables as floats, averaged
+        over all processes of distributed training.
+        """
+        values = torch.cat([loss.data.view(-1) for loss in losses])
+        if self.world_size > 1:
+            dist.all_reduce(values)
+            values /= self.world_size
+        return values.cpu().tolist()
+
     def valid_epoch(self, datagenerator, steps):
 
         step = 0
         loss_sum = 0
 
         for inputs in datagenerator:
+            # Batch with no usable images, in any of the processes
+            if not self.all_processes(inputs is not None):
+                continue
+
             images = inputs[0]
             image_metas = inputs[1]
-            rpn_match = inputs[2]
-            rpn_bbox = inputs[3]
-            gt_class_ids = inputs[4]
-            gt_boxes = inputs[5]
-            gt_masks = inputs[6]
+            rpn_indices = inputs[2]
+            rpn_labels = inputs[3]
+            rpn_bbox = inputs[4]
+            gt_class_ids = inputs[5]
+            gt_boxes = inputs[6]
+            gt_masks = inputs[7]
 
             # image_metas as numpy array
             image_metas = image_metas.numpy()
 
             # Wrap in variables
-            images = Variable(images, volatile=True)
-            rpn_match = Variable(rpn_match, volatile=True)
-            rpn_bbox = Variable(rpn_bbox, volatile=True)
+            # Images are a list of backbone outputs with a feature cache.
+            if isinstance(images, list):
+                images = [Variable(c, volatile=True) for c in images]
+            else:
+                images = Variable(images, volatile=True)
             gt_class_ids = Variable(gt_class_ids, volatile=True)
             gt_boxes = Variable(gt_boxes, volatile=True)
             gt_masks = Variable(gt_masks, volatile=True)
 
             # To GPU
             if self.config.GPU_COUNT:
-                images = images.cuda()
-                rpn_match = rpn_match.cuda()
-                rpn_bbox = rpn_bbox.cuda()
+                images = [c.cuda() for c in images] if isinstance(images, list) else images.cuda()
                 gt_class_ids = gt_class_ids.cuda()
                 gt_boxes = gt_boxes.cuda()
                 gt_masks = gt_masks.cuda()
 
+            # RPN targets are None with RPN_TARGETS_ON_DEVICE. The model
+            # builds them.
+            if rpn_indices is not None:
+                rpn_indices = Variable(rpn_indices, volatile=True)
+                rpn_labels = Variable(rpn_labels, volatile=True)
+                rpn_bbox = Variable(rpn_bbox, volatile=True)
+                if self.config.GPU_COUNT:
+                    rpn_indices = rpn_indices.cuda()
+                    rpn_labels = rpn_labels.cuda()
+                    rpn_bbox = rpn_bbox.cuda()
+
             # Run object detection
-            rpn_class_logits, rpn_pred_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask = \
-                self.predict([images, image_metas, gt_class_ids, gt_boxes, gt_masks], mode='training')
+            rpn_indices, rpn_labels, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_class_ids, target_valid, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask = \
+                self.predict([images, image_metas, gt_class_ids, gt_boxes, gt_masks, rpn_indices, rpn_labels, rpn_bbox], mode='training')
 
-            if not target_class_ids.size():
+            # Skip batches where no ROI could be sampled, in any of the processes
+            if not self.all_processes(bool(target_valid.data.any())):
                 continue
 
             # Compute losses
-            rpn_class_loss, rpn_bbox_loss, mrcnn_class_loss, mrcnn_bbox_loss, mrcnn_mask_loss = compute_losses(rpn_match, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask)
+            rpn_class_loss, rpn_bbox_loss, mrcnn_class_loss, mrcnn_bbox_loss, mrcnn_mask_loss = compute_losses(rpn_indices, rpn_labels, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_class_ids, target_valid, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask)
             loss = rpn_class_loss + rpn_bbox_loss + mrcnn_class_loss + mrcnn_bbox_loss + mrcnn_mask_loss
 
+            # Losses averaged over all processes
+            losses = self.reduce_losses([loss, rpn_class_loss, rpn_bbox_loss,
+                                         mrcnn_class_loss, mrcnn_bbox_loss, mrcnn_mask_loss])
+
             # Progress
-            printProgressBar(step + 1, steps, prefix="\t{}/{}".format(step + 1, steps),
-                             suffix="Complete - loss: {:.5f} - rpn_class_loss: {:.5f} - rpn_bbox_loss: {:.5f} - mrcnn_class_loss: {:.5f} - mrcnn_bbox_loss: {:.5f} - mrcnn_mask_loss: {:.5f}".format(
-                                 loss.data.cpu()[0], rpn_class_loss.data.cpu()[0], rpn_bbox_loss.data.cpu()[0],
-                                 mrcnn_class_loss.data.cpu()[0], mrcnn_bbox_loss.data.cpu()[0],
-                                 mrcnn_mask_loss.data.cpu()[0]), length=10)
+            if self.rank == 0:
+                printProgressBar(step + 1, steps, prefix="\t{}/{}".format(step + 1, steps),
+                                 suffix="Complete - loss: {:.5f} - rpn_class_loss: {:.5f} - rpn_bbox_loss: {:.5f} - mrcnn_class_loss: {:.5f} - mrcnn_bbox_loss: {:.5f} - mrcnn_mask_loss: {:.5f}".format(
+                                     *losses), length=10)
 
             # Statistics
-            loss_sum += loss.data.cpu()[0]/steps
+            loss_sum += losses[0]/steps
 
             # Break after 'steps' steps
             if step==steps-1:
@@ -1944,11 +3316,13 @@ class MaskRCNN(nn.Module):
     def mold_inputs(self, images):
         """Takes a list of images and modifies them to the format expected
         as an input to the neural network.
-        images: List of image matricies [height,width,depth]. Images can have
-            different sizes.
+        images: List of image matricies [height,width,depth] or paths of
+            image files. Images can have different sizes. Files are decoded
+            straight at the target size where possible.
 
         Returns 3 Numpy matricies:
-        molded_images: [N, h, w, 3]. Images resized and normalized.
+        molded_images: [N, h, w, 3]. Images resized and padded, as uint8.
+            predict() normalizes them.
         image_metas: [N, length of meta data]. Details about each image.
         windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
             original image (padding excluded).
@@ -1959,15 +3333,22 @@ class MaskRCNN(nn.Module):
         for image in images:
             # Resize image to fit the model expected size
             # TODO: move resizing to mold_image()
-            molded_image, window, scale, padding = utils.resize_image(
-                image,
-                min_dim=self.config.IMAGE_MIN_DIM,
-                max_dim=self.config.IMAGE_MAX_DIM,
-                padding=self.config.IMAGE_PADDING)
-            molded_image = mold_image(molded_image, self.config)
+            if isinstance(image, str):
+                molded_image, window, scale, padding, shape = utils.load_image_resized(
+                    image,
+                    min_dim=self.config.IMAGE_MIN_DIM,
+                    max_dim=self.config.IMAGE_MAX_DIM,
+                    padding=self.config.IMAGE_PADDING)
+            else:
+                molded_image, window, scale, padding = utils.resize_image(
+                    image,
+                    min_dim=self.config.IMAGE_MIN_DIM,
+                    max_dim=self.config.IMAGE_MAX_DIM,
+                    padding=self.config.IMAGE_PADDING)
+                shape = image.shape
             # Build image_meta
             image_meta = compose_image_meta(
-                0, image.shape, window,
+                0, shape, window,
                 np.zeros([self.config.NUM_CLASSES], dtype=np.int32))
             # Append
             molded_images.append(molded_image)
@@ -1985,7 +3366,7 @@ class MaskRCNN(nn.Module):
         application.
 
         detections: [N, (y1, x1, y2, x2, class_id, score)]
-        mrcnn_mask: [N, height, width, num_classes]
+        mrcnn_mask: [N, height, width] mask of the class of each detection
         image_shape: [height, width, depth] Original size of the image before resizing
         window: [y1, x1, y2, x2] Box in the image where the real image is
                 excluding the padding.
@@ -2005,7 +3386,7 @@ class MaskRCNN(nn.Module):
         boxes = detections[:N, :4]
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        masks = mrcnn_mask[:N]
 
         # Compute scale and shift to translate coordinates to image domain.
         h_scale = image_shape[0] / (window[2] - window[0])
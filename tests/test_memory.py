@@ -0,0 +1,15 @@
+"""
+Mask R-CNN
+Regression test of the peak memory of loading a training sample and of
+detect() on the reference image, against the bounds of bench.memory.
+"""
+
+import pytest
+
+from bench import memory
+
+
+def test_reference_within_bounds():
+    pytest.importorskip("pycocotools")
+    results, peak_rss_mb = memory.profile(memory.REFERENCE_IMAGE, memory.ReferenceConfig(), 8)
+    assert memory.check(results, peak_rss_mb) == []
@@ -0,0 +1,44 @@
+"""
+Mask R-CNN
+Regression tests of refine_detections().
+"""
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+import model as modellib
+from config import Config
+
+
+class DetectionConfig(Config):
+    NAME = "test"
+    GPU_COUNT = 0
+    NUM_CLASSES = 3
+    DETECTION_MIN_CONFIDENCE = 0.7
+
+
+def refine(probs):
+    count = probs.shape[0]
+    rois = torch.FloatTensor([[0.1, 0.1, 0.3, 0.3]]).repeat(count, 1)
+    deltas = torch.zeros(count, DetectionConfig.NUM_CLASSES, 4)
+    window = np.array([0, 0, 1024, 1024])
+    return modellib.refine_detections(Variable(rois), Variable(torch.FloatTensor(probs)),
+                                      Variable(deltas), window, DetectionConfig())
+
+
+def test_all_background():
+    probs = np.tile([[0.9, 0.05, 0.05]], [4, 1])
+    assert tuple(refine(probs).size()) == (0, 6)
+
+
+def test_below_min_confidence():
+    probs = np.tile([[0.2, 0.5, 0.3]], [4, 1])
+    assert tuple(refine(probs).size()) == (0, 6)
+
+
+def test_detection():
+    probs = np.array([[0.2, 0.5, 0.3], [0.05, 0.05, 0.9]])
+    detections = refine(probs)
+    assert tuple(detections.size()) == (1, 6)
+    assert detections[0, 4].item() == 2
@@ -11,12 +11,15 @@ import sys
 import os
 import math
 import random
+import collections.abc
+import json
+import pickle
+import shutil
 import numpy as np
-import scipy.misc
-import scipy.ndimage
 import skimage.color
 import skimage.io
 import torch
+from PIL import Image
 
 ############################################################
 #  Bounding Boxes
@@ -28,24 +31,19 @@ def extract_bboxes(mask):
 
     Returns: bbox array [num_instances, (y1, x1, y2, x2)].
     """
-    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
-    for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
-        # Bounding box.
-        horizontal_indicies = np.where(np.any(m, axis=0))[0]
-        vertical_indicies = np.where(np.any(m, axis=1))[0]
-        if horizontal_indicies.shape[0]:
-            x1, x2 = horizontal_indicies[[0, -1]]
-            y1, y2 = vertical_indicies[[0, -1]]
-            # x2 and y2 should not be part of the box. Increment by 1.
-            x2 += 1
-            y2 += 1
-        else:
-            # No mask for this instance. Might happen due to
-            # resizing or cropping. Set bbox to zeros
-            x1, x2, y1, y2 = 0, 0, 0, 0
-        boxes[i] = np.array([y1, x1, y2, x2])
-    return boxes.astype(np.int32)
+    # Project masks on both axes: [height, instances] and [width, instances]
+    rows = np.any(mask, axis=1)
+    cols = np.any(mask, axis=0)
+    # First and last (exclusive) row and column of each instance
+    y1 = np.argmax(rows, axis=0)
+    y2 = rows.shape[0] - np.argmax(rows[::-1], axis=0)
+    x1 = np.argmax(cols, axis=0)
+    x2 = cols.shape[0] - np.argmax(cols[::-1], axis=0)
+    boxes = np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+    # No mask for this instance. Might happen due to
+    # resizing or cropping. Set bbox to zeros
+    boxes[~np.any(rows, axis=0)] = 0
+    return boxes
 
 
 def compute_iou(box, boxes, box_area, boxes_area):
@@ -111,6 +109,397 @@ def box_refinement(box, gt_box):
     return result
 
 
+############################################################
+#  Image Info Store
+############################################################
+
+# Segmentation encodings in the annotation table
+SEGM_POLYGON = 0
+SEGM_RLE_COUNTS = 1     # Uncompressed RLE, counts as a list of ints
+SEGM_RLE_STRING = 2     # Compressed RLE, counts as a byte string
+
+
+def _pack_strings(strings):
+    """Packs a list of strings into a flat uint8 buffer plus offsets."""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros([len(encoded) + 1], dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def _pack_values(values):
+    """Packs a list of values into a flat uint8 buffer plus offsets, as
+    _pack_strings(). Strings are stored as UTF-8 when all values are
+    strings, anything else is pickled. Returns the buffer, the offsets and
+    whether the values are pickled.
+    """
+    if all(isinstance(v, str) for v in values):
+        return _pack_strings(values) + (False,)
+    encoded = [pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL) for v in values]
+    offsets = np.zeros([len(encoded) + 1], dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets, True
+
+
+class ImageInfoChunk(object):
+    """An immutable, columnar block of image info records.
+
+    Images are stored as numpy columns (ids, sources, sizes, paths) and
+    their COCO style annotations as one flat table with per-image offsets
+    and flat polygon and RLE buffers. Compared to lists of dicts this uses
+    far less memory, and since the buffers hold no Python objects, forked
+    DataLoader workers don't touch (and copy) their pages.
+
+    columns: dict of column name to numpy array. See from_dicts().
+    sources: list of source names indexed by the "source" column.
+    """
+
+    # Keys that have dedicated columns. Everything else passed to
+    # add_image() goes to the "extra" columns.
+    BASE_KEYS = ("id", "source", "path", "annotations")
+
+    def __init__(self, columns, sources, extra_keys=()):
+        self.columns = columns
+        self.sources = list(sources)
+        self.extra_keys = list(extra_keys)
+
+    def __len__(self):
+        return self.columns["path_offsets"].shape[0] - 1
+
+    @classmethod
+    def from_dicts(cls, infos):
+        """Builds a chunk from a list of image info dicts as passed to
+        Dataset.add_image().
+        """
+        sources = sorted(set(info["source"] for info in infos))
+        source_index = {s: i for i, s in enumerate(sources)}
+        columns = {}
+
+        ids = [info["id"] for info in infos]
+        if all(isinstance(i, (int, np.integer)) for i in ids):
+            columns["id"] = np.array(ids, dtype=np.int64)
+        else:
+            cls._add_packed(columns, "id", ids)
+        columns["source"] = np.array([source_index[info["source"]] for info in infos],
+                                     dtype=np.int16)
+        # Images generated on the fly (e.g. the shapes sample) have no path
+        columns["path"], columns["path_offsets"] = _pack_strings(
+            [info["path"] or "" for info in infos])
+        columns["has_path"] = np.array([info["path"] is not None for info in infos],
+                                       dtype=bool)
+
+        # Extra columns. Numbers and booleans become typed arrays, anything
+        # else is packed like the ids. Images without the key get a zero or
+        # empty value and a False in the "extra_present." column.
+        extra_keys = sorted(set(k for info in infos for k in info
+                                if k not in cls.BASE_KEYS))
+        for key in extra_keys:
+            present = np.array([key in info for info in infos], dtype=bool)
+            values = [info[key] for info in infos if key in info]
+            if all(isinstance(v, (bool, np.bool_)) for v in values):
+                column = np.zeros([len(infos)], dtype=bool)
+                column[present] = values
+                columns["extra." + key] = column
+            elif all(isinstance(v, (int, float, np.number)) and
+                     not isinstance(v, (bool, np.bool_)) for v in values):
+                column = np.zeros([len(infos)], dtype=np.array(values).dtype)
+                column[present] = values
+                columns["extra." + key] = column
+            else:
+                cls._add_packed(columns, "extra." + key,
+                                [info.get(key, "") for info in infos])
+            if not present.all():
+                columns["extra_present." + key] = present
+
+        columns.update(cls._pack_annotations(infos))
+        return cls(columns, sources, extra_keys)
+
+    @staticmethod
+    def _add_packed(columns, name, values):
+        """Adds a column of values packed by _pack_values()."""
+        columns[name], columns[name + "_offsets"], pickled = _pack_values(values)
+        columns[name + "_pickled"] = np.array(pickled)
+
+    def value(self, name, i):
+        """Returns element i of a typed or packed column."""
+        c = self.columns
+        if name + "_offsets" in c:
+            start, end = c[name + "_offsets"][i], c[name + "_offsets"][i + 1]
+            data = c[name][start:end].tobytes()
+            return pickle.loads(data) if c[name + "_pickled"] else data.decode("utf-8")
+        value = c[name][i]
+        return value.item() if isinstance(value, np.generic) else value
+
+    @staticmethod
+    def _pack_annotations(infos):
+        """Flattens the "annotations" lists of all images into one table."""
+        has_annotations = np.array(["annotations" in info for info in infos], dtype=bool)
+        annotations = [info.get("annotations") or [] for info in infos]
+        ann_offsets = np.zeros([len(infos) + 1], dtype=np.int64)
+        ann_offsets[1:] = np.cumsum([len(a) for a in annotations])
+        count = int(ann_offsets[-1])
+
+        ann_id = np.zeros([count], dtype=np.int64)
+        category_id = np.zeros([count], dtype=np.int32)
+        iscrowd = np.zeros([count], dtype=np.uint8)
+        area = np.zeros([count], dtype=np.float64)
+        bbox = np.zeros([count, 4], dtype=np.float64)
+        seg_kind = np.zeros([count], dtype=np.uint8)
+        seg_size = np.zeros([count, 2], dtype=np.int32)
+        # Range of each annotation in the buffer of its kind. For polygons
+        # it's a range of polygons in poly_offsets.
+        seg_offsets = np.zeros([count, 2], dtype=np.int64)
+
+        poly_lengths = []
+        poly_coords = []
+        rle_counts = []
+        rle_strings = []
+        rle_counts_len = 0
+        rle_strings_len = 0
+        i = 0
+        for anns in annotations:
+            for ann in anns:
+                ann_id[i] = ann.get("id", 0)
+                category_id[i] = ann["category_id"]
+                iscrowd[i] = ann.get("iscrowd", 0)
+                area[i] = ann.get("area", 0)
+                if "bbox" in ann:
+                    bbox[i] = ann["bbox"]
+                segm = ann["segmentation"]
+                if isinstance(segm, list):
+                    seg_kind[i] = SEGM_POLYGON
+                    seg_offsets[i] = [len(poly_lengths), len(poly_lengths) + len(segm)]
+                    for poly in segm:
+                        poly_lengths.append(len(poly))
+                        poly_coords.append(np.asarray(poly, dtype=np.float64))
+                elif isinstance(segm["counts"], list):
+                    seg_kind[i] = SEGM_RLE_COUNTS
+                    seg_size[i] = segm["size"]
+                    n = len(segm["counts"])
+                    seg_offsets[i] = [rle_counts_len, rle_counts_len + n]
+                    rle_counts.append(np.asarray(segm["counts"], dtype=np.uint32))
+                    rle_counts_len += n
+                else:
+                    seg_kind[i] = SEGM_RLE_STRING
+                    seg_size[i] = segm["size"]
+                    counts = segm["counts"]
+                    if not isinstance(counts, bytes):
+                        counts = counts.encode("ascii")
+                    seg_offsets[i] = [rle_strings_len, rle_strings_len + len(counts)]
+                    rle_strings.append(counts)
+                    rle_strings_len += len(counts)
+                i += 1
+
+        poly_offsets = np.zeros([len(poly_lengths) + 1], dtype=np.int64)
+        poly_offsets[1:] = np.cumsum(poly_lengths)
+        return {
+            "has_annotations": has_annotations,
+            "ann_offsets": ann_offsets,
+            "ann_id": ann_id,
+            "ann_category_id": category_id,
+            "ann_iscrowd": iscrowd,
+            "ann_area": area,
+            "ann_bbox": bbox,
+            "ann_seg_kind": seg_kind,
+            "ann_seg_size": seg_size,
+            "ann_seg_offsets": seg_offsets,
+            "poly_offsets": poly_offsets,
+            "poly_coords": np.concatenate(poly_coords) if poly_coords
+                           else np.zeros([0], dtype=np.float64),
+            "rle_counts": np.concatenate(rle_counts) if rle_counts
+                          else np.zeros([0], dtype=np.uint32),
+            "rle_strings": np.frombuffer(b"".join(rle_strings), dtype=np.uint8),
+        }
+
+    def save(self, path):
+        """Writes the chunk to the directory path. Each column goes to its
+        own .npy file so that load() can memory-map it. The directory is
+        written under a temporary name and renamed at the end so readers
+        never see a partial chunk.
+        """
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        os.makedirs(tmp_path)
+        for name, column in self.columns.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), column)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"sources": self.sources,
+                       "extra_keys": self.extra_keys,
+                       "columns": sorted(self.columns)}, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process wrote the same chunk first. Keep theirs.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a chunk written by save(). If mmap is True, columns are
+        memory-mapped read-only instead of read into memory.
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        columns = {}
+        for name in meta["columns"]:
+            columns[name] = np.load(os.path.join(path, name + ".npy"),
+                                    mmap_mode="r" if mmap else None)
+        return cls(columns, meta["sources"], meta["extra_keys"])
+
+    def get(self, i, key):
+        """Returns the value of one field of image i."""
+        c = self.columns
+        if key == "id":
+            return self.value("id", i)
+        if key == "source":
+            return self.sources[c["source"][i]]
+        if key == "path":
+            if "has_path" in c and not c["has_path"][i]:
+                return None
+            start, end = c["path_offsets"][i], c["path_offsets"][i + 1]
+            return c["path"][start:end].tobytes().decode("utf-8")
+        if key == "annotations" and c["has_annotations"][i]:
+            return self.annotations(i)
+        if key in self.extra_keys:
+            present = c.get("extra_present." + key)
+            if present is None or present[i]:
+                return self.value("extra." + key, i)
+        raise KeyError(key)
+
+    def keys(self, i):
+        """Returns the field names that image i has."""
+        keys = ["id", "source", "path"]
+        for key in self.extra_keys:
+            present = self.columns.get("extra_present." + key)
+            if present is None or present[i]:
+                keys.append(key)
+        if self.columns["has_annotations"][i]:
+            keys.append("annotations")
+        return keys
+
+    def annotations(self, i):
+        """Rebuilds the list of COCO style annotation dicts of image i."""
+        c = self.columns
+        image_id = self.get(i, "id")
+        annotations = []
+        for a in range(c["ann_offsets"][i], c["ann_offsets"][i + 1]):
+            start, end = c["ann_seg_offsets"][a]
+            kind = c["ann_seg_kind"][a]
+            if kind == SEGM_POLYGON:
+                segm = [c["poly_coords"][c["poly_offsets"][p]:c["poly_offsets"][p + 1]].tolist()
+                        for p in range(start, end)]
+            elif kind == SEGM_RLE_COUNTS:
+                segm = {"counts": c["rle_counts"][start:end].tolist(),
+                        "size": c["ann_seg_size"][a].tolist()}
+            else:
+                segm = {"counts": c["rle_strings"][start:end].tobytes(),
+                        "size": c["ann_seg_size"][a].tolist()}
+            annotations.append({
+                "id": int(c["ann_id"][a]),
+                "image_id": image_id,
+                "category_id": int(c["ann_category_id"][a]),
+                "iscrowd": int(c["ann_iscrowd"][a]),
+                "area": float(c["ann_area"][a]),
+                "bbox": c["ann_bbox"][a].tolist(),
+                "segmentation": segm,
+            })
+        return annotations
+
+
+class ImageInfo(collections.abc.Mapping):
+    """A read-only, lazy dict view of one image info record. Fields (in
+    particular "annotations") are decoded from the columnar store only
+    when accessed.
+    """
+
+    def __init__(self, chunk, index):
+        self._chunk = chunk
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._chunk.get(self._index, key)
+
+    def __iter__(self):
+        return iter(self._chunk.keys(self._index))
+
+    def __len__(self):
+        return len(self._chunk.keys(self._index))
+
+    def __repr__(self):
+        return "ImageInfo({})".format({k: self[k] for k in self if k != "annotations"})
+
+
+class ImageInfoStore(object):
+    """List-like, columnar container behind Dataset.image_info.
+
+    Records are appended as dicts and kept as-is until freeze() packs
+    them into an ImageInfoChunk. Indexing returns lazy ImageInfo views, so
+    code written against a list of dicts keeps working. Returned records
+    are read-only.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._starts = np.zeros([0], dtype=np.int64)
+        self._frozen_count = 0
+        self._pending = []
+
+    def append(self, info):
+        self._pending.append(info)
+
+    def add_chunk(self, chunk):
+        """Appends an already built chunk of records."""
+        self.freeze()
+        self._chunks.append(chunk)
+        self._starts = np.append(self._starts, self._frozen_count)
+        self._frozen_count += len(chunk)
+
+    def freeze(self):
+        """Packs pending records into a columnar chunk."""
+        if self._pending:
+            pending = self._pending
+            self._pending = []
+            self.add_chunk(ImageInfoChunk.from_dicts(pending))
+
+    def __len__(self):
+        return self._frozen_count + len(self._pending)
+
+    def __getitem__(self, i):
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("image index out of range")
+        if i >= self._frozen_count:
+            return self._pending[i - self._frozen_count]
+        c = int(np.searchsorted(self._starts, i, side="right")) - 1
+        return ImageInfo(self._chunks[c], i - int(self._starts[c]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def column(self, key):
+        """Returns one field of all images as a numpy array without
+        building per-image records. Only works on frozen records.
+        """
+        assert not self._pending, "Call freeze() first"
+        if not self._chunks:
+            return np.zeros([0])
+        if key == "source":
+            return np.concatenate([np.array(c.sources, dtype=object)[c.columns["source"]]
+                                   for c in self._chunks])
+        name = key if key in ("id",) else "extra." + key
+        columns = []
+        for c in self._chunks:
+            if name + "_offsets" in c.columns:
+                column = np.empty([len(c)], dtype=object)
+                column[:] = [c.value(name, i) for i in range(len(c))]
+                columns.append(column)
+            else:
+                columns.append(c.columns[name])
+        return np.concatenate(columns)
+
+
 ############################################################
 #  Dataset
 ############################################################
@@ -133,7 +522,8 @@ class Dataset(object):
 
     def __init__(self, class_map=None):
         self._image_ids = []
-        self.image_info = []
+        # Columnar store. Behaves like a list of image info dicts.
+        self.image_info = ImageInfoStore()
         # Background is always the first class
         self.class_info = [{"source": "", "id": 0, "name": "BG"}]
         self.source_class_ids = {}
@@ -180,6 +570,9 @@ class Dataset(object):
             """Returns a shorter version of object names for cleaner display."""
             return ",".join(name.split(",")[:1])
 
+        # Pack the image info dicts into columnar form
+        self.image_info.freeze()
+
         # Build (or rebuild) everything else from the info dicts.
         self.num_classes = len(self.class_info)
         self.class_ids = np.arange(self.num_classes)
@@ -202,6 +595,17 @@ class Dataset(object):
                 if i == 0 or source == info['source']:
                     self.source_class_ids[source].append(i)
 
+    def select_images(self, image_ids):
+        """Restricts the dataset to a subset of its images, given by their
+        image_ids. Call it after prepare(). image_info keeps every image, so
+        a shallow copy of a dataset can select a subset without changing the
+        original.
+        """
+        image_ids = np.asarray(image_ids, dtype=self._image_ids.dtype)
+        assert np.isin(image_ids, self._image_ids).all(), "Unknown image ids"
+        self._image_ids = image_ids
+        self.num_images = len(image_ids)
+
     def map_source_class_id(self, source_class_id):
         """Takes a source class ID and returns the int class ID assigned to it.
 
@@ -248,6 +652,24 @@ class Dataset(object):
             image = skimage.color.gray2rgb(image)
         return image
 
+    def load_image_resized(self, image_id, min_dim=None, max_dim=None,
+                           padding=False, padded_shape=None):
+        """Load the specified image resized like resize_image().
+
+        Images loaded by the default load_image() are decoded straight
+        at the target size when possible (see load_image_resized() in
+        utils). Datasets that override load_image() get it resized
+        after loading.
+
+        Returns the same values as resize_image(), followed by the shape
+        of the original image [height, width, 3].
+        """
+        if type(self).load_image is Dataset.load_image:
+            return load_image_resized(self.image_info[image_id]['path'],
+                                      min_dim, max_dim, padding, padded_shape)
+        image = self.load_image(image_id)
+        return resize_image(image, min_dim, max_dim, padding, padded_shape) + (image.shape,)
+
     def load_mask(self, image_id):
         """Load instance masks for the given image.
 
@@ -266,8 +688,74 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def load_mask_crops(self, image_id, scale, padding):
+        """Load instance masks already resized and padded the same way
+        resize_image() resized and padded the image, as one small crop
+        per instance instead of a full [height, width, instances] stack.
+
+        This default implementation goes through load_mask() and
+        resize_mask(). Override it to rasterize masks directly at the
+        target resolution so that memory scales with object size rather
+        than image size.
 
-def resize_image(image, min_dim=None, max_dim=None, padding=False):
+        scale, padding: As returned by resize_image().
+
+        Returns:
+            boxes: [instance count, (y1, x1, y2, x2)] int32 tight bounding
+                boxes of the crops in resized image coordinates. The x2, y2
+                pixels are not included.
+            crops: A list of bool arrays, one [y2 - y1, x2 - x1] mask per
+                instance. Instances with empty masks are dropped.
+            class_ids: a 1D array of class IDs of the instance masks.
+        """
+        mask, class_ids = self.load_mask(image_id)
+        if mask.shape[-1] == 0:
+            return np.zeros([0, 4], dtype=np.int32), [], class_ids
+        mask = resize_mask(mask, scale, padding)
+        boxes = extract_bboxes(mask)
+        # Some masks vanish when scaled down. Skip those objects.
+        keep = np.where((boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1]))[0]
+        crops = [mask[y1:y2, x1:x2, i].astype(bool)
+                 for i, (y1, x1, y2, x2) in zip(keep, boxes[keep])]
+        return boxes[keep], crops, class_ids[keep]
+
+
+def compute_resize_scale(height, width, min_dim=None, max_dim=None, padded_shape=None):
+    """Returns the factor that resize_image() scales an image of the given
+    size by. See resize_image() for the arguments.
+    """
+    scale = 1
+    # Scale?
+    if min_dim:
+        # Scale up but not down
+        scale = max(1, min_dim / min(height, width))
+    # Does it exceed max dim?
+    if max_dim:
+        image_max = max(height, width)
+        if round(image_max * scale) > max_dim:
+            scale = max_dim / image_max
+    # Does it fit the padded shape?
+    if padded_shape is not None:
+        if round(height * scale) > padded_shape[0] or round(width * scale) > padded_shape[1]:
+            scale = min(padded_shape[0] / height, padded_shape[1] / width)
+    return scale
+
+
+def imresize(image, shape):
+    """Resizes an image or mask to shape (height, width) with Pillow's
+    bilinear filter, as scipy.misc.imresize(image, shape) did before SciPy
+    removed it. Arrays other than uint8 are stretched to 0-255 bytes
+    first, from their minimum to their maximum. Returns uint8.
+    """
+    if image.dtype != np.uint8:
+        low, high = image.min(), image.max()
+        image = (image - low) * (255. / (high - low) if high > low else 0.)
+        image = (np.clip(image, 0, 255) + 0.5).astype(np.uint8)
+    resized = Image.fromarray(image).resize((int(shape[1]), int(shape[0])), Image.BILINEAR)
+    return np.array(resized)
+
+
+def resize_image(image, min_dim=None, max_dim=None, padding=False, padded_shape=None):
     """
     Resizes an image keeping the aspect ratio.
 
@@ -276,6 +764,8 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
     max_dim: if provided, ensures that the image longest side doesn't
         exceed this value.
     padding: If true, pads image with zeros so it's size is max_dim x max_dim
+    padded_shape: (height, width) to pad to instead of max_dim x max_dim.
+        The image is scaled down further if it doesn't fit.
 
     Returns:
     image: the resized image
@@ -289,35 +779,75 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
     # Default window (y1, x1, y2, x2) and default scale == 1.
     h, w = image.shape[:2]
     window = (0, 0, h, w)
-    scale = 1
+    scale = compute_resize_scale(h, w, min_dim, max_dim, padded_shape)
 
-    # Scale?
-    if min_dim:
-        # Scale up but not down
-        scale = max(1, min_dim / min(h, w))
-    # Does it exceed max dim?
-    if max_dim:
-        image_max = max(h, w)
-        if round(image_max * scale) > max_dim:
-            scale = max_dim / image_max
     # Resize image and mask
     if scale != 1:
-        image = scipy.misc.imresize(
-            image, (round(h * scale), round(w * scale)))
+        image = imresize(image, (round(h * scale), round(w * scale)))
     # Need padding?
     if padding:
         # Get new height and width
         h, w = image.shape[:2]
-        top_pad = (max_dim - h) // 2
-        bottom_pad = max_dim - h - top_pad
-        left_pad = (max_dim - w) // 2
-        right_pad = max_dim - w - left_pad
+        padded_h, padded_w = padded_shape[:2] if padded_shape is not None \
+            else (max_dim, max_dim)
+        top_pad = (padded_h - h) // 2
+        bottom_pad = padded_h - h - top_pad
+        left_pad = (padded_w - w) // 2
+        right_pad = padded_w - w - left_pad
         padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
         image = np.pad(image, padding, mode='constant', constant_values=0)
         window = (top_pad, left_pad, h + top_pad, w + left_pad)
     return image, window, scale, padding
 
 
+def load_image_resized(path, min_dim=None, max_dim=None, padding=False, padded_shape=None):
+    """Loads an image file and resizes it like resize_image().
+
+    JPEG files are decoded in draft mode, which lets the decoder downscale
+    by 1/2, 1/4 or 1/8 in the DCT domain. The smallest of these scales
+    that is still at least as large as the target size is used, and the
+    rest of the resize is done with a bilinear filter. The result is
+    copied straight into its window of a zero filled, padded buffer,
+    without an intermediate array. Other formats are loaded in full with
+    skimage and go through resize_image().
+
+    Returns the same values as resize_image(), followed by the shape of
+    the image file [height, width, 3].
+    """
+    with Image.open(path) as im:
+        if im.format != "JPEG":
+            im = None
+        else:
+            w, h = im.size
+            shape = (h, w, 3)
+            scale = compute_resize_scale(h, w, min_dim, max_dim, padded_shape)
+            size = (round(w * scale), round(h * scale))
+            # Decode at the reduced size, then finish the resize
+            im.draft("RGB", size)
+            im = im.convert("RGB")
+            if im.size != size:
+                im = im.resize(size, Image.BILINEAR)
+    if im is None:
+        image = skimage.io.imread(path)
+        # If grayscale. Convert to RGB for consistency.
+        if image.ndim != 3:
+            image = skimage.color.gray2rgb(image)
+        return resize_image(image, min_dim, max_dim, padding, padded_shape) + (image.shape,)
+
+    w, h = im.size
+    if not padding:
+        return np.asarray(im), (0, 0, h, w), scale, padding, shape
+    padded_h, padded_w = padded_shape[:2] if padded_shape is not None \
+        else (max_dim, max_dim)
+    top_pad = (padded_h - h) // 2
+    left_pad = (padded_w - w) // 2
+    padding = [(top_pad, padded_h - h - top_pad), (left_pad, padded_w - w - left_pad), (0, 0)]
+    image = np.zeros([padded_h, padded_w, 3], dtype=np.uint8)
+    np.copyto(image[top_pad:top_pad + h, left_pad:left_pad + w], im)
+    window = (top_pad, left_pad, h + top_pad, w + left_pad)
+    return image, window, scale, padding, shape
+
+
 def resize_mask(mask, scale, padding):
     """Resizes a mask using the given scale and padding.
     Typically, you get the scale and padding from resize_image() to
@@ -328,9 +858,40 @@ def resize_mask(mask, scale, padding):
             [(top, bottom), (left, right), (0, 0)]
     """
     h, w = mask.shape[:2]
-    mask = scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0)
-    mask = np.pad(mask, padding, mode='constant', constant_values=0)
-    return mask
+    # Nearest neighbour source row and column of every output pixel, the
+    # same ones scipy.ndimage.zoom(order=0) picks. Gathered with a single
+    # index straight into the padded output.
+    rows, rows_inside = _zoom_nearest_indices(h, int(round(h * scale)))
+    cols, cols_inside = _zoom_nearest_indices(w, int(round(w * scale)))
+    (top, bottom), (left, right) = padding[:2]
+    resized = np.zeros((len(rows) + top + bottom, len(cols) + left + right) + mask.shape[2:],
+                       dtype=mask.dtype)
+    resized[top:top + len(rows), left:left + len(cols)] = \
+        mask[rows[:, None], cols] * (rows_inside[:, None] & cols_inside)[..., None]
+    return resized
+
+
+def _zoom_nearest_indices(in_size, out_size):
+    """Source indices of scipy.ndimage.zoom(order=0) along one axis, and
+    whether each is inside the input. zoom() fills the output with zeros
+    where rounding puts the source coordinate past the last pixel.
+    """
+    if out_size <= 1:
+        return np.zeros([out_size], dtype=np.intp), np.ones([out_size], dtype=bool)
+    coords = np.arange(out_size) * ((in_size - 1) / (out_size - 1))
+    inside = coords <= in_size - 1
+    return np.minimum(np.floor(coords + 0.5), in_size - 1).astype(np.intp), inside
+
+
+def pack_masks(masks):
+    """Packs boolean masks into bits, 8 pixels per byte.
+
+    masks: [N, height, width] boolean masks.
+
+    Returns [N, ceil(height * width / 8)] uint8. Unpack with
+    model.unpack_masks().
+    """
+    return np.packbits(masks.reshape(masks.shape[0], -1).astype(bool), axis=1)
 
 
 def minimize_mask(bbox, mask, mini_shape):
@@ -339,16 +900,11 @@ def minimize_mask(bbox, mask, mini_shape):
 
     See inspect_data.ipynb notebook for more details.
     """
-    mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
+    crops = []
     for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
         y1, x1, y2, x2 = bbox[i][:4]
-        m = m[y1:y2, x1:x2]
-        if m.size == 0:
-            raise Exception("Invalid bounding box with area of zero")
-        m = scipy.misc.imresize(m.astype(float), mini_shape, interp='bilinear')
-        mini_mask[:, :, i] = np.where(m >= 128, 1, 0)
-    return mini_mask
+        crops.append(mask[y1:y2, x1:x2, i])
+    return minimize_mask_crops(bbox, crops, mini_shape)
 
 
 def expand_mask(bbox, mini_mask, image_shape):
@@ -357,17 +913,86 @@ def expand_mask(bbox, mini_mask, image_shape):
 
     See inspect_data.ipynb notebook for more details.
     """
-    mask = np.zeros(image_shape[:2] + (mini_mask.shape[-1],), dtype=bool)
-    for i in range(mask.shape[-1]):
-        m = mini_mask[:, :, i]
-        y1, x1, y2, x2 = bbox[i][:4]
-        h = y2 - y1
-        w = x2 - x1
-        m = scipy.misc.imresize(m.astype(float), (h, w), interp='bilinear')
-        mask[y1:y2, x1:x2, i] = np.where(m >= 128, 1, 0)
+    bbox = np.asarray(bbox)[:, :4]
+    shapes = np.stack([bbox[:, 2] - bbox[:, 0], bbox[:, 3] - bbox[:, 1]], axis=1)
+    crops = resize_mask_crops(np.moveaxis(mini_mask, -1, 0), shapes)
+    return expand_mask_crops(bbox, crops, image_shape)
+
+
+def resize_mask_crops(crops, shapes):
+    """Resizes binary masks with a bilinear filter and thresholds them at
+    half intensity, as scipy.misc.imresize(m, shape, interp='bilinear')
+    did. Masks go straight to Pillow as 0/255 bytes, without imresize's
+    float conversion and rescaling.
+
+    crops: List of [height, width] binary masks.
+    shapes: [N, (height, width)] size to resize each mask to.
+
+    Masks are resized one Pillow call at a time, not in a batch. A batched
+    resize of the zero-padded stack of crops with Pillow's fixed-point
+    filter weights gives the same masks, but its dense matrix products do
+    far more work than Pillow's filter windows: 19ms instead of 2.6ms for
+    8 crops of up to 500x600 to 56x56 mini masks.
+
+    Returns a list of [height, width] boolean masks.
+    """
+    resized = []
+    for m, (h, w) in zip(crops, shapes):
+        if m.size == 0:
+            raise Exception("Invalid bounding box with area of zero")
+        image = Image.fromarray(np.where(m, 255, 0).astype(np.uint8))
+        resized.append(np.asarray(image.resize((int(w), int(h)), Image.BILINEAR)) >= 128)
+    return resized
+
+
+def tighten_mask_crop(y1, x1, crop):
+    """Trims empty rows and columns off a mask crop.
+    y1, x1: Position of the top-left corner of the crop in the image.
+    crop: [height, width] binary mask.
+
+    Returns the tight (y1, x1, y2, x2) box of the crop and the trimmed crop,
+    or (None, None) if the crop is empty.
+    """
+    rows = np.where(np.any(crop, axis=1))[0]
+    if not rows.shape[0]:
+        return None, None
+    cols = np.where(np.any(crop, axis=0))[0]
+    r1, r2 = rows[0], rows[-1] + 1
+    c1, c2 = cols[0], cols[-1] + 1
+    box = (y1 + r1, x1 + c1, y1 + r2, x1 + c2)
+    return box, crop[r1:r2, c1:c2].astype(bool)
+
+
+def flip_mask_crops(boxes, crops, width):
+    """Horizontally flips mask crops returned by Dataset.load_mask_crops().
+    width: Width of the (resized and padded) image the boxes are in.
+    """
+    boxes = boxes.copy()
+    boxes[:, 1], boxes[:, 3] = width - boxes[:, 3], width - boxes[:, 1]
+    crops = [np.fliplr(c) for c in crops]
+    return boxes, crops
+
+
+def expand_mask_crops(boxes, crops, image_shape):
+    """Pastes mask crops into a full [height, width, instances] mask."""
+    mask = np.zeros(tuple(image_shape[:2]) + (len(crops),), dtype=bool)
+    for i, crop in enumerate(crops):
+        y1, x1, y2, x2 = boxes[i][:4]
+        mask[y1:y2, x1:x2, i] = crop
     return mask
 
 
+def minimize_mask_crops(boxes, crops, mini_shape):
+    """Resizes mask crops to mini-masks without going through a full size
+    mask. Equivalent to minimize_mask(boxes, expand_mask_crops(...), ...).
+    Crops are resized one by one, see resize_mask_crops().
+    """
+    mini_mask = np.zeros(tuple(mini_shape) + (len(crops),), dtype=bool)
+    for i, m in enumerate(resize_mask_crops(crops, [mini_shape] * len(crops))):
+        mini_mask[:, :, i] = m
+    return mini_mask
+
+
 # TODO: Build and use this function to reduce code duplication
 def mold_mask(mask, config):
     pass
@@ -383,8 +1008,7 @@ def unmold_mask(mask, bbox, image_shape):
     """
     threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = scipy.misc.imresize(
-        mask, (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
+    mask = imresize(mask, (y2 - y1, x2 - x1)).astype(np.float32) / 255.0
     mask = np.where(mask >= threshold, 1, 0).astype(np.uint8)
 
     # Put the mask in the right location.